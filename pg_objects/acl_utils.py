@@ -47,8 +47,17 @@ def parse_datacl(datacl: str):
         c - for CONNECT privilege
         T - for TEMPORARY (alias TEMP) privilege
     """
+    return parse_acl(datacl)
+
+
+def parse_acl(acl: str):
+    """
+    Parses the string representation of any aclitem[] column (datacl, nspacl, relacl, defaclacl)
+    and returns a list of tuples of (grantee, privs_str, grantor).
+    See pg_objects.privileges.acl_to_mask() for what letters privs_str can contain.
+    """
     privs = []
-    for raw in _parse_acl_list_str(datacl):
+    for raw in _parse_acl_list_str(acl):
         grantee, privs_and_grantor = raw.split("=")
         if grantee == "":
             grantee = "public"
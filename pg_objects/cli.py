@@ -1,14 +1,23 @@
 import json
 import logging
+import sys
 
 from aarghparse import cli
 
 from .utils import generate_password, get_password_md5
 from .connection import get_connection
+from .daemon import DEFAULT_CHANNEL, Daemon, install_event_trigger, send_definition
+from .definition import open_definition
+from .plan import Plan
+from .objects.base import ConnectionManager
 from .setup import Setup
+from .snapshot import load_snapshot, save_snapshot
+from .state import State
 
 log = logging.getLogger(__name__)
 
+DEFINITION_HELP = "Definition in JSON, or path to a JSON or NDJSON file with the definition, or - to read it from stdin"
+
 
 @cli
 def pg_objects_cli(parser, subcommand):
@@ -24,16 +33,87 @@ def pg_objects_cli(parser, subcommand):
         default="INFO",
     )
 
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        help="Maximum number of per-database connections to keep open at a time",
+    )
+
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        help="Close per-database connections which have not been used for this many seconds",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of databases to work on at the same time",
+    )
+
+    parser.add_argument(
+        "--table-chunk-size",
+        type=int,
+        help="Grant privileges on tables in chunks of this many tables instead of ON ALL TABLES IN SCHEMA",
+    )
+
+    parser.add_argument(
+        "--lock-timeout",
+        help="Give up waiting for table locks after this time (e.g. 2s) and retry",
+    )
+
+    parser.add_argument(
+        "--lock-retries",
+        type=int,
+        default=3,
+        help="Number of times to retry a transaction which timed out waiting for locks",
+    )
+
+    parser.add_argument(
+        "--state-snapshot",
+        help="File in which to keep the server state between runs so that only changed databases are reloaded",
+    )
+
+    parser.add_argument(
+        "--state",
+        help="Plan against the server state in a file created by export-state instead of connecting to the server",
+    )
+
+    def load_state(path: str) -> State:
+        snapshot = load_snapshot(path)
+        if snapshot is None:
+            raise ValueError(f"Cannot read server state from {path!r}")
+        return State.from_snapshot(snapshot)
+
+    def setup_options(args) -> dict:
+        if args.state:
+            connection = None
+            server_state = load_state(args.state)
+        else:
+            connection = get_connection(env_prefix=args.env_prefix)
+            server_state = None
+        return dict(
+            master_connection=connection,
+            server_state=server_state,
+            max_connections=args.max_connections,
+            idle_timeout=args.idle_timeout,
+            concurrency=args.concurrency,
+            table_chunk_size=args.table_chunk_size,
+            lock_timeout=args.lock_timeout,
+            lock_retries=args.lock_retries,
+            state_snapshot=args.state_snapshot,
+        )
+
     def setup_from_definition(definition_str: str, args) -> Setup:
-        definition = json.loads(definition_str)
-        connection = get_connection(env_prefix=args.env_prefix)
-        return Setup.from_definition(definition, master_connection=connection)
+        with open_definition(definition_str) as stream:
+            return Setup.from_stream(stream, **setup_options(args))
 
     def configure_logging(args):
         logging.basicConfig(level=getattr(logging, args.log_level.upper()))
 
     @subcommand(args=[
-        ["definition", {"help": "Definition in JSON"}],
+        ["definition", {"help": DEFINITION_HELP}],
         ["--no-current-state", {"action": "store_true", "help": "Do not load current state"}],
     ])
     def inspect(args):
@@ -45,16 +125,146 @@ def pg_objects_cli(parser, subcommand):
         setup.inspect(load_current_state=not args.no_current_state)
 
     @subcommand(args=[
-        ["definition", {"help": "Definition in JSON"}],
+        ["definition", {"help": DEFINITION_HELP}],
+        ["--output", {"help": "Save the plan to this file to apply it later with apply --plan"}],
+    ])
+    def plan(args):
+        """
+        Log the statements which apply would execute, and optionally save them.
+        """
+        configure_logging(args)
+        setup = setup_from_definition(definition_str=args.definition, args=args)
+        plan = setup.plan()
+        setup.execute_plan(plan, dry_run=True, verify=False)
+        log.info(f"Plan has {len(plan)} statements")
+        if args.output:
+            plan.save(args.output)
+
+    @subcommand(args=[
+        ["definition", {"nargs": "?", "help": DEFINITION_HELP}],
+        ["--plan", {"help": "Execute the plan saved by the plan subcommand if the server state has not changed since"}],
         ["--dry-run", {"action": "store_true", "help": "Do not execute any queries, just log what would be done"}],
+        ["--batch-size", {"type": int, "help": "Send statements for the same database in batches of this size"}],
+        ["--single-transaction", {"action": "store_true", "help": "Execute statements for each database in one transaction"}],
+        ["--commit-every", {"type": int, "help": "With --single-transaction, commit after every this many statements"}],
     ])
     def apply(args):
         """
         Apply the changes necessary to provision the requested setup.
         """
         configure_logging(args)
-        setup = setup_from_definition(definition_str=args.definition, args=args)
-        setup.execute(dry_run=args.dry_run)
+        if bool(args.definition) == bool(args.plan):
+            raise ValueError("Pass either a definition or --plan")
+        options = dict(
+            dry_run=args.dry_run,
+            batch_size=args.batch_size,
+            single_transaction=args.single_transaction,
+            commit_every=args.commit_every,
+        )
+        if args.plan:
+            setup = Setup(**setup_options(args))
+            setup.execute_plan(Plan.load(args.plan), **options)
+        else:
+            setup = setup_from_definition(definition_str=args.definition, args=args)
+            setup.execute(**options)
+
+    @subcommand(args=[
+        ["definition", {"help": DEFINITION_HELP}],
+        ["--output", {"help": "Write keys of the objects which differ from the setup to this file as JSON"}],
+    ])
+    def check(args):
+        """
+        Check whether the current state matches the setup.
+        Exit with 0 if it does, with 1 if it does not and with 2 if the check failed.
+        """
+        configure_logging(args)
+        try:
+            setup = setup_from_definition(definition_str=args.definition, args=args)
+            drift = setup.get_drift()
+        except Exception:
+            log.exception("Failed to check the current state")
+            sys.exit(2)
+        # An object can be both created and maintained, count it once
+        drifted = len(set().union(*drift.values()))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump({"drifted": drifted, "objects": drift}, f, indent=2)
+        if drifted:
+            log.warning(f"{drifted} object(s) differ from the setup")
+            sys.exit(1)
+        log.info("Current state matches the setup")
+
+    @subcommand(name="export-state", args=[
+        ["path", {"help": "File to write the server state to, compressed with gzip if it ends with .gz"}],
+        ["--without-passwords", {"action": "store_true", "help": "Do not export digests of password hashes"}],
+    ])
+    def export_state(args):
+        """
+        Export the state of the whole cluster to a file so that setups can be planned against it with --state.
+        The file is only readable by its owner and contains digests of password hashes, not the hashes.
+        """
+        configure_logging(args)
+        state = State(
+            master_connection=get_connection(env_prefix=args.env_prefix),
+            concurrency=args.concurrency,
+        )
+        state.load_all(fingerprint=True)
+        save_snapshot(state.to_snapshot(without_passwords=args.without_passwords), args.path)
+
+    @subcommand(args=[
+        ["--socket", {"required": True, "help": "Path of the unix socket to listen on"}],
+        ["--listen", {"action": "store_true", "help": "Listen for notifications of the event trigger, see install-event-trigger"}],
+        ["--channel", {"default": DEFAULT_CHANNEL, "help": "Channel the event trigger notifies"}],
+    ])
+    def daemon(args):
+        """
+        Keep the server state in memory and apply definitions sent with reconcile.
+        """
+        configure_logging(args)
+        connection_manager = ConnectionManager(
+            master_connection=get_connection(env_prefix=args.env_prefix),
+            max_connections=args.max_connections,
+            idle_timeout=args.idle_timeout,
+        )
+        Daemon(
+            connection_manager=connection_manager,
+            listen=args.listen,
+            channel=args.channel,
+            concurrency=args.concurrency,
+            table_chunk_size=args.table_chunk_size,
+            lock_timeout=args.lock_timeout,
+            lock_retries=args.lock_retries,
+        ).serve(args.socket)
+
+    @subcommand(args=[
+        ["definition", {"help": DEFINITION_HELP}],
+        ["--socket", {"required": True, "help": "Path of the unix socket the daemon listens on"}],
+        ["--dry-run", {"action": "store_true", "help": "Do not execute any queries, just log what would be done"}],
+    ])
+    def reconcile(args):
+        """
+        Send the definition to the daemon to apply it, exit with 1 if it failed.
+        """
+        configure_logging(args)
+        with open_definition(args.definition) as stream:
+            response = send_definition(args.socket, stream, dry_run=args.dry_run)
+        print(json.dumps(response))
+        if response["status"] != "ok":
+            sys.exit(1)
+
+    @subcommand(name="install-event-trigger", args=[
+        ["databases", {"nargs": "+", "help": "Databases to install the event trigger in"}],
+        ["--channel", {"default": DEFAULT_CHANNEL, "help": "Channel to notify of DDL commands"}],
+    ])
+    def install_event_trigger_cmd(args):
+        """
+        Install an event trigger which notifies the daemon of DDL commands so that it reloads only changed databases.
+        """
+        configure_logging(args)
+        connection = get_connection(env_prefix=args.env_prefix)
+        for datname in args.databases:
+            with connection.clone(database=datname) as conn:
+                install_event_trigger(conn, channel=args.channel)
 
     @subcommand(args=[
         ["username"],
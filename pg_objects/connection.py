@@ -2,9 +2,12 @@ import logging
 import os
 import re
 import textwrap
-from typing import Any, Dict, Generator, Optional
+from typing import Any, Dict, Generator, List, Optional, Tuple
 
 import psycopg2
+import psycopg2.extensions
+
+from .utils import quote_ident
 
 
 log = logging.getLogger(__name__)
@@ -50,6 +53,12 @@ class Connection:
         # Can be used to catch programming errors regardless of the driver being used.
         self.programming_error_cls = None
         self.authentication_error_cls = None
+        self.database_error_cls = None
+
+        # Number of physical connections opened and number of queries sent,
+        # useful to confirm that connections are being reused.
+        self.connect_count = 0
+        self.query_count = 0
 
     def clone(self, **kwargs) -> "Connection":
         """
@@ -67,6 +76,19 @@ class Connection:
 
     @property
     def connection(self):
+        """
+        The live connection to the database.
+        It is opened on first access and reused after that.
+        A connection that has been closed or broken is discarded and a new one is opened.
+        """
+        if self._connection is not None and not self.is_healthy():
+            log.warning(f"Connection {self} is no longer usable, reconnecting")
+            self._discard_connection()
+        if self._connection is None:
+            self._connection = self._connect()
+        return self._connection
+
+    def _connect(self):
         host_str = f"host={self.host}" if self.host else ""
         dsn = (
             f"dbname={self.database} "
@@ -75,15 +97,55 @@ class Connection:
             f"user={self.username} "
             f"password={self._connection_params['password']}"
         )
-        self._connection = psycopg2.connect(dsn)
-        self._connection.autocommit = self._connection_extras['autocommit']
+        connection = psycopg2.connect(dsn)
+        connection.autocommit = self._connection_extras['autocommit']
         self.programming_error_cls = psycopg2.ProgrammingError
         self.authentication_error_cls = psycopg2.OperationalError
-        return self._connection
+        self.database_error_cls = psycopg2.Error
+        self.connect_count += 1
+        return connection
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connection is not None
+
+    def is_healthy(self) -> bool:
+        """
+        Cheap client-side check of the current connection, does not talk to the server.
+        Use ping() to verify that the server is actually reachable.
+        """
+        if self._connection is None or self._connection.closed:
+            return False
+        status = self._connection.get_transaction_status()
+        return status != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+
+    def ping(self) -> bool:
+        """
+        Returns True if the server responds to a trivial query.
+        A connection which fails to respond is discarded so that the next use reconnects.
+        """
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            self._discard_connection()
+            return False
+
+    def _discard_connection(self):
+        """
+        Forget the current connection without committing anything.
+        """
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except psycopg2.Error:
+                pass
+            self._connection = None
 
     @property
     def autocommit(self):
-        return self.connection.autocommit
+        return self._connection_extras['autocommit']
 
     @property
     def database(self):
@@ -115,8 +177,9 @@ class Connection:
 
     def close(self):
         if self._connection is not None:
-            self._connection.commit()
-            self._connection.close()
+            if not self._connection.closed:
+                self._connection.commit()
+                self._connection.close()
             self._connection = None
 
     def execute(self, query, *rest) -> "Result":
@@ -124,15 +187,65 @@ class Connection:
         cursor = self.connection.cursor()
         try:
             self.log_query(query)
+            self.query_count += 1
             if rest:
                 cursor.execute(query, rest)
             else:
                 cursor.execute(query)
         except Exception:
             log.warning(f"Failed to execute query (as {self.username!r}): {self.format_query(query)}")
+            if not self.is_healthy():
+                # Make sure the next query gets a fresh connection
+                self._discard_connection()
             raise
         return Result(cursor)
 
+    def execute_batch(self, queries: List[Tuple[str, Tuple]]):
+        """
+        Sends several queries, each passed as a tuple of (query, params), to the server in one round trip.
+
+        The server executes them in a single implicit transaction, so if one of them fails,
+        none of them are applied.
+        """
+        cursor = self.connection.cursor()
+        parts = []
+        for query, params in queries:
+            query = textwrap.dedent(query).strip().rstrip(";")
+            self.log_query(query)
+            if params:
+                query = cursor.mogrify(query, params).decode()
+            parts.append(query)
+        try:
+            self.query_count += 1
+            cursor.execute(";\n".join(parts))
+        except Exception:
+            log.warning(f"Failed to execute a batch of {len(parts)} queries (as {self.username!r}) in {self.database!r}")
+            if not self.is_healthy():
+                self._discard_connection()
+            elif not self.autocommit:
+                self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def listen(self, channel: str):
+        """
+        Subscribes the connection to notifications sent to the channel, see get_notifications().
+        """
+        self.execute(f"LISTEN {quote_ident(channel)}")
+
+    def get_notifications(self) -> List[str]:
+        """
+        Returns payloads of the notifications received since the last call, without waiting for any.
+        """
+        if not self.is_healthy():
+            # A new connection would not be listening and notifications may have been missed
+            raise ConnectionError(f"Connection {self} which was listening for notifications was lost")
+        self._connection.poll()
+        payloads = [notify.payload for notify in self._connection.notifies]
+        del self._connection.notifies[:]
+        return payloads
+
     def statement(self, query, *query_args, columns=None) -> "Statement":
         return Statement(query, *query_args, columns=columns, db=self)
 
@@ -211,22 +324,40 @@ class Transaction:
     def __init__(self, db: Connection):
         self.db = db
         self.cursor = None
+        self._connection = None
+        self._autocommit = False
 
     def __enter__(self) -> "Transaction":
-        self.cursor = self.db.connection.cursor()
+        self._connection = self.db.connection
+        # In autocommit mode every statement would be committed on its own,
+        # so autocommit is switched off for the duration of the transaction.
+        self._autocommit = self._connection.autocommit
+        if self._autocommit:
+            self._connection.autocommit = False
+        self.cursor = self._connection.cursor()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is not None:
-            log.warning(f"Rolling back due to an exception ({exc_type}, {exc_val}, {exc_tb})")
-            self.db.connection.rollback()
-        else:
-            self.db.connection.commit()
-        self.cursor.close()
+        try:
+            if exc_type is not None:
+                log.warning(f"Rolling back due to an exception ({exc_type}, {exc_val}, {exc_tb})")
+                if not self._connection.closed:
+                    self._connection.rollback()
+            else:
+                self._connection.commit()
+        finally:
+            if not self._connection.closed:
+                self.cursor.close()
+                if self._autocommit:
+                    self._connection.autocommit = True
 
     def execute(self, query, *query_args):
         self.db.log_query(query)
-        self.cursor.execute(query, *query_args)
+        self.db.query_count += 1
+        if query_args:
+            self.cursor.execute(query, query_args)
+        else:
+            self.cursor.execute(query)
 
 
 def get_connection(env_prefix="PGO_", defaults: Dict = None, overrides: Dict = None) -> Connection:
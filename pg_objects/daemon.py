@@ -0,0 +1,216 @@
+"""
+Long-running reconcile daemon.
+
+The daemon keeps the connections, the Setup of the last definition and the loaded server state in memory
+and listens on a unix socket for definitions to apply. A request is a line of JSON options
+(such as {"dry_run": true}) followed by the definition in any format accepted by iter_definition(),
+and the client shuts down its side of the socket once the definition is sent.
+The response is a line of JSON: {"status": "ok", "statements": n} or {"status": "error", "error": "..."}.
+
+Before every run the state is checked for changes made since the last run:
+
+- Cluster-level state (roles and databases) is reloaded if the cluster fingerprint has changed.
+- Databases in which the event trigger installed by install_event_trigger() notifies the daemon
+  of DDL commands are only reloaded after a notification. The fingerprints of other databases
+  are checked, see State.load_all().
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+from typing import Dict, Optional, Set, TextIO
+
+from .connection import Connection
+from .objects.base import ConnectionManager
+from .objects.database import Database
+from .setup import Setup
+from .snapshot import StateCache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = "pg_objects"
+
+EVENT_TRIGGER_NAME = "pg_objects_notify_ddl"
+
+
+def install_event_trigger(connection: Connection, channel: str = DEFAULT_CHANNEL):
+    """
+    Installs an event trigger in the database of the connection which notifies the channel
+    after every DDL command, with the name of the database as payload. Requires a superuser.
+    """
+    with connection.begin() as tx:
+        tx.execute(f"""
+            CREATE OR REPLACE FUNCTION {EVENT_TRIGGER_NAME}() RETURNS event_trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                PERFORM pg_notify(%s, current_database());
+            END
+            $$
+        """, channel)
+        tx.execute(f"DROP EVENT TRIGGER IF EXISTS {EVENT_TRIGGER_NAME}")
+        tx.execute(f"""
+            CREATE EVENT TRIGGER {EVENT_TRIGGER_NAME} ON ddl_command_end
+            EXECUTE PROCEDURE {EVENT_TRIGGER_NAME}()
+        """)
+
+
+def has_event_trigger(connection: Connection) -> bool:
+    return connection.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_event_trigger WHERE evtname = %s AND evtenabled <> 'D')",
+        EVENT_TRIGGER_NAME,
+    ).scalar()
+
+
+class Daemon:
+    """
+    Applies definitions against warm state, see the module docstring.
+
+    setup_options are passed to Setup (such as concurrency or table_chunk_size).
+    If listen is set, databases with the event trigger are watched for changes on the channel.
+    """
+
+    def __init__(
+        self, connection_manager: ConnectionManager, listen: bool = False, channel: str = DEFAULT_CHANNEL,
+        **setup_options,
+    ):
+        self.connection_manager = connection_manager
+        self.listen = listen
+        self.channel = channel
+        self.setup_options = setup_options
+        self.state_cache = StateCache()
+
+        # Connections listening for notifications: [database] => Connection.
+        # They are not pooled by the connection manager so that they are never closed.
+        self._listeners: Dict[str, Connection] = {}
+
+        self._setup: Optional[Setup] = None
+        self._setup_digest: Optional[str] = None
+
+    def get_setup(self, definition: str) -> Setup:
+        """
+        Returns the Setup of the definition. The Setup of the last definition, with its object graph,
+        is reused if the definition has not changed.
+        """
+        digest = hashlib.sha256(definition.encode()).hexdigest()
+        if digest != self._setup_digest:
+            self._setup = Setup.from_stream(
+                io.StringIO(definition),
+                connection_manager=self.connection_manager,
+                state_cache=self.state_cache,
+                **self.setup_options,
+            )
+            self._setup_digest = digest
+        return self._setup
+
+    def reconcile(self, definition: str, dry_run: bool = False) -> Dict:
+        setup = self.get_setup(definition)
+
+        self.process_notifications()
+        plan = setup.plan()
+
+        # Notifications received from now on are of changes made after the state was loaded
+        self.state_cache.unchanged_databases = set(self._listeners)
+
+        setup.execute_plan(plan, dry_run=dry_run, verify=False)
+        if self.listen:
+            self.watch({
+                datname for datname in setup.managed_databases
+                if setup.get_current_state(Database(datname)).is_present
+            })
+        return {"status": "ok", "statements": len(plan)}
+
+    def watch(self, databases: Set[str]):
+        """
+        Starts listening for notifications in those of the databases which have the event trigger installed.
+        """
+        for datname in sorted(databases - set(self._listeners)):
+            connection = self.connection_manager.master_connection.clone(database=datname)
+            try:
+                if not has_event_trigger(connection):
+                    log.debug(f"No event trigger in {datname!r}, its fingerprint will be checked on every run")
+                    connection.close()
+                    continue
+                connection.listen(self.channel)
+            except Exception as e:
+                # Not being able to watch a database only makes its state more expensive to check
+                log.warning(f"Cannot listen for notifications in {datname!r}: {e}")
+                connection.close()
+                continue
+            log.info(f"Listening for changes in {datname!r}")
+            self._listeners[datname] = connection
+
+    def process_notifications(self):
+        """
+        Marks the databases from which notifications were received as changed.
+        A database whose listening connection was lost is marked as changed and is no longer watched.
+        """
+        for datname, connection in list(self._listeners.items()):
+            try:
+                notified = bool(connection.get_notifications())
+            except Exception as e:
+                log.warning(f"Stopped listening for changes in {datname!r}: {e}")
+                connection.close()
+                del self._listeners[datname]
+                notified = True
+            if notified:
+                self.state_cache.unchanged_databases.discard(datname)
+
+    def make_server(self, socket_path: str) -> socketserver.UnixStreamServer:
+        """
+        Returns a server which handles requests on the unix socket one at a time.
+        """
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.unlink(socket_path)
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    options = json.loads(self.rfile.readline() or "{}")
+                    definition = self.rfile.read().decode("utf-8")
+                    response = daemon.reconcile(definition, dry_run=bool(options.get("dry_run")))
+                except Exception as e:
+                    log.exception("Failed to reconcile")
+                    response = {"status": "error", "error": str(e)}
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+        class Server(socketserver.UnixStreamServer):
+            def service_actions(self):
+                # Read notifications while idle so that they do not pile up in the server
+                daemon.process_notifications()
+
+        # The daemon applies changes as the master user, so only its own OS user may send definitions
+        umask = os.umask(0o177)
+        try:
+            return Server(socket_path, Handler)
+        finally:
+            os.umask(umask)
+
+    def serve(self, socket_path: str):
+        """
+        Serves requests on the unix socket until interrupted.
+        """
+        with self.make_server(socket_path) as server:
+            log.info(f"Listening on {socket_path}")
+            try:
+                server.serve_forever(poll_interval=1.0)
+            finally:
+                os.unlink(socket_path)
+
+
+def send_definition(socket_path: str, definition: TextIO, dry_run: bool = False) -> Dict:
+    """
+    Sends the definition to the daemon listening on the socket and returns its response.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({"dry_run": dry_run}).encode("utf-8") + b"\n")
+        sock.sendall(definition.read().encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
@@ -0,0 +1,161 @@
+"""
+Streaming loader of setup definitions.
+
+A definition is read in chunks and its objects are yielded one at a time,
+so that definitions with millions of objects don't need to fit in memory.
+Supported formats:
+
+- JSON document: {"objects": [{"type": "Group", "name": "devops"}, ...]}
+- JSON array of objects: [{"type": "Group", "name": "devops"}, ...]
+- NDJSON (or any whitespace-separated JSON objects): one object per line.
+"""
+
+import contextlib
+import io
+import json
+import sys
+from typing import Any, Dict, Generator, TextIO
+
+_decoder = json.JSONDecoder()
+
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",:]}[{"
+
+
+class _Reader:
+    """
+    Buffer over a text stream from which JSON values are decoded one at a time.
+    """
+
+    def __init__(self, stream: TextIO, chunk_size: int):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what has been consumed so that the buffer does not grow with the stream
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character, or "" at the end of the stream.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return ""
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in definition, got {self.peek()!r}")
+        self.pos += 1
+
+    def decode(self) -> Any:
+        """
+        Decodes the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._read():
+                    continue
+                raise
+            # A number cut off by the end of the buffer may have been decoded only partially
+            # (such as "1" of "1.25"), so a value must be followed by a delimiter or the end of the stream.
+            if (end == len(self.buf) or self.buf[end] not in _DELIMITERS) and self._read():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_definition(stream: TextIO, chunk_size: int = 1 << 16) -> Generator[Dict, None, None]:
+    """
+    Yields raw objects (as accepted by registry.deserialise_object) of the definition read from the stream.
+    """
+    reader = _Reader(stream, chunk_size=chunk_size)
+    while True:
+        char = reader.peek()
+        if char == "":
+            return
+        elif char == "[":
+            yield from _iter_array(reader)
+        elif char == "{":
+            yield from _iter_object(reader)
+        else:
+            raise ValueError(f"Expected an object or an array in definition, got {char!r}")
+
+
+def _iter_array(reader: _Reader) -> Generator[Dict, None, None]:
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        yield reader.decode()
+        if reader.peek() == ",":
+            reader.pos += 1
+            continue
+        reader.expect("]")
+        return
+
+
+def _iter_object(reader: _Reader) -> Generator[Dict, None, None]:
+    """
+    Parses a top-level object key by key. The "objects" array of a definition document is streamed,
+    any other top-level object is an object of an NDJSON definition and is yielded as a whole.
+    """
+    reader.expect("{")
+    raw = {}
+    is_document = False
+    first = True
+    while reader.peek() != "}":
+        if not first:
+            reader.expect(",")
+        first = False
+        key = _decode_key(reader)
+        if key == "objects" and reader.peek() == "[":
+            is_document = True
+            yield from _iter_array(reader)
+        else:
+            raw[key] = reader.decode()
+    reader.pos += 1
+    if not is_document:
+        yield raw
+
+
+def _decode_key(reader: _Reader) -> str:
+    if reader.peek() != '"':
+        raise ValueError(f"Expected a key in definition, got {reader.peek()!r}")
+    key = reader.decode()
+    reader.expect(":")
+    return key
+
+
+@contextlib.contextmanager
+def open_definition(definition: str) -> Generator[TextIO, None, None]:
+    """
+    Yields a stream of the definition passed as a path to a file, "-" for stdin,
+    or as the JSON itself.
+    """
+    if definition == "-":
+        yield sys.stdin
+    elif definition.lstrip()[:1] in ("{", "["):
+        yield io.StringIO(definition)
+    else:
+        with open(definition, encoding="utf-8") as f:
+            yield f
@@ -0,0 +1,372 @@
+import collections
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Collection, Dict, Generator, Iterable, List, Optional, Tuple
+
+from .connection import Connection
+from .objects.base import ConnectionManager
+from .objects.database import Database
+from .statements import CreateStatement, DropStatement, Statement, TransactionOfStatements
+
+
+log = logging.getLogger(__name__)
+
+# SQLSTATE of the error raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = "55P03"
+
+# SQLSTATE of the error raised when a table does not exist
+UNDEFINED_TABLE = "42P01"
+
+
+class ExecutionError(Exception):
+    """
+    Raised when statements failed in one or more databases which were worked on concurrently.
+    The statements in other databases were still executed.
+    """
+
+    def __init__(self, failures: Dict[str, Exception]):
+        self.failures = failures
+        details = "; ".join(f"{database}: {error}" for database, error in failures.items())
+        super().__init__(f"Statements failed in {len(failures)} database(s): {details}")
+
+
+class Executor:
+    """
+    Executes statements generated by Setup against the database cluster.
+
+    Statements marked with Statement.ALL_DATABASES are executed on each of the passed databases.
+
+    If batch_size is set, consecutive statements which are to be executed in the same database
+    are sent to the server in batches of up to batch_size statements, one round trip per batch.
+    The server executes a batch in a single implicit transaction, so a failing batch changes nothing;
+    its statements are then executed one by one to apply the ones that succeed and to report
+    the one that fails.
+
+    concurrency is the number of databases worked on at the same time, see execute_concurrently().
+
+    If single_transaction is set, consecutive statements for the same database are executed
+    in one transaction instead of each being committed on its own; if commit_every is set too,
+    the transaction is committed after every commit_every statements.
+    Statements which cannot run inside a transaction block are executed outside of it.
+    Use this with execute_concurrently() which groups the statements by database
+    so that each database gets a single transaction.
+
+    Transactions with a lock_timeout or keep_separate are always executed on their own. When they fail to acquire
+    a lock in time, they are retried after lock_retry_delay seconds, doubling the delay each time.
+    """
+
+    lock_retry_delay: float = 0.5
+
+    def __init__(
+        self,
+        connection_manager: ConnectionManager, databases: Collection[str],
+        dry_run: bool = False, batch_size: int = None, concurrency: int = 1,
+        single_transaction: bool = False, commit_every: int = None,
+    ):
+        self.connection_manager = connection_manager
+        self.databases = list(databases)
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.single_transaction = single_transaction
+        self.commit_every = commit_every
+
+    def get_connection(self, database: str = None) -> Connection:
+        """
+        Returns a pooled connection which is not pinned. Statements are executed on connections
+        acquired with ConnectionManager.using() instead, so that other threads cannot evict them.
+        """
+        return self.connection_manager.get_connection(database=database)
+
+    def expand(self, statements: Iterable[Statement]) -> Generator[Tuple[Optional[str], Statement], None, None]:
+        """
+        Yields (database, statement) pairs, with statements marked with ALL_DATABASES
+        repeated for each of the databases.
+        """
+        for stmt in statements:
+            if stmt.is_on_all_databases:
+                for datname in self.databases:
+                    yield datname, stmt
+            else:
+                yield stmt.database, stmt
+
+    def execute(self, statements: Iterable[Statement]):
+        """
+        Executes the statements in order.
+
+        Consecutive statements marked with ALL_DATABASES are executed in all databases concurrently,
+        up to `concurrency` databases at a time. A failure in one database does not stop
+        the statements in the other databases, but execution stops after that with an ExecutionError.
+        """
+        for on_all_databases, group in itertools.groupby(statements, key=lambda s: s.is_on_all_databases):
+            if on_all_databases:
+                group = list(group)
+                self._execute_streams({datname: [(datname, stmt) for stmt in group] for datname in self.databases})
+            else:
+                self._execute_units(self.expand(group))
+
+    def execute_concurrently(self, statements: Iterable[Statement], drop_statements: Iterable[Statement]):
+        """
+        Executes the statements in three steps:
+
+        1. Cluster-level statements (those executed in the master database, such as CREATE ROLE
+           and CREATE DATABASE) of `statements`, in order.
+        2. Statements for individual databases of both `statements` and `drop_statements`.
+           Statements of each database are executed in order, but up to `concurrency` databases
+           are worked on at the same time.
+        3. Cluster-level statements of `drop_statements` (such as DROP ROLE and DROP DATABASE), in order.
+
+        This relies on statements in different databases not depending on each other
+        once the cluster-level objects exist.
+        """
+        before, streams = self._split_by_database(self.expand(statements))
+        after, drop_streams = self._split_by_database(self.expand(drop_statements))
+        for database, units in drop_streams.items():
+            streams.setdefault(database, []).extend(units)
+
+        self._execute_units(before)
+        self._execute_streams(streams)
+        self._execute_units(after)
+
+    def _execute_units(self, units: Iterable[Tuple[Optional[str], Statement]]):
+        if self.dry_run:
+            for database, stmt in units:
+                self.execute_statement(database, stmt)
+        elif self.single_transaction:
+            for database, group in self._group_into_batches(units, max_length=self.commit_every):
+                if self.is_batchable(group[0]):
+                    self.execute_in_transaction(database, group)
+                else:
+                    self.execute_statement(database, group[0])
+        elif self.batch_size:
+            for database, batch in self._group_into_batches(units, max_length=self.batch_size):
+                self.execute_batch(database, batch)
+        else:
+            for database, stmt in units:
+                self.execute_statement(database, stmt)
+
+    def _execute_streams(self, streams: Dict[str, List[Tuple[str, Statement]]]):
+        """
+        Executes statements of each database in order, up to `concurrency` databases at a time.
+        A failure in one database does not stop the others; all failures are reported together.
+        """
+        failures = {}
+
+        def run(database: str):
+            with self.connection_manager.using(database):
+                self._execute_units(streams[database])
+
+        # Keep the log of a dry run readable
+        workers = 1 if self.dry_run else max(self.concurrency or 1, 1)
+        if self.connection_manager.max_connections:
+            workers = min(workers, self.connection_manager.max_connections)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pg_objects_exec") as pool:
+            futures = {database: pool.submit(run, database) for database in streams}
+            for database, future in futures.items():
+                error = future.exception()
+                if error is not None:
+                    log.error(f"Failed to execute statements in {database!r}: {error}")
+                    failures[database] = error
+
+        if failures:
+            raise ExecutionError(failures)
+
+    def _split_by_database(
+        self, units: Iterable[Tuple[Optional[str], Statement]],
+    ) -> Tuple[List[Tuple[Optional[str], Statement]], Dict[str, List[Tuple[str, Statement]]]]:
+        """
+        Splits units into cluster-level ones and the ones for individual databases.
+        """
+        master_database = self.connection_manager.master_connection.database
+        cluster_units = []
+        database_units = collections.OrderedDict()
+        for database, stmt in units:
+            if database is None or database == master_database or self.is_cluster_level(stmt):
+                cluster_units.append((database, stmt))
+            else:
+                database_units.setdefault(database, []).append((database, stmt))
+        return cluster_units, database_units
+
+    def execute_statement(self, database: Optional[str], statement: Statement):
+        with self.connection_manager.using(database) as connection:
+            if self.dry_run:
+                for stmt in self._flatten(statement):
+                    connection.log_query(stmt.query, dry_run=True, database=database or connection.database)
+                return
+
+            # Before attempting to drop a database, must close the connection to that database.
+            # (a connection was acquired earlier for each database to load its schemas)
+            if isinstance(statement, DropStatement) and isinstance(statement.obj, Database):
+                self.connection_manager.close_connection(statement.obj.name)
+
+            # If a statement is a transaction, must execute it as one
+            if isinstance(statement, TransactionOfStatements):
+                self.execute_transaction(connection, statement)
+            else:
+                connection.execute(statement.query, *statement.params)
+
+    def execute_transaction(self, connection: Connection, statement: TransactionOfStatements):
+        """
+        Executes a transaction, retrying it with exponential backoff if it has lock_timeout set
+        and fails to acquire a lock in time.
+
+        If the transaction fails because some of the tables it lists have been dropped
+        since the state was loaded, it is retried without them.
+        """
+        attempt = 0
+        while True:
+            try:
+                with connection.begin() as tx:
+                    if statement.lock_timeout:
+                        tx.execute("SET LOCAL lock_timeout = %s", statement.lock_timeout)
+                    for stmt in statement.statements:
+                        assert stmt.database is None or stmt.database == connection.database
+                        tx.execute(stmt.query, *stmt.params)
+                return
+            except Exception as e:
+                if getattr(e, "pgcode", None) == UNDEFINED_TABLE and statement.tables:
+                    existing = self.get_existing_tables(connection, statement.tables)
+                    if len(existing) < len(statement.tables):
+                        dropped = sorted(f"{schema}.{table}" for schema, table in set(statement.tables) - set(existing))
+                        log.warning(
+                            f"Tables {', '.join(dropped)} no longer exist in {connection.database!r}, "
+                            f"retrying without them"
+                        )
+                        retry = statement.with_tables(existing)
+                        if retry is not None:
+                            self.execute_transaction(connection, retry)
+                        return
+                if getattr(e, "pgcode", None) != LOCK_NOT_AVAILABLE or attempt >= statement.retries:
+                    raise
+                delay = self.lock_retry_delay * 2 ** attempt
+                attempt += 1
+                log.warning(
+                    f"Could not acquire locks in {connection.database!r}, "
+                    f"retrying in {delay:.1f}s ({attempt} of {statement.retries})"
+                )
+                time.sleep(delay)
+
+    @staticmethod
+    def get_existing_tables(connection: Connection, tables: Collection[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Returns those of the (schema, table) pairs which are tables in the database of the connection.
+        """
+        schemas = sorted({schema for schema, _ in tables})
+        names = sorted({table for _, table in tables})
+        rows = connection.execute("""
+            SELECT n.nspname, c.relname FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'p') AND n.nspname = ANY(%s) AND c.relname = ANY(%s)
+        """, schemas, names).get_all("nspname", "relname")
+        current = {(row["nspname"], row["relname"]) for row in rows}
+        return [table for table in tables if table in current]
+
+    def execute_batch(self, database: Optional[str], statements: List[Statement]):
+        if len(statements) == 1:
+            self.execute_statement(database, statements[0])
+            return
+
+        with self.connection_manager.using(database) as connection:
+            queries = [(stmt.query, stmt.params) for statement in statements for stmt in self._flatten(statement)]
+            try:
+                connection.execute_batch(queries)
+            except Exception as e:
+                if not isinstance(e, connection.database_error_cls or ()) or not connection.is_healthy():
+                    raise
+                log.warning(
+                    f"Batch of {len(queries)} statements failed in {connection.database!r} ({e}), "
+                    f"executing them one by one to find the failing statement"
+                )
+                for statement in statements:
+                    self.execute_statement(database, statement)
+
+    def execute_in_transaction(self, database: Optional[str], statements: List[Statement]):
+        """
+        Executes statements in a single transaction, in batches if batch_size is set.
+        """
+        with self.connection_manager.using(database) as connection:
+            queries = [(stmt.query, stmt.params) for statement in statements for stmt in self._flatten(statement)]
+            try:
+                with connection.begin() as tx:
+                    if self.batch_size:
+                        for i in range(0, len(queries), self.batch_size):
+                            connection.execute_batch(queries[i:i + self.batch_size])
+                    else:
+                        for query, params in queries:
+                            tx.execute(query, *params)
+            except Exception as e:
+                if not self.batch_size or not isinstance(e, connection.database_error_cls or ()):
+                    raise
+                if not connection.is_healthy():
+                    raise
+                log.warning(
+                    f"Transaction of {len(queries)} statements failed in {connection.database!r} ({e}), "
+                    f"executing them one by one to find the failing statement"
+                )
+                with connection.begin() as tx:
+                    for query, params in queries:
+                        tx.execute(query, *params)
+
+    def _group_into_batches(
+        self, units: Iterable[Tuple[Optional[str], Statement]], max_length: int = None,
+    ) -> Generator[Tuple[Optional[str], List[Statement]], None, None]:
+        """
+        Groups consecutive units for the same database into batches of up to max_length statements
+        (statements in transactions are counted individually). Statements which are not batchable
+        are yielded on their own.
+        """
+        master_database = self.connection_manager.master_connection.database
+        batch_database = None
+        batch = []
+        batch_length = 0
+
+        for database, stmt in units:
+            if database is None:
+                database = master_database
+            length = len(self._flatten(stmt))
+            if batch and (
+                database != batch_database
+                or (max_length and batch_length + length > max_length)
+                or not self.is_batchable(stmt)
+            ):
+                yield batch_database, batch
+                batch = []
+                batch_length = 0
+            if not self.is_batchable(stmt):
+                yield database, [stmt]
+                continue
+            batch_database = database
+            batch.append(stmt)
+            batch_length += length
+
+        if batch:
+            yield batch_database, batch
+
+    @staticmethod
+    def is_cluster_level(statement: Statement) -> bool:
+        """
+        Returns True for statements which change the cluster rather than a database
+        and cannot run inside a transaction block.
+        """
+        return isinstance(statement, (CreateStatement, DropStatement)) and isinstance(statement.obj, Database)
+
+    @classmethod
+    def is_batchable(cls, statement: Statement) -> bool:
+        """
+        Statements which cannot run inside a transaction block cannot be batched,
+        and neither can transactions which are meant to hold their locks briefly.
+        """
+        if cls.is_cluster_level(statement):
+            return False
+        if isinstance(statement, TransactionOfStatements) and (statement.lock_timeout or statement.keep_separate):
+            return False
+        return True
+
+    @staticmethod
+    def _flatten(statement: Statement) -> List[Statement]:
+        if isinstance(statement, TransactionOfStatements):
+            return list(statement.statements)
+        return [statement]
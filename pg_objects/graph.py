@@ -1,10 +1,27 @@
+import array
 import collections
-from typing import Iterable, Union, Hashable
+from typing import Any, Dict, Hashable, Iterable, List, Tuple, Union
+
+
+class GraphCycleError(ValueError):
+    """
+    Raised when a graph that has cycles is sorted topologically.
+    `cycles` has a path of values for each strongly connected component of the graph,
+    with the first value repeated at the end, e.g. ["a", "b", "a"].
+    """
+
+    def __init__(self, cycles: List[List[Any]]):
+        self.cycles = cycles
+        paths = "; ".join(" -> ".join(repr(value) for value in cycle) for cycle in cycles)
+        super().__init__(f"Graph has {len(cycles)} cycle(s): {paths}")
 
 
 class Vertex:
-    def __init__(self, value, graph: "Graph"):
+    __slots__ = ("_graph", "id", "value")
+
+    def __init__(self, value, graph: "Graph", id: int = None):
         self._graph = graph
+        self.id = id
         self.value = value
 
     def __hash__(self):
@@ -21,97 +38,237 @@ class Vertex:
 
     @property
     def dependencies(self):
-        return self._graph._edges_from[self]
+        return {self._graph._vertices[i] for i in self._graph._adjacent(self.id, dependants=False)}
 
     @property
     def dependants(self):
-        return self._graph._edges_to[self]
+        return {self._graph._vertices[i] for i in self._graph._adjacent(self.id, dependants=True)}
 
 
 class Graph:
-    def __init__(self):
-        self._vertices = dict()
-        self._edges_to = collections.defaultdict(set)
-        self._edges_from = collections.defaultdict(set)
+    """
+    Directed graph in which an edge from a vertex to another means that the former depends on the latter.
 
-    def new_vertex(self, value):
-        node = Vertex(value, graph=self)
-        self._vertices[hash(value)] = node
-        return node
+    Vertices are identified by integer ids assigned in the order in which they are added,
+    and edges are stored as two arrays of ids. Adjacency in compressed sparse row form
+    is built from them when needed and kept until the graph changes.
+    """
 
-    def add_edge(self, vertex_from: Union[Vertex, Hashable], vertex_to: Union[Vertex, Hashable]):
-        if not isinstance(vertex_from, Vertex):
-            vertex_from = self._vertices[hash(vertex_from)]
-        if not isinstance(vertex_to, Vertex):
-            vertex_to = self._vertices[hash(vertex_to)]
-        self._edges_from[vertex_from].add(vertex_to)
-        self._edges_to[vertex_to].add(vertex_from)
+    def __init__(self):
+        self._vertices: List[Vertex] = []
+        self._ids: Dict[Hashable, int] = {}
+        self._edges_from = array.array("q")
+        self._edges_to = array.array("q")
+        self._csr: Dict[bool, Tuple[array.array, array.array]] = {}
+
+    def new_vertex(self, value) -> Vertex:
+        """
+        Adds a vertex for the value, or returns the existing one if the value is already in the graph.
+        """
+        if value in self._ids:
+            return self._vertices[self._ids[value]]
+        vertex = Vertex(value, graph=self, id=len(self._vertices))
+        self._ids[value] = vertex.id
+        self._vertices.append(vertex)
+        self._csr.clear()
+        return vertex
+
+    def _get_id(self, vertex_or_value: Union[Vertex, Hashable]) -> int:
+        if isinstance(vertex_or_value, Vertex):
+            return vertex_or_value.id
+        return self._ids[vertex_or_value]
 
-    def remove_edge(self, vertex_from: Vertex, vertex_to: Vertex):
-        self._edges_from[vertex_from].remove(vertex_to)
-        self._edges_to[vertex_to].remove(vertex_from)
+    def add_edge(self, vertex_from: Union[Vertex, Hashable], vertex_to: Union[Vertex, Hashable]):
+        self._edges_from.append(self._get_id(vertex_from))
+        self._edges_to.append(self._get_id(vertex_to))
+        self._csr.clear()
+
+    def remove_edge(self, vertex_from: Union[Vertex, Hashable], vertex_to: Union[Vertex, Hashable]):
+        """
+        Removes the edge. This takes O(E) time.
+        """
+        edge = (self._get_id(vertex_from), self._get_id(vertex_to))
+        edges = [e for e in zip(self._edges_from, self._edges_to) if e != edge]
+        if len(edges) == len(self._edges_from):
+            raise KeyError(edge)
+        self._edges_from = array.array("q", (e[0] for e in edges))
+        self._edges_to = array.array("q", (e[1] for e in edges))
+        self._csr.clear()
+
+    def _get_csr(self, dependants: bool) -> Tuple[array.array, array.array]:
+        """
+        Returns (offsets, targets) such that targets[offsets[i]:offsets[i + 1]] are the ids
+        of the dependencies (or dependants) of vertex i. Duplicate edges are kept.
+        """
+        if dependants not in self._csr:
+            sources, targets = self._edges_from, self._edges_to
+            if dependants:
+                sources, targets = targets, sources
+
+            n = len(self._vertices)
+            offsets = array.array("q", bytes(8 * (n + 1)))
+            for i in sources:
+                offsets[i + 1] += 1
+            for i in range(n):
+                offsets[i + 1] += offsets[i]
+
+            positions = array.array("q", offsets)
+            adjacent = array.array("q", bytes(8 * len(sources)))
+            for source, target in zip(sources, targets):
+                adjacent[positions[source]] = target
+                positions[source] += 1
+
+            self._csr[dependants] = (offsets, adjacent)
+        return self._csr[dependants]
+
+    def _adjacent(self, i: int, dependants: bool) -> array.array:
+        offsets, adjacent = self._get_csr(dependants)
+        return adjacent[offsets[i]:offsets[i + 1]]
 
     def __iter__(self) -> Iterable[Vertex]:
-        return iter(self._vertices.values())
+        return iter(self._vertices)
+
+    def __len__(self):
+        return len(self._vertices)
 
-    def __getitem__(self, value):
-        return self._vertices[hash(value)]
+    def __getitem__(self, value) -> Vertex:
+        return self._vertices[self._ids[value]]
 
     def __contains__(self, value):
-        return hash(value) in self._vertices
+        return value in self._ids
 
     def __repr__(self):
-        return f"<{self.__class__.__name__} {set(self._vertices.values())}>"
+        return f"<{self.__class__.__name__} {self._vertices}>"
 
     def clone(self) -> "Graph":
         g = Graph()
-
-        for v in self._vertices.values():
+        for v in self._vertices:
             g.new_vertex(v.value)
-
-        for vertex_from, vertices_to in self._edges_from.items():
-            for vertex_to in vertices_to:
-                g.add_edge(g[vertex_from.value], g[vertex_to.value])
-
+        g._edges_from = array.array("q", self._edges_from)
+        g._edges_to = array.array("q", self._edges_to)
         return g
 
     def has_edges(self):
-        return sum(len(vertices_to) for _, vertices_to in self._edges_from.items()) > 0
+        return len(self._edges_from) > 0
 
     @classmethod
     def from_edge_list(cls, *edge_list):
         g = cls()
         for (vertex_from, vertex_to) in edge_list:
-            if vertex_from not in g:
-                g.new_vertex(vertex_from)
-            if vertex_to not in g:
-                g.new_vertex(vertex_to)
-            g.add_edge(g[vertex_from], g[vertex_to])
+            g.add_edge(g.new_vertex(vertex_from), g.new_vertex(vertex_to))
         return g
 
-    def topological_sort_by_kahn(self):
-        # https://en.wikipedia.org/wiki/Topological_sorting
-        G: Graph = self.clone()
-        L = []
-        S = set(v for v in G if not v.dependencies)
-
-        if not S:
-            raise ValueError("Graph has no vertex with no incoming edges")
+    def topological_sort_by_kahn(self) -> List[Vertex]:
+        """
+        Returns vertices ordered so that every vertex comes after its dependencies.
 
-        while S:
-            n = S.pop()
-            L.append(n)
-
-            for m in set(n.dependants):
-                G.remove_edge(m, n)
-                if not m.dependencies:
-                    S.add(m)
-
-        if G.has_edges():
-            raise ValueError("Graph has at least one cycle")
-
-        # Return the vertices of the original graph, not the clone
-        return [self[v.value] for v in L]
+        Runs in O(V + E). Vertices which become ready at the same time keep the order
+        in which they were added to the graph, so the result is the same on every run.
+        Raises GraphCycleError if the graph has cycles.
+        """
+        # https://en.wikipedia.org/wiki/Topological_sorting
+        dependency_offsets, _ = self._get_csr(dependants=False)
+        dependant_offsets, dependants = self._get_csr(dependants=True)
+
+        n = len(self._vertices)
+        pending = array.array("q", (dependency_offsets[i + 1] - dependency_offsets[i] for i in range(n)))
+        queue = collections.deque(i for i in range(n) if not pending[i])
+        order = []
+
+        while queue:
+            i = queue.popleft()
+            order.append(i)
+            for j in dependants[dependant_offsets[i]:dependant_offsets[i + 1]]:
+                pending[j] -= 1
+                if not pending[j]:
+                    queue.append(j)
+
+        if len(order) < n:
+            raise GraphCycleError(self._find_cycles([i for i in range(n) if pending[i]]))
+
+        return [self._vertices[i] for i in order]
+
+    def _find_cycles(self, candidates: List[int]) -> List[List[Any]]:
+        """
+        Returns a cycle path through each strongly connected component (with a cycle)
+        of the subgraph of the candidate vertices.
+        """
+        offsets, adjacent = self._get_csr(dependants=False)
+        in_subgraph = set(candidates)
+
+        # Tarjan's strongly connected components algorithm, iterative to handle deep graphs
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        for root in candidates:
+            if root in index:
+                continue
+            work = [(root, offsets[root])]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                v, pos = work[-1]
+                if pos < offsets[v + 1]:
+                    work[-1] = (v, pos + 1)
+                    w = adjacent[pos]
+                    if w not in in_subgraph:
+                        continue
+                    if w not in index:
+                        index[w] = lowlink[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        work.append((w, offsets[w]))
+                    elif w in on_stack:
+                        lowlink[v] = min(lowlink[v], index[w])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[v])
+                if lowlink[v] == index[v]:
+                    component = set()
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.add(w)
+                        if w == v:
+                            break
+                    components.append(component)
+
+        cycles = []
+        for component in sorted(components, key=min):
+            start = min(component)
+            path = self._find_path(start, start, component)
+            if path:
+                cycles.append([self._vertices[i].value for i in path])
+        return cycles
+
+    def _find_path(self, start: int, end: int, within: set) -> List[int]:
+        """
+        Returns a path of ids from start to end (of at least one edge) through the vertices in `within`,
+        following the edges from vertices to their dependencies, or an empty list if there is no path.
+        """
+        offsets, adjacent = self._get_csr(dependants=False)
+        previous = {}
+        queue = collections.deque([start])
+        while queue:
+            v = queue.popleft()
+            for w in adjacent[offsets[v]:offsets[v + 1]]:
+                if w not in within or w in previous:
+                    continue
+                previous[w] = v
+                if w == end:
+                    path = [end]
+                    while True:
+                        path.append(previous[path[-1]])
+                        if path[-1] == start:
+                            return path[::-1]
+                queue.append(w)
+        return []
 
 
 def graph_definition_example1():
@@ -135,11 +292,11 @@ def graph_definition_example2():
 def topological_sort_example():
     g1 = graph_definition_example1()
     print(g1)
-    print(topological_sort_by_kahn(g1))
+    print(g1.topological_sort_by_kahn())
 
     g2 = graph_definition_example2()
     print(g2)
-    print(topological_sort_by_kahn(g2))
+    print(g2.topological_sort_by_kahn())
 
 
 if __name__ == "__main__":
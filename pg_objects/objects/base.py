@@ -1,9 +1,19 @@
 import abc
-from typing import Set, Generator, Optional, Union, Collection, Type, Hashable, Dict
+import collections
+import contextlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Set, Generator, Optional, Union, Collection, Type, Hashable, Dict, Callable, Tuple, Any, List
 
 from ..graph import Graph
-from ..statements import Statement
+from ..statements import Statement, TextStatement
 from ..connection import Connection
+from ..privileges import BITS_BY_KEYWORD, diff_privileges, mask_to_keywords
+
+
+log = logging.getLogger(__name__)
 
 
 class SetupAbc(abc.ABC):
@@ -12,6 +22,11 @@ class SetupAbc(abc.ABC):
     master_database: str
     connection_manager: "ConnectionManager"
 
+    # Options for statements on tables, see SchemaTablesPrivilege
+    table_chunk_size: Optional[int] = None
+    lock_timeout: Union[str, int, None] = None
+    lock_retries: int = 0
+
     @abc.abstractmethod
     def register(self, obj: "Object"):
         raise NotImplementedError()
@@ -35,23 +50,159 @@ class SetupAbc(abc.ABC):
     def get_current_state(self, obj: "Object") -> "ObjectState":
         raise NotImplementedError()
 
+    def get_schema_tables(self, database: str, schema: str) -> List[str]:
+        raise NotImplementedError()
+
+    def get_current_privileges(self, obj: "Object") -> Optional[int]:
+        raise NotImplementedError()
+
+    def get_drifted_tables(self, obj: "Object") -> Optional[Dict[str, int]]:
+        raise NotImplementedError()
+
 
 class ConnectionManager:
-    def __init__(self, master_connection: Connection):
+    """
+    Hands out connections to individual databases, cloned from the master connection.
+
+    Connections are pooled: at most max_connections per-database connections are kept open
+    (master connection is not counted) and when the limit is reached the least recently used one
+    is closed. Connections that have not been used for idle_timeout seconds are closed too.
+    A connection acquired through using() is not evicted until the with-block exits.
+    A connection returned by get_connection() is not pinned, so when other threads use the pool too
+    it may be evicted (and closed) while it is still being used; acquire it through using() instead.
+    """
+
+    def __init__(self, master_connection: Connection, max_connections: int = None, idle_timeout: float = None):
         self.master_connection = master_connection
-        self._managed_connections: Dict[str, Connection] = {}
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        # Ordered from least recently used to most recently used
+        self._managed_connections: Dict[str, Connection] = collections.OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._in_use: Dict[str, int] = collections.Counter()
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def get_connection(self, database: str) -> Connection:
         if database is None or database == self.master_connection.database:
             return self.master_connection
-        if database not in self._managed_connections:
-            self._managed_connections[database] = self.master_connection.clone(database=database)
-        return self._managed_connections[database]
+        with self._lock:
+            self._close_idle_connections()
+            if database in self._managed_connections:
+                self.hits += 1
+                self._managed_connections.move_to_end(database)
+            else:
+                self.misses += 1
+                self._evict_connections(room_for=1)
+                self._managed_connections[database] = self.master_connection.clone(database=database)
+            self._last_used[database] = time.monotonic()
+            return self._managed_connections[database]
+
+    @contextlib.contextmanager
+    def using(self, database: str) -> Generator[Connection, None, None]:
+        """
+        Context manager which returns a connection to the database and makes sure
+        it is not evicted by other threads while it is being used.
+        """
+        with self._lock:
+            connection = self.get_connection(database)
+            self._in_use[database] += 1
+        try:
+            yield connection
+        finally:
+            with self._lock:
+                self._in_use[database] -= 1
+                if not self._in_use[database]:
+                    del self._in_use[database]
+                if database in self._managed_connections:
+                    # Keep the order by last use which _close_idle_connections() relies on
+                    self._managed_connections.move_to_end(database)
+                    self._last_used[database] = time.monotonic()
+
+    def close_connection(self, database: str):
+        """
+        Close the pooled connection to the database, if there is one.
+        """
+        with self._lock:
+            if database in self._managed_connections:
+                self._managed_connections.pop(database).close()
+                self._last_used.pop(database, None)
+
+    def close_all(self):
+        with self._lock:
+            for database in list(self._managed_connections):
+                self.close_connection(database)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "open": len(self._managed_connections),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self, database: str):
+        log.debug(f"Closing pooled connection to {database!r}")
+        self.close_connection(database)
+        self.evictions += 1
+
+    def _evict_connections(self, room_for: int = 0):
+        if not self.max_connections:
+            return
+        for database in list(self._managed_connections):
+            if len(self._managed_connections) + room_for <= self.max_connections:
+                return
+            if database not in self._in_use:
+                self._evict(database)
+        if len(self._managed_connections) + room_for > self.max_connections:
+            log.warning(
+                f"All {len(self._managed_connections)} pooled connections are in use, "
+                f"exceeding max_connections={self.max_connections}"
+            )
+
+    def _close_idle_connections(self):
+        if not self.idle_timeout:
+            return
+        now = time.monotonic()
+        for database in list(self._managed_connections):
+            if now - self._last_used[database] < self.idle_timeout:
+                # The rest were used even more recently
+                return
+            if database not in self._in_use:
+                self._evict(database)
 
 
 class StateProviderAbc(abc.ABC):
     connection_manager: ConnectionManager
 
+    # Provided by DatabaseStateProvider
+    databases: Dict
+
+    # Maximum number of databases queried at the same time by per-database loaders
+    concurrency: int = 1
+
+    # If set, per-database loaders only query these databases
+    managed_databases: Optional[Set[str]] = None
+
+    # Names of object types (see State.get()) whose state each load_* method provides.
+    # Loaders which are not listed are always run by State.load_all().
+    object_types_by_loader: Dict[str, Tuple[str, ...]] = {}
+
+    # Attributes in which each load_* method stores the state it loads, see State.to_snapshot().
+    state_attributes_by_loader: Dict[str, Tuple[str, ...]] = {}
+
+    # Loaders which query each database separately and key the state they store by database name.
+    # They can be run for some databases only, see reload_databases.
+    per_database_loaders: Tuple[str, ...] = ()
+
+    # If set, per-database loaders only query these databases
+    reload_databases: Optional[Set[str]] = None
+
     @property
     def master_connection(self) -> Connection:
         return self.connection_manager.master_connection
@@ -63,6 +214,40 @@ class StateProviderAbc(abc.ABC):
     def get_connection(self, database: str) -> Connection:
         return self.connection_manager.get_connection(database=database)
 
+    def _map_databases(
+        self, func: Callable[[Connection], Any], only: Collection[str] = None,
+    ) -> Generator[Tuple[str, Any], None, None]:
+        """
+        Calls func with a connection to each database and yields (database, result) pairs
+        in the order of databases. Pass `only` to further restrict the databases.
+
+        Up to `concurrency` databases are queried at the same time, so func should only fetch
+        the rows (not lazily!) and leave merging of the results to the caller,
+        which does it in the calling thread.
+        """
+        databases = [
+            datname for datname in self.databases
+            if (self.managed_databases is None or datname in self.managed_databases)
+            and (only is None or datname in only)
+            and (self.reload_databases is None or datname in self.reload_databases)
+        ]
+
+        def call(datname):
+            with self.connection_manager.using(datname) as conn:
+                return func(conn)
+
+        workers = self.concurrency or 1
+        if self.connection_manager.max_connections:
+            workers = min(workers, self.connection_manager.max_connections)
+
+        if workers <= 1 or len(databases) <= 1:
+            for datname in databases:
+                yield datname, call(datname)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pg_objects_state") as executor:
+            yield from zip(databases, executor.map(call, databases))
+
 
 class ObjectState(str):
     # The object currently exists
@@ -102,6 +287,8 @@ ObjectState.IS_UNKNOWN = ObjectState("IS_UNKNOWN")
 
 
 class Object:
+    __slots__ = ("name", "present", "setup", "dependencies", "_key")
+
     name: str
     present: bool
     setup: SetupAbc
@@ -121,6 +308,17 @@ class Object:
 
     @property
     def key(self) -> str:
+        """
+        Identifies the object. It is computed by _make_key() on first access and cached,
+        so the attributes it is made of must not change after that.
+        """
+        try:
+            return self._key
+        except AttributeError:
+            self._key = self._make_key()
+            return self._key
+
+    def _make_key(self) -> str:
         return f"{self.__class__.__name__}({self.name})"
 
     def __hash__(self):
@@ -184,46 +382,76 @@ class Object:
 
         You should use these only when the statements don't belong to creation, and
         it's not easy to detect the current state and express this state as a separate object.
+
+        These statements are skipped if the state provider can tell that they would not change anything,
+        see State.is_maintained().
         """
         if False:
             yield
 
 
 class ObjectLink(Object):
+    __slots__ = ()
+
     def __init__(self, present: bool = True, setup: SetupAbc = None):
         self.present = present
         self.setup = setup
         self.dependencies = set()
 
-    @property
-    def key(self):
+    def _make_key(self):
         raise NotImplementedError()
 
 
-def parse_privileges(privileges: Optional[Union[str, Collection[str]]], obj_type: Type[Object]):
+def parse_privileges(privileges: Optional[Union[str, int, Collection[str]]], obj_type: Type[Object]) -> int:
+    """
+    Returns the bitmask (see pg_objects.privileges) of the passed privilege keywords.
+    """
     if not privileges:
-        return set()
+        return 0
+    if isinstance(privileges, int):
+        if privileges & ~obj_type.ALL:
+            raise ValueError(f"Unsupported privileges {mask_to_keywords(privileges & ~obj_type.ALL)} for {obj_type}")
+        return privileges
     if isinstance(privileges, str):
         privileges = {privileges}
-    else:
-        privileges = set(privileges)
 
-    parsed = []
+    parsed = 0
 
     for p in privileges:
         p = p.upper()
 
         if p == "ALL":
-            parsed.extend(obj_type.ALL)
+            parsed |= obj_type.ALL
             continue
 
-        # Known aliases
-        if p == "TEMP":
-            p = "TEMPORARY"
+        # Known aliases are included in BITS_BY_KEYWORD
+        bit = BITS_BY_KEYWORD.get(p, 0)
 
-        if p not in obj_type.ALL:
+        if not bit & obj_type.ALL:
             raise ValueError(f"Unsupported privilege {p!r} for {obj_type}")
 
-        parsed.append(p)
-
-    return set(parsed)
+        parsed |= bit
+
+    return parsed
+
+
+def stmts_to_change_privileges(
+    current: int, desired: int, on: str, grantee: str, database: str = None,
+) -> List[Statement]:
+    """
+    Returns statements that revoke the privileges the grantee has on `on` (e.g. "SCHEMA sch")
+    but should not have, and grant the ones it should have but does not have.
+    """
+    to_grant, to_revoke = diff_privileges(current, desired)
+    stmts = []
+    if to_revoke:
+        stmts.append(TextStatement(
+            f"REVOKE {', '.join(mask_to_keywords(to_revoke))} ON {on} FROM {grantee}",
+            database=database,
+        ))
+    if to_grant:
+        stmts.append(TextStatement(
+            f"GRANT {', '.join(mask_to_keywords(to_grant))} ON {on} TO {grantee}",
+            database=database,
+        ))
+    return stmts
@@ -1,13 +1,18 @@
 import collections
-from typing import Dict, Set, Union, Collection
+from typing import Dict, Union, Collection
 
 from ..statements import CreateStatement, DropStatement, TextStatement, TransactionOfStatements
 from ..acl_utils import parse_datacl
+from ..privileges import ACL_CONNECT, ACL_CREATE, ACL_TEMPORARY, acl_to_mask, mask_to_keywords
 from ..graph import Graph
-from .base import Object, ObjectLink, parse_privileges, SetupAbc, ObjectState, StateProviderAbc
+from .base import (
+    Object, ObjectLink, parse_privileges, SetupAbc, ObjectState, StateProviderAbc, stmts_to_change_privileges,
+)
 
 
 class Database(Object):
+    __slots__ = ("owner",)
+
     owner: str
 
     def __init__(self, name, owner: str = None, present: bool = True, setup: SetupAbc = None):
@@ -32,10 +37,9 @@ class Database(Object):
 
     def stmts_to_maintain(self):
         # We don't allow public access to managed databases.
-        # TODO At the moment there is no cleaner way to do this
-        # TODO because we are not loading current privileges of public group
-        # TODO as it does not appear in pg_roles.
-        # TODO Also, a new database wouldn't have existed at the time when
+        # This is only executed if public group is found to have privileges on the database
+        # or if the database did not exist when the server state was loaded.
+        # TODO A new database wouldn't have existed at the time when
         # TODO we load server state so we wouldn't have detected state change
         # TODO if we requested an implicit DatabasePrivilege to be absent.
 
@@ -50,6 +54,8 @@ class Database(Object):
 
 
 class DatabaseOwner(ObjectLink):
+    __slots__ = ("database", "owner")
+
     database: str
     owner: str
 
@@ -60,8 +66,7 @@ class DatabaseOwner(ObjectLink):
         self.dependencies.add(Database(self.database))
         self.dependencies.add(setup.resolve_role(self.owner))
 
-    @property
-    def key(self):
+    def _make_key(self):
         return f"{self.__class__.__name__}({self.database}+{self.owner})"
 
     def stmts_to_create(self):
@@ -69,14 +74,16 @@ class DatabaseOwner(ObjectLink):
 
 
 class DatabasePrivilege(Object):
+    __slots__ = ("database", "grantee", "privileges")
+
     database: str
     grantee: str
-    privileges: Set[str]
+    privileges: int
 
-    CONNECT = "CONNECT"
-    CREATE = "CREATE"
-    TEMPORARY = "TEMPORARY"
-    ALL = {CONNECT, CREATE, TEMPORARY}
+    CONNECT = ACL_CONNECT
+    CREATE = ACL_CREATE
+    TEMPORARY = ACL_TEMPORARY
+    ALL = CONNECT | CREATE | TEMPORARY
 
     def __init__(
         self,
@@ -90,9 +97,11 @@ class DatabasePrivilege(Object):
         self.dependencies.add(Database(self.database))
         self.dependencies.add(self.resolve_role(self.grantee))
 
-    @property
-    def key(self):
-        return f"{self.__class__.__name__}({self.grantee}@{self.database}:{','.join(sorted(self.privileges))})"
+    def _make_key(self):
+        return (
+            f"{self.__class__.__name__}({self.grantee}@{self.database}:"
+            f"{','.join(sorted(mask_to_keywords(self.privileges)))})"
+        )
 
     def stmts_to_create(self):
 
@@ -104,16 +113,30 @@ class DatabasePrivilege(Object):
                     FROM {self.grantee}
                 """)
             yield TextStatement(f"""
-                GRANT {', '.join(self.privileges)}
+                GRANT {', '.join(mask_to_keywords(self.privileges))}
                 ON DATABASE {self.database}
                 TO {self.grantee}
             """)
 
         yield TransactionOfStatements(*get_stmts())
 
+    def stmts_to_update(self):
+        """
+        Grants only the missing privileges and revokes only the extra ones.
+        """
+        current = self.setup.get_current_privileges(self) if self.setup is not None else None
+        if current is None:
+            yield from self.stmts_to_create()
+            return
+        stmts = stmts_to_change_privileges(
+            current, self.privileges, on=f"DATABASE {self.database}", grantee=self.grantee,
+        )
+        if stmts:
+            yield TransactionOfStatements(*stmts)
+
     def stmts_to_drop(self):
         yield TextStatement(f"""
-            REVOKE {', '.join(self.privileges)}
+            REVOKE {', '.join(mask_to_keywords(self.privileges))}
             ON DATABASE {self.database}
             FROM {self.grantee}
         """)
@@ -122,6 +145,14 @@ class DatabasePrivilege(Object):
 class DatabaseStateProvider(StateProviderAbc):
     _dsp_databases = None
 
+    object_types_by_loader = {
+        "load_databases": ("Database", "DatabaseOwner"),
+    }
+
+    state_attributes_by_loader = {
+        "load_databases": ("_dsp_databases",),
+    }
+
     @property
     def databases(self):
         if self._dsp_databases is None:
@@ -158,17 +189,20 @@ class DatabaseStateProvider(StateProviderAbc):
 
 class DatabasePrivilegeStateProvider(StateProviderAbc):
 
-    _dpsp_db_privs: Dict = None
-    _dpsp_db_privs_lookup = {
-        "c": "CONNECT",
-        "C": "CREATE",
-        "T": "TEMPORARY",
+    object_types_by_loader = {
+        "load_database_privileges": ("DatabasePrivilege", "Database"),
+    }
+
+    state_attributes_by_loader = {
+        "load_database_privileges": ("_dpsp_db_privs",),
     }
 
+    _dpsp_db_privs: Dict = None
+
     @property
     def database_privileges(self):
         """
-        [datname][grantee] => Set[privilege]
+        [datname][grantee] => privileges bitmask
         """
         if self._dpsp_db_privs is None:
             self.load_database_privileges()
@@ -180,11 +214,23 @@ class DatabasePrivilegeStateProvider(StateProviderAbc):
                 return True
         return False
 
-    def _get_database_privileges(self, database, grantee) -> Set[str]:
+    def _get_database_privileges(self, database, grantee) -> int:
         if database in self._dpsp_db_privs:
             if grantee in self._dpsp_db_privs[database]:
                 return self._dpsp_db_privs[database][grantee]
-        return set()
+        return 0
+
+    def is_database_maintained(self, obj: Database) -> bool:
+        """
+        Returns True if public group has no privileges on the database, see Database.stmts_to_maintain().
+        """
+        return obj.name in self.database_privileges and not self._get_database_privileges(obj.name, "public")
+
+    def get_current_databaseprivilege(self, obj: DatabasePrivilege) -> int:
+        """
+        Returns the privileges bitmask the grantee currently has on the database.
+        """
+        return self._get_database_privileges(database=obj.database, grantee=obj.grantee)
 
     def get_databaseprivilege(self, obj: DatabasePrivilege) -> ObjectState:
         privileges = self._get_database_privileges(database=obj.database, grantee=obj.grantee)
@@ -194,14 +240,13 @@ class DatabasePrivilegeStateProvider(StateProviderAbc):
 
     def load_database_privileges(self):
         self._dpsp_db_privs = collections.defaultdict(
-            lambda: collections.defaultdict(set)
+            lambda: collections.defaultdict(int)
         )
 
+        # Databases with no ACL have the default privileges which include CONNECT and TEMPORARY for public.
         for row in self.master_connection.execute(f"""
-            SELECT datname, datacl FROM pg_database
+            SELECT datname, COALESCE(datacl, acldefault('d', datdba)) AS datacl FROM pg_database
             WHERE datname NOT LIKE 'template%%'
         """).get_all("datname", "datacl"):
             for (grantee, privs, grantor) in parse_datacl(row["datacl"]):
-                self._dpsp_db_privs[row["datname"]][grantee].update(
-                    self._dpsp_db_privs_lookup[p] for p in privs
-                )
+                self._dpsp_db_privs[row["datname"]][grantee] |= acl_to_mask(privs)
@@ -1,7 +1,10 @@
-from typing import Set, ClassVar, Dict, Union
+import collections
+from typing import ClassVar, Dict, Union
 
+from ..acl_utils import parse_acl
+from ..privileges import acl_to_mask
 from ..statements import TextStatement, TransactionOfStatements
-from .base import Object, SetupAbc
+from .base import Object, SetupAbc, StateProviderAbc, ObjectState
 
 
 class DefaultPrivilegeReady(Object):
@@ -9,12 +12,18 @@ class DefaultPrivilegeReady(Object):
     Base class for privilege classes which support default privileges.
     """
 
+    # Empty so that subclasses can also inherit from another Object subclass with slots
+    __slots__ = ()
+
     database: str
     schema: str
     grantee: str
-    privileges: Set[str]
+    privileges: int
+
+    ALL: ClassVar[int]
 
-    ALL: ClassVar[Set[str]]
+    # Value of pg_default_acl.defaclobjtype for the objects to which the privilege applies
+    DEFAULT_ACL_OBJECT_TYPE: ClassVar[str]
 
     def get_default_privilege_clause(self, privileges=None, present=None) -> str:
         """
@@ -34,6 +43,8 @@ class DefaultPrivilege(Object):
     DefaultPrivilege objects are expressed as a tuple of a privilege that supports default privileges
     and a grantor. Grantor is the role which will be creating new objects to which the privilege applies.
     """
+    __slots__ = ("privilege", "grantor")
+
     privilege: DefaultPrivilegeReady
     grantor: str
 
@@ -51,8 +62,7 @@ class DefaultPrivilege(Object):
         self.dependencies.add(self.privilege)
         self.dependencies.add(self.resolve_role(self.grantor))
 
-    @property
-    def key(self):
+    def _make_key(self):
         return f"{self.__class__.__name__}({self.grantor}:{self.privilege.key})"
 
     def _get_schema_sql(self):
@@ -72,7 +82,7 @@ class DefaultPrivilege(Object):
             database=self.privilege.database,
         )
 
-    def stmts_to_maintain(self):
+    def stmts_to_create(self):
 
         def get_stmts():
             # First, revoke all default privileges so that we have a clean slate
@@ -90,3 +100,85 @@ class DefaultPrivilege(Object):
 
     def stmts_to_drop(self):
         yield self._get_revoke_all_stmt()
+
+
+class DefaultPrivilegeStateProvider(StateProviderAbc):
+
+    # Provided by RoleStateProvider
+    groups: Dict
+    users: Dict
+
+    # Provided by SchemaStateProvider
+    schemas: Dict
+
+    _defpsp_default_privileges: Dict = None
+
+    object_types_by_loader = {
+        "load_default_privileges": ("DefaultPrivilege",),
+    }
+
+    state_attributes_by_loader = {
+        "load_default_privileges": ("_defpsp_default_privileges",),
+    }
+
+    per_database_loaders = ("load_default_privileges",)
+
+    @property
+    def default_privileges(self):
+        """
+        [database][(grantor, schema, object_type)][grantee] => privileges bitmask
+
+        object_type is pg_default_acl.defaclobjtype, for example "r" for tables.
+        schema is None for default privileges which apply to all schemas.
+        """
+        if self._defpsp_default_privileges is None:
+            self.load_default_privileges()
+        return self._defpsp_default_privileges
+
+    def get_defaultprivilege(self, obj: DefaultPrivilege) -> ObjectState:
+        priv = obj.privilege
+        if obj.grantor not in self.groups and obj.grantor not in self.users:
+            return ObjectState.IS_ABSENT
+        if priv.database not in self.schemas:
+            return ObjectState.IS_ABSENT
+        if priv.schema not in self.schemas[priv.database]:
+            return ObjectState.IS_ABSENT
+
+        default_acls = self.default_privileges.get(priv.database, {})
+        current = default_acls.get((obj.grantor, priv.schema, priv.DEFAULT_ACL_OBJECT_TYPE), {}).get(priv.grantee, 0)
+
+        if not obj.present:
+            return ObjectState.IS_PRESENT if current else ObjectState.IS_ABSENT
+
+        desired = priv.privileges if priv.present else 0
+        if current == desired:
+            # This also covers the case when privileges are requested to be revoked and there are none.
+            return ObjectState.IS_PRESENT
+        elif not current:
+            return ObjectState.IS_ABSENT
+        else:
+            return ObjectState.IS_DIFFERENT
+
+    def load_default_privileges(self):
+        self._defpsp_default_privileges = collections.defaultdict(
+            lambda: collections.defaultdict(
+                lambda: collections.defaultdict(int)
+            )
+        )
+
+        def fetch(conn):
+            return list(conn.execute(f"""
+                SELECT
+                    pg_get_userbyid(d.defaclrole) AS grantor,
+                    n.nspname AS schema,
+                    d.defaclobjtype AS object_type,
+                    d.defaclacl AS acl
+                FROM pg_default_acl d
+                LEFT JOIN pg_namespace n ON n.oid = d.defaclnamespace
+            """).get_all("grantor", "schema", "object_type", "acl"))
+
+        for datname, raw_rows in self._map_databases(fetch):
+            for raw in raw_rows:
+                default_acl = self._defpsp_default_privileges[datname][(raw["grantor"], raw["schema"], raw["object_type"])]
+                for (grantee, privs, grantor) in parse_acl(raw["acl"]):
+                    default_acl[grantee] |= acl_to_mask(privs)
@@ -1,17 +1,27 @@
 import collections
-from typing import List, Generator
+import logging
+from typing import Dict, List, Generator, Optional
 
 from ..graph import Graph
 from ..statements import CreateStatement, DropStatement, Statement, TextStatement
-from ..utils import get_password_md5
+from ..utils import get_password_digest, get_password_md5
 from .base import Object, ObjectLink, SetupAbc, StateProviderAbc, ObjectState
 
 
+log = logging.getLogger(__name__)
+
+# Recorded instead of the password hash when it cannot be read from pg_authid.
+# A string rather than a sentinel object so that it survives state snapshots.
+UNKNOWN_PASSWORD = "UNKNOWN"
+
+
 class Role(Object):
     """
     Do not use directly, instead use Group or User.
     """
 
+    __slots__ = ()
+
     FORBIDDEN_ROLES = {"public", "postgres"}
 
     def _is_managed(self):
@@ -50,10 +60,12 @@ class Role(Object):
 
 
 class Group(Role):
-    pass
+    __slots__ = ()
 
 
 class User(Role):
+    __slots__ = ("password", "groups", "inherit")
+
     groups: List[str]
     password: str
     inherit: bool
@@ -87,19 +99,24 @@ class User(Role):
             {self.get_password_sql()}
         """)
 
+    def get_password_hash(self) -> Optional[str]:
+        if not self.password:
+            return None
+        if self.password.startswith("md5"):
+            return self.password
+        return get_password_md5(username=self.name, password=self.password)
+
     def get_password_sql(self):
         # If password is not set, the password is not updated and is not disabled either.
         password_sql = "LOGIN"
         if self.password:
-            if self.password.startswith("md5"):
-                password_hash = self.password
-            else:
-                password_hash = get_password_md5(username=self.name, password=self.password)
-            password_sql = f"LOGIN PASSWORD '{password_hash}'"
+            password_sql = f"LOGIN PASSWORD '{self.get_password_hash()}'"
         return password_sql
 
 
 class GroupUser(ObjectLink):
+    __slots__ = ("group", "user")
+
     group: str
     user: str
 
@@ -110,8 +127,7 @@ class GroupUser(ObjectLink):
         self.dependencies.add(Group(self.group))
         self.dependencies.add(User(self.user))
 
-    @property
-    def key(self):
+    def _make_key(self):
         return f"{self.__class__.__name__}({self.group}+{self.user})"
 
     def stmts_to_create(self):
@@ -126,6 +142,17 @@ class RoleStateProvider(StateProviderAbc):
     _rsp_users = None
     _rsp_group_users = None
     _rsp_user_groups = None
+    _rsp_role_attributes: Dict = None
+
+    object_types_by_loader = {
+        "load_groups_and_users": ("User", "Group", "GroupUser", "DefaultPrivilege"),
+        "load_role_attributes": ("User",),
+    }
+
+    state_attributes_by_loader = {
+        "load_groups_and_users": ("_rsp_groups", "_rsp_users", "_rsp_group_users", "_rsp_user_groups"),
+        "load_role_attributes": ("_rsp_role_attributes",),
+    }
 
     @property
     def groups(self):
@@ -151,6 +178,32 @@ class RoleStateProvider(StateProviderAbc):
             self.load_groups_and_users()
         return self._rsp_user_groups
 
+    @property
+    def role_attributes(self):
+        """
+        [rolname] => {"inherit": bool, "createdb": bool, "login": bool, "password": Optional[str]}
+
+        "password" is the digest of the password hash (see get_password_digest()), UNKNOWN_PASSWORD or None.
+        """
+        if self._rsp_role_attributes is None:
+            self.load_role_attributes()
+        return self._rsp_role_attributes
+
+    def is_user_maintained(self, obj: User) -> bool:
+        """
+        Returns True if the attributes which User.stmts_to_maintain() sets already have the requested values.
+        Passwords are only compared if they could be read, see load_role_attributes().
+        """
+        attributes = self.role_attributes.get(obj.name)
+        if attributes is None:
+            return False
+        if attributes["inherit"] != obj.inherit or attributes["createdb"] or not attributes["login"]:
+            return False
+        if obj.password and attributes["password"] != UNKNOWN_PASSWORD:
+            if attributes["password"] != get_password_digest(obj.get_password_hash()):
+                return False
+        return True
+
     def get_user(self, obj: User) -> ObjectState:
         return ObjectState.IS_PRESENT if obj.name in self._rsp_users else ObjectState.IS_ABSENT
 
@@ -158,7 +211,9 @@ class RoleStateProvider(StateProviderAbc):
         return ObjectState.IS_PRESENT if obj.name in self._rsp_groups else ObjectState.IS_ABSENT
 
     def get_groupuser(self, obj: GroupUser) -> ObjectState:
-        return ObjectState.IS_PRESENT if obj.user in self._rsp_group_users[obj.group] else ObjectState.IS_ABSENT
+        # Restored snapshots have plain dicts instead of defaultdicts
+        group_users = self._rsp_group_users.get(obj.group, ())
+        return ObjectState.IS_PRESENT if obj.user in group_users else ObjectState.IS_ABSENT
 
     def load_groups_and_users(self):
         self._rsp_groups = {}
@@ -194,3 +249,32 @@ class RoleStateProvider(StateProviderAbc):
             if raw["rolname"]:
                 self._rsp_group_users[raw["groname"]].append(raw["rolname"])
                 self._rsp_user_groups[raw["rolname"]].append(raw["groname"])
+
+    def load_role_attributes(self):
+        self._rsp_role_attributes = {}
+
+        try:
+            raw_rows = list(self.mc.execute("""
+                SELECT rolname, rolinherit, rolcreatedb, rolcanlogin, rolpassword FROM pg_authid
+            """).get_all("rolname", "rolinherit", "rolcreatedb", "rolcanlogin", "rolpassword"))
+        except Exception as e:
+            if not isinstance(e, self.mc.programming_error_cls or ()):
+                raise
+            # Only superusers can read pg_authid. Without passwords we cannot tell
+            # whether they need to be updated, so they are not compared, see is_user_maintained().
+            log.warning(f"Cannot read passwords from pg_authid ({e}), falling back to pg_roles")
+            raw_rows = list(self.mc.execute("""
+                SELECT rolname, rolinherit, rolcreatedb, rolcanlogin, %s AS rolpassword FROM pg_roles
+            """, UNKNOWN_PASSWORD).get_all("rolname", "rolinherit", "rolcreatedb", "rolcanlogin", "rolpassword"))
+
+        for raw in raw_rows:
+            password = raw["rolpassword"]
+            if password and password != UNKNOWN_PASSWORD:
+                # Password hashes are not kept in the state as they can be used to log in
+                password = get_password_digest(password)
+            self._rsp_role_attributes[raw["rolname"]] = {
+                "inherit": raw["rolinherit"],
+                "createdb": raw["rolcreatedb"],
+                "login": raw["rolcanlogin"],
+                "password": password,
+            }
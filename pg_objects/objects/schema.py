@@ -1,14 +1,23 @@
 import collections
-from typing import Set, Union, Collection, Dict
+from typing import Set, Union, Collection, Dict, List, Optional, Tuple
 
 from ..graph import Graph
 from ..statements import CreateStatement, DropStatement, TextStatement, TransactionOfStatements
-from .base import Object, SetupAbc, ObjectLink, parse_privileges, StateProviderAbc, ObjectState
+from ..utils import quote_tables
+from ..privileges import (
+    ACL_CREATE, ACL_DELETE, ACL_INSERT, ACL_REFERENCES, ACL_SELECT, ACL_TRIGGER, ACL_TRUNCATE, ACL_UPDATE,
+    ACL_USAGE, keywords_to_mask, mask_to_keywords,
+)
+from .base import (
+    Object, SetupAbc, ObjectLink, parse_privileges, StateProviderAbc, ObjectState, stmts_to_change_privileges,
+)
 from .database import Database
 from .default_privilege import DefaultPrivilegeReady
 
 
 class Schema(Object):
+    __slots__ = ("database", "owner")
+
     database: str
     owner: str
 
@@ -20,8 +29,7 @@ class Schema(Object):
         if self.owner:
             self.dependencies.add(self.resolve_role(self.owner))
 
-    @property
-    def key(self):
+    def _make_key(self):
         return f"{self.__class__.__name__}({self.database}.{self.name})"
 
     def add_to_graph(self, graph: Graph):
@@ -40,6 +48,8 @@ class Schema(Object):
 
 
 class SchemaOwner(ObjectLink):
+    __slots__ = ("database", "schema", "owner")
+
     database: str
     schema: str
     owner: str
@@ -52,8 +62,7 @@ class SchemaOwner(ObjectLink):
         self.dependencies.add(Schema(database=self.database, name=self.schema))
         self.dependencies.add(self.resolve_role(self.owner))
 
-    @property
-    def key(self):
+    def _make_key(self):
         return f"{self.__class__.__name__}({self.database}.{self.schema}+{self.owner})"
 
     def stmts_to_create(self):
@@ -61,14 +70,16 @@ class SchemaOwner(ObjectLink):
 
 
 class SchemaPrivilege(Object):
+    __slots__ = ("database", "schema", "grantee", "privileges")
+
     database: str
     schema: str
     grantee: str
-    privileges: Set[str]
+    privileges: int
 
-    CREATE = "CREATE"
-    USAGE = "USAGE"
-    ALL = {CREATE, USAGE}
+    CREATE = ACL_CREATE
+    USAGE = ACL_USAGE
+    ALL = CREATE | USAGE
 
     def __init__(
         self,
@@ -84,11 +95,10 @@ class SchemaPrivilege(Object):
         self.dependencies.add(Schema(database=self.database, name=self.schema))
         self.dependencies.add(self.resolve_role(self.grantee))
 
-    @property
-    def key(self):
+    def _make_key(self):
         return (
             f"{self.__class__.__name__}({self.grantee}@{self.database}.{self.schema}:"
-            f"{','.join(sorted(self.privileges))})"
+            f"{','.join(sorted(mask_to_keywords(self.privileges)))})"
         )
 
     def stmts_to_create(self):
@@ -102,12 +112,26 @@ class SchemaPrivilege(Object):
                 )
 
             yield TextStatement(f"""
-                GRANT {', '.join(self.privileges)}
+                GRANT {', '.join(mask_to_keywords(self.privileges))}
                 ON SCHEMA {self.schema} TO {self.grantee}
             """, database=self.database)
 
         yield TransactionOfStatements(*get_stmts(), database=self.database)
 
+    def stmts_to_update(self):
+        """
+        Grants only the missing privileges and revokes only the extra ones.
+        """
+        current = self.setup.get_current_privileges(self) if self.setup is not None else None
+        if current is None:
+            yield from self.stmts_to_create()
+            return
+        stmts = stmts_to_change_privileges(
+            current, self.privileges, on=f"SCHEMA {self.schema}", grantee=self.grantee, database=self.database,
+        )
+        if stmts:
+            yield TransactionOfStatements(*stmts, database=self.database)
+
     def stmts_to_drop(self):
         yield TextStatement(
             query=f"REVOKE ALL ON SCHEMA {self.schema} FROM {self.grantee}",
@@ -122,24 +146,66 @@ class SchemaTablesPrivilege(DefaultPrivilegeReady, SchemaPrivilege):
 
     Schema "public" is accessible to anyone who has access to the database and we don't manage
     it yet.
+
+    GRANT ... ON ALL TABLES IN SCHEMA locks all tables of the schema in one transaction.
+    If the setup has table_chunk_size set, the privileges are granted on the current tables
+    of the schema instead, table_chunk_size tables per transaction, and if the setup has
+    lock_timeout set, each transaction gives up waiting for locks after that time and is retried.
+    Transactions on chunks of tables are never batched with other statements, see Executor.is_batchable().
+    If tables of a chunk are dropped before its transaction runs, the transaction is retried without them.
     """
 
-    SELECT = "SELECT"
-    INSERT = "INSERT"
-    UPDATE = "UPDATE"
-    DELETE = "DELETE"
-    TRUNCATE = "TRUNCATE"
-    REFERENCES = "REFERENCES"
-    TRIGGER = "TRIGGER"
-    ALL = {SELECT, INSERT, UPDATE, DELETE, TRUNCATE, REFERENCES, TRIGGER}
+    __slots__ = ()
+
+    SELECT = ACL_SELECT
+    INSERT = ACL_INSERT
+    UPDATE = ACL_UPDATE
+    DELETE = ACL_DELETE
+    TRUNCATE = ACL_TRUNCATE
+    REFERENCES = ACL_REFERENCES
+    TRIGGER = ACL_TRIGGER
+    ALL = SELECT | INSERT | UPDATE | DELETE | TRUNCATE | REFERENCES | TRIGGER
+
+    DEFAULT_ACL_OBJECT_TYPE = "r"
+
+    def _chunk_tables(self, tables: Collection[str]) -> List[List[Tuple[str, str]]]:
+        """
+        Returns the passed tables of the schema as (schema, table) pairs split into chunks
+        of up to table_chunk_size tables, or as a single chunk if that is not set.
+        """
+        tables = [(self.schema, table) for table in sorted(tables)]
+        size = self.setup.table_chunk_size if self.setup is not None else None
+        if not size:
+            return [tables] if tables else []
+        return [tables[i:i + size] for i in range(0, len(tables), size)]
+
+    def _get_targets(self) -> List[Tuple[str, List[Tuple[str, str]]]]:
+        """
+        Returns the ON clauses of the statements, one per transaction, with the tables they list.
+        If the setup has table_chunk_size set, these list the current tables of the schema,
+        otherwise the statements apply to ALL TABLES IN SCHEMA.
+        """
+        if self.setup is None or not self.setup.table_chunk_size:
+            return [(f"ALL TABLES IN SCHEMA {self.schema}", [])]
+        tables = self.setup.get_schema_tables(self.database, self.schema)
+        return [(f"TABLE {quote_tables(chunk)}", chunk) for chunk in self._chunk_tables(tables)]
+
+    def _get_transaction_options(self, tables: Collection[Tuple[str, str]] = ()) -> Dict:
+        """
+        Pass the tables which the statements list. Such transactions are kept separate from other statements
+        and are retried without the tables which have been dropped by the time they are executed.
+        """
+        options = {"keep_separate": True, "tables": tables} if tables else {}
+        if self.setup is not None and self.setup.lock_timeout:
+            options.update(lock_timeout=self.setup.lock_timeout, retries=self.setup.lock_retries)
+        return options
 
     def stmts_to_create(self):
-        def get_stmts():
+        def get_stmts(target):
             if self.privileges != self.ALL:
                 yield TextStatement(
                     query=f"""
-                        REVOKE ALL ON ALL TABLES
-                        IN SCHEMA {self.schema}
+                        REVOKE ALL ON {target}
                         FROM {self.grantee}
                     """,
                     database=self.database,
@@ -147,31 +213,62 @@ class SchemaTablesPrivilege(DefaultPrivilegeReady, SchemaPrivilege):
 
             yield TextStatement(
                 query=f"""
-                    GRANT {', '.join(self.privileges)} ON ALL TABLES
-                    IN SCHEMA {self.schema}
+                    GRANT {', '.join(mask_to_keywords(self.privileges))} ON {target}
                     TO {self.grantee}
                 """,
                 database=self.database,
             )
 
-        yield TransactionOfStatements(*get_stmts(), database=self.database)
+        for target, tables in self._get_targets():
+            yield TransactionOfStatements(
+                *get_stmts(target), database=self.database, **self._get_transaction_options(tables)
+            )
 
     def stmts_to_drop(self):
-        yield TextStatement(
-            query=f"""
-                REVOKE {', '.join(self.privileges)} ON ALL TABLES
-                IN SCHEMA {self.schema}
-                FROM {self.grantee}
-            """,
-            database=self.database,
-        )
+        for target, tables in self._get_targets():
+            stmt = TextStatement(
+                query=f"""
+                    REVOKE {', '.join(mask_to_keywords(self.privileges))} ON {target}
+                    FROM {self.grantee}
+                """,
+                database=self.database,
+            )
+            options = self._get_transaction_options(tables)
+            if options:
+                yield TransactionOfStatements(stmt, database=self.database, **options)
+            else:
+                yield stmt
+
+    def stmts_to_update(self):
+        """
+        Changes privileges only on the tables on which the grantee does not have the desired privileges,
+        granting only the missing privileges and revoking only the extra ones.
+        """
+        drifted = self.setup.get_drifted_tables(self) if self.setup is not None else None
+        if drifted is None:
+            yield from self.stmts_to_create()
+            return
+
+        tables_by_privileges = collections.defaultdict(list)
+        for table, privileges in drifted.items():
+            tables_by_privileges[privileges].append(table)
+
+        for current, tables in sorted(tables_by_privileges.items()):
+            for chunk in self._chunk_tables(tables):
+                stmts = stmts_to_change_privileges(
+                    current, self.privileges,
+                    on=f"TABLE {quote_tables(chunk)}", grantee=self.grantee, database=self.database,
+                )
+                yield TransactionOfStatements(
+                    *stmts, database=self.database, **self._get_transaction_options(chunk)
+                )
 
     def get_default_privilege_clause(self, privileges=None, present=None) -> str:
         present = self.present if (present is None) else present
         privileges = self.privileges if (privileges is None) else privileges
         return f"""
             {'GRANT' if present else 'REVOKE'}
-            {', '.join(privileges)}
+            {', '.join(mask_to_keywords(privileges))}
             ON TABLES
             {'TO' if present else 'FROM'}
             {self.grantee}
@@ -186,6 +283,18 @@ class SchemaStateProvider(StateProviderAbc):
     _ssp_schemas: Dict = None
     _ssp_schema_privileges: Dict = None
 
+    object_types_by_loader = {
+        "load_schemas": ("Schema", "SchemaOwner", "DefaultPrivilege"),
+        "load_schema_privileges": ("SchemaPrivilege",),
+    }
+
+    state_attributes_by_loader = {
+        "load_schemas": ("_ssp_schemas",),
+        "load_schema_privileges": ("_ssp_schema_privileges",),
+    }
+
+    per_database_loaders = ("load_schemas", "load_schema_privileges")
+
     @property
     def schemas(self):
         """
@@ -196,9 +305,9 @@ class SchemaStateProvider(StateProviderAbc):
         return self._ssp_schemas
 
     @property
-    def schema_privileges(self) -> Dict[str, Dict[str, Dict[str, Set[str]]]]:
+    def schema_privileges(self) -> Dict[str, Dict[str, Dict[str, int]]]:
         """
-        [database][schema][grantee] => Set[privileges]
+        [database][schema][grantee] => privileges bitmask
         """
         if self._ssp_schema_privileges is None:
             self.load_schema_privileges()
@@ -220,6 +329,16 @@ class SchemaStateProvider(StateProviderAbc):
                     return ObjectState.IS_DIFFERENT
         return ObjectState.IS_ABSENT
 
+    def get_current_schemaprivilege(self, obj: SchemaPrivilege) -> int:
+        """
+        Returns the privileges bitmask the grantee currently has on the schema.
+        """
+        sp = self.schema_privileges
+        if obj.database in sp:
+            if obj.schema in sp[obj.database]:
+                return sp[obj.database][obj.schema].get(obj.grantee, 0)
+        return 0
+
     def get_schemaprivilege(self, obj: SchemaPrivilege) -> ObjectState:
         sp = self._ssp_schema_privileges
         if obj.database in sp:
@@ -234,9 +353,8 @@ class SchemaStateProvider(StateProviderAbc):
     def load_schemas(self):
         self._ssp_schemas = collections.defaultdict(dict)
 
-        for datname in self.databases:
-            conn = self.get_connection(datname)
-            raw_rows = conn.execute(f"""
+        def fetch(conn):
+            return list(conn.execute(f"""
                 SELECT
                 pg_namespace.nspname AS name,
                 pg_roles.rolname AS owner
@@ -245,7 +363,9 @@ class SchemaStateProvider(StateProviderAbc):
                 WHERE pg_namespace.nspname != 'information_schema' AND
                 pg_namespace.nspname NOT LIKE 'pg_%'
                 ORDER BY pg_namespace.nspname
-            """).get_all("name", "owner")
+            """).get_all("name", "owner"))
+
+        for datname, raw_rows in self._map_databases(fetch):
             for raw in raw_rows:
                 self._ssp_schemas[datname][raw["name"]] = {
                     "database": datname, "name": raw["name"], "owner": raw["owner"],
@@ -256,35 +376,67 @@ class SchemaStateProvider(StateProviderAbc):
     def load_schema_privileges(self):
         self._ssp_schema_privileges = collections.defaultdict(
             lambda: collections.defaultdict(
-                lambda: collections.defaultdict(set)
+                lambda: collections.defaultdict(int)
             )
         )
 
-        # TODO This is imperfect as HAS_SCHEMA_PRIVILEGE checks effective privileges
-        # TODO not actual privileges granted specifically to the role.
+        # Read the privileges actually granted on each schema (not the effective privileges
+        # which roles may have through other means) straight from the ACL of the schema.
+        # Schemas with no ACL have the default privileges which acldefault() gives us.
 
-        for datname in self.databases:
-            conn = self.get_connection(datname)
-            for priv_type in SchemaPrivilege.ALL:
-                raw_rows = conn.execute(f"""
-                    SELECT
-                        r.rolname,
-                        (
-                            SELECT STRING_AGG(s.nspname, ',' ORDER BY s.nspname)
-                            FROM pg_namespace s 
-                            WHERE HAS_SCHEMA_PRIVILEGE(r.rolname, s.nspname, %s)
-                            AND s.nspname != 'information_schema'
-                            AND NOT s.nspname LIKE 'pg_%%'
-                        ) AS schemas
-                    FROM pg_roles r
-                    WHERE NOT r.rolcanlogin AND NOT (r.rolname LIKE 'pg_%%')
-                    ORDER BY r.rolname
-                """, priv_type).get_all("rolname", "schemas")
-                for raw in raw_rows:
-                    if not raw["schemas"]:
-                        continue
-                    for schemaname in raw["schemas"].split(","):
-                        self._ssp_schema_privileges[datname][schemaname][raw["rolname"]].add(priv_type)
+        def fetch(conn):
+            return list(conn.execute(f"""
+                SELECT
+                    n.nspname AS schema,
+                    COALESCE(r.rolname, 'public') AS grantee,
+                    STRING_AGG(a.privilege_type, ',') AS privileges
+                FROM pg_namespace n
+                CROSS JOIN LATERAL aclexplode(COALESCE(n.nspacl, acldefault('n', n.nspowner))) a
+                LEFT JOIN pg_roles r ON r.oid = a.grantee
+                WHERE n.nspname != 'information_schema' AND NOT n.nspname LIKE 'pg_%%'
+                GROUP BY n.nspname, r.rolname
+            """).get_all("schema", "grantee", "privileges"))
+
+        for datname, raw_rows in self._map_databases(fetch):
+            for raw in raw_rows:
+                self._ssp_schema_privileges[datname][raw["schema"]][raw["grantee"]] |= keywords_to_mask(
+                    raw["privileges"].split(",")
+                )
+
+
+class SchemaTablesGrants:
+    """
+    Summary of the privileges a grantee has on the tables of a schema.
+
+    If the grantee has exactly the same privileges on every table of the schema,
+    these are in `privileges`, otherwise `privileges` is None.
+    """
+
+    __slots__ = ("privileges", "tables_by_privileges", "tables")
+
+    def __init__(self, tables_by_privileges: Dict[int, List[str]], tables: Dict[str, Dict]):
+        self.tables_by_privileges = tables_by_privileges
+        self.tables = tables
+        self.privileges = None
+        if len(tables_by_privileges) == 1:
+            privileges, privileged_tables = next(iter(tables_by_privileges.items()))
+            if len(privileged_tables) == len(tables):
+                self.privileges = privileges
+
+    def get_drifted_tables(self, privileges: int) -> Dict[str, int]:
+        """
+        Returns tables on which the grantee does not have exactly the passed privileges:
+        [table] => privileges bitmask the grantee has on the table.
+        """
+        drifted = {}
+        seen = set()
+        for table_privileges, tables in self.tables_by_privileges.items():
+            seen.update(tables)
+            if table_privileges != privileges:
+                drifted.update((table, table_privileges) for table in tables)
+        if privileges:
+            drifted.update((table, 0) for table in self.tables if table not in seen)
+        return drifted
 
 
 class SchemaTablesStateProvider(StateProviderAbc):
@@ -292,8 +444,24 @@ class SchemaTablesStateProvider(StateProviderAbc):
     # Provided by DatabaseStateProvider
     databases: Dict
 
+    # If set, tables and their privileges are only loaded for these schemas: [database] => Set[schema]
+    managed_table_schemas: Optional[Dict[str, Set[str]]] = None
+
     _stsp_schema_tables: Dict = None
     _stsp_schema_tables_privileges: Dict = None
+    _stsp_schema_tables_grants: Dict = None
+
+    object_types_by_loader = {
+        "load_schema_tables": ("SchemaTablesPrivilege",),
+        "load_schema_tables_privileges": ("SchemaTablesPrivilege",),
+    }
+
+    state_attributes_by_loader = {
+        "load_schema_tables": ("_stsp_schema_tables",),
+        "load_schema_tables_privileges": ("_stsp_schema_tables_privileges",),
+    }
+
+    per_database_loaders = ("load_schema_tables", "load_schema_tables_privileges")
 
     @property
     def schema_tables(self):
@@ -305,26 +473,67 @@ class SchemaTablesStateProvider(StateProviderAbc):
         return self._stsp_schema_tables
 
     @property
-    def schema_tables_privileges(self):
+    def schema_tables_privileges(self) -> Dict[str, Dict[str, Dict[str, Dict[int, List[str]]]]]:
         """
-        [database][schema][grantee][table] => Set[privileges]
+        [database][schema][grantee][privileges bitmask] => List[table]
+
+        Tables of a schema are grouped by the exact set of privileges the grantee has on them,
+        so a grantee with the same privileges on all tables of the schema has a single entry.
+        Tables on which the grantee has no privileges are not listed.
         """
         if self._stsp_schema_tables_privileges is None:
             self.load_schema_tables_privileges()
         return self._stsp_schema_tables_privileges
 
+    @property
+    def schema_tables_grants(self) -> Dict[str, Dict[str, Dict[str, SchemaTablesGrants]]]:
+        """
+        [database][schema][grantee] => SchemaTablesGrants
+
+        Built from schema_tables_privileges when it is loaded.
+        """
+        if self._stsp_schema_tables_grants is None:
+            self.load_schema_tables_privileges()
+        return self._stsp_schema_tables_grants
+
+    def _get_schema_tables_grants(self, obj: SchemaTablesPrivilege) -> Optional[SchemaTablesGrants]:
+        stg = self.schema_tables_grants
+        if obj.database in stg:
+            if obj.schema in stg[obj.database]:
+                return stg[obj.database][obj.schema].get(obj.grantee)
+        return None
+
     def get_schematablesprivilege(self, obj: SchemaTablesPrivilege) -> ObjectState:
-        stp = self._stsp_schema_tables_privileges
-        if obj.database in stp:
-            if obj.schema in stp[obj.database]:
-                tables = self.schema_tables[obj.database][obj.schema]
-                if obj.grantee in stp[obj.database][obj.schema]:
-                    # Have to check that privileges for each existing table match the expected ones
-                    if all(stp[obj.database][obj.schema][obj.grantee][t] == obj.privileges for t in tables):
-                        return ObjectState.IS_PRESENT
-                    else:
-                        return ObjectState.IS_DIFFERENT
-        return ObjectState.IS_ABSENT
+        grants = self._get_schema_tables_grants(obj)
+        if grants is None:
+            return ObjectState.IS_ABSENT
+        if grants.privileges == obj.privileges:
+            return ObjectState.IS_PRESENT
+        return ObjectState.IS_DIFFERENT
+
+    def get_drifted_tables(self, obj: SchemaTablesPrivilege) -> Dict[str, int]:
+        """
+        Returns tables of the schema on which the grantee does not have exactly the requested privileges:
+        [table] => privileges bitmask the grantee currently has on the table.
+        """
+        grants = self._get_schema_tables_grants(obj)
+        if grants is None:
+            return {}
+        return grants.get_drifted_tables(obj.privileges)
+
+    def _get_table_schemas_filter(self, datname: str, column: str) -> Tuple[str, Tuple]:
+        """
+        Returns SQL condition and its parameters to restrict a query to the managed schemas.
+        """
+        if self.managed_table_schemas is None:
+            return f"{column} != 'information_schema' AND NOT {column} LIKE 'pg_%%'", ()
+        return f"{column} = ANY(%s)", (sorted(self.managed_table_schemas.get(datname, ())),)
+
+    def _map_table_databases(self, func):
+        if self.managed_table_schemas is None:
+            yield from self._map_databases(func)
+        else:
+            yield from self._map_databases(func, only=self.managed_table_schemas.keys())
 
     def load_schema_tables(self):
         #
@@ -335,12 +544,14 @@ class SchemaTablesStateProvider(StateProviderAbc):
             lambda: collections.defaultdict(dict)
         )
 
-        for datname in self.databases:
-            conn = self.get_connection(database=datname)
-            raw_rows = conn.execute(f"""
+        def fetch(conn):
+            condition, params = self._get_table_schemas_filter(conn.database, "schemaname")
+            return list(conn.execute(f"""
                 SELECT schemaname, tablename, tableowner FROM pg_tables
-                WHERE schemaname != 'information_schema' AND NOT schemaname LIKE 'pg_%%' 
-            """).get_all("schemaname", "tablename", "tableowner")
+                WHERE {condition}
+            """, *params).get_all("schemaname", "tablename", "tableowner"))
+
+        for datname, raw_rows in self._map_table_databases(fetch):
             for raw in raw_rows:
                 self._stsp_schema_tables[datname][raw["schemaname"]][raw["tablename"]] = {
                     "database": datname,
@@ -351,26 +562,53 @@ class SchemaTablesStateProvider(StateProviderAbc):
 
     def load_schema_tables_privileges(self):
         self._stsp_schema_tables_privileges = collections.defaultdict(
-            lambda: collections.defaultdict(
-                lambda: collections.defaultdict(
-                    lambda: collections.defaultdict(set)
-                )
-            )
+            lambda: collections.defaultdict(dict)
         )
 
-        for datname in self.databases:
-            conn = self.get_connection(database=datname)
+        def fetch(conn):
             #
-            # Load schema tables privileges
+            # Load schema tables privileges straight from the ACLs of tables (the same
+            # kinds of relations as in pg_tables), grouping tables by grantee and privileges
+            # so that the server returns one row per distinct set of privileges instead of one per table.
             #
-            raw_rows = conn.execute(f"""
-                SELECT
-                grantee, table_schema, table_name, STRING_AGG(privilege_type, ',') AS privileges
-                FROM information_schema.role_table_grants
-                WHERE table_schema != 'information_schema' AND NOT table_schema LIKE 'pg_%%'
-                GROUP BY grantee, table_schema, table_name;
-            """).get_all("grantee", "table_schema", "table_name", "privileges")
+            condition, params = self._get_table_schemas_filter(conn.database, "n.nspname")
+            return list(conn.execute(f"""
+                SELECT schema, grantee, privileges, ARRAY_AGG(table_name ORDER BY table_name) AS tables
+                FROM (
+                    SELECT
+                        n.nspname AS schema,
+                        c.relname AS table_name,
+                        COALESCE(r.rolname, 'public') AS grantee,
+                        STRING_AGG(DISTINCT a.privilege_type, ',' ORDER BY a.privilege_type) AS privileges
+                    FROM pg_class c
+                    JOIN pg_namespace n ON n.oid = c.relnamespace
+                    CROSS JOIN LATERAL aclexplode(COALESCE(c.relacl, acldefault('r', c.relowner))) a
+                    LEFT JOIN pg_roles r ON r.oid = a.grantee
+                    WHERE c.relkind IN ('r', 'p') AND {condition}
+                    GROUP BY n.nspname, c.relname, r.rolname
+                ) table_privileges
+                GROUP BY schema, grantee, privileges
+            """, *params).get_all("schema", "grantee", "privileges", "tables"))
+
+        for datname, raw_rows in self._map_table_databases(fetch):
             for raw in raw_rows:
-                if not raw["privileges"]:
-                    continue
-                self._stsp_schema_tables_privileges[datname][raw["table_schema"]][raw["grantee"]][raw["table_name"]] = set(raw["privileges"].split(","))
+                privileges = keywords_to_mask(raw["privileges"].split(","))
+                grantee_privileges = self._stsp_schema_tables_privileges[datname][raw["schema"]]
+                grantee_privileges.setdefault(raw["grantee"], {})[privileges] = raw["tables"]
+
+        self.index_schema_tables_grants()
+
+    def index_schema_tables_grants(self):
+        """
+        Index the privileges so that checking the state of a SchemaTablesPrivilege
+        does not require looking at every table of the schema.
+        """
+        self._stsp_schema_tables_grants = {}
+        for datname, schemas in self._stsp_schema_tables_privileges.items():
+            self._stsp_schema_tables_grants[datname] = {}
+            for schema, grantees in schemas.items():
+                tables = self.schema_tables.get(datname, {}).get(schema, {})
+                self._stsp_schema_tables_grants[datname][schema] = {
+                    grantee: SchemaTablesGrants(tables_by_privileges, tables=tables)
+                    for grantee, tables_by_privileges in grantees.items()
+                }
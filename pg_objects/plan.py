@@ -0,0 +1,137 @@
+"""
+Plans of the statements which bring the cluster to the desired state, see Setup.plan().
+
+A plan can be saved to a file, reviewed and executed later with Setup.execute_plan()
+which first checks that the server state has not changed since the plan was created.
+Plan files contain password hashes of users, keep them as private as the definitions.
+"""
+
+import itertools
+from typing import Dict, Iterable, Iterator
+
+from .objects.base import ConnectionManager
+from .objects.database import Database
+from .snapshot import load_snapshot, save_snapshot
+from .state import State
+from .statements import CreateStatement, DropStatement, Statement, TextStatement, TransactionOfStatements
+
+
+class StalePlanError(Exception):
+    """
+    Raised when a plan is about to be executed against a server state other than the one it was created against.
+    """
+
+
+class Plan:
+    """
+    `statements` (to create and maintain objects) and `drop_statements` are executed in this order,
+    see Executor.execute_concurrently() for the order when databases are worked on concurrently.
+
+    `databases` are the databases on which statements marked with Statement.ALL_DATABASES are executed.
+
+    `fingerprints` are those of the server state the plan was created against, see State.load_all().
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self, statements: Iterable[Statement], drop_statements: Iterable[Statement] = (),
+        databases: Iterable[str] = (), fingerprints: Dict = None,
+    ):
+        self.statements = list(statements)
+        self.drop_statements = list(drop_statements)
+        self.databases = list(databases)
+        self.fingerprints = fingerprints
+
+    def __iter__(self) -> Iterator[Statement]:
+        return itertools.chain(self.statements, self.drop_statements)
+
+    def __len__(self):
+        return len(self.statements) + len(self.drop_statements)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} of {len(self)} statements>"
+
+    def verify(self, connection_manager: ConnectionManager, concurrency: int = 1):
+        """
+        Raises StalePlanError if the catalogs of the cluster or of any of the databases
+        have changed since the plan was created.
+        """
+        if self.fingerprints is None:
+            raise StalePlanError("Plan was created without fingerprints of the server state")
+        planned = self.fingerprints["databases"]
+        state = State(connection_manager=connection_manager, concurrency=concurrency, databases=planned)
+        if state.fetch_cluster_fingerprint() != self.fingerprints["cluster"]:
+            raise StalePlanError("Roles or databases have changed since the plan was created")
+        current = state.fetch_database_fingerprints()
+        changed = sorted(datname for datname in planned if current.get(datname) != planned[datname])
+        if changed:
+            raise StalePlanError(f"Databases {', '.join(changed)} have changed since the plan was created")
+
+    def to_dict(self) -> Dict:
+        return {
+            "version": self.VERSION,
+            "databases": self.databases,
+            "fingerprints": self.fingerprints,
+            "statements": [_encode_statement(stmt) for stmt in self.statements],
+            "drop_statements": [_encode_statement(stmt) for stmt in self.drop_statements],
+        }
+
+    @classmethod
+    def from_dict(cls, raw: Dict) -> "Plan":
+        if raw.get("version") != cls.VERSION:
+            raise ValueError(f"Unsupported plan version {raw.get('version')!r}")
+        return cls(
+            statements=[_decode_statement(stmt) for stmt in raw["statements"]],
+            drop_statements=[_decode_statement(stmt) for stmt in raw["drop_statements"]],
+            databases=raw["databases"],
+            fingerprints=raw["fingerprints"],
+        )
+
+    def save(self, path: str):
+        """
+        Saves the plan as JSON, compressed with gzip if the path ends with ".gz".
+        """
+        save_snapshot(self.to_dict(), path)
+
+    @classmethod
+    def load(cls, path: str) -> "Plan":
+        raw = load_snapshot(path)
+        if raw is None:
+            raise ValueError(f"Cannot read plan from {path!r}")
+        return cls.from_dict(raw)
+
+
+def _encode_statement(stmt: Statement) -> Dict:
+    """
+    Statements are stored as their queries, except for transactions which keep their options,
+    and CREATE DATABASE and DROP DATABASE which the Executor handles specially.
+    """
+    if isinstance(stmt, TransactionOfStatements):
+        return {
+            "database": stmt.database,
+            "transaction": [_encode_statement(s) for s in stmt.statements],
+            "lock_timeout": stmt.lock_timeout,
+            "retries": stmt.retries,
+            "keep_separate": stmt.keep_separate,
+            "tables": [list(table) for table in stmt.tables],
+        }
+    if isinstance(stmt, (CreateStatement, DropStatement)) and isinstance(stmt.obj, Database):
+        action = "create" if isinstance(stmt, CreateStatement) else "drop"
+        return {"database": stmt.database, f"{action}_database": stmt.obj.name}
+    return {"database": stmt.database, "query": stmt.query, "params": list(stmt.params)}
+
+
+def _decode_statement(raw: Dict) -> Statement:
+    if "transaction" in raw:
+        return TransactionOfStatements(
+            *(_decode_statement(s) for s in raw["transaction"]),
+            database=raw["database"], lock_timeout=raw["lock_timeout"], retries=raw["retries"],
+            keep_separate=raw.get("keep_separate", False),
+            tables=raw.get("tables", ()),
+        )
+    if "create_database" in raw:
+        return CreateStatement(Database(raw["create_database"]), database=raw["database"])
+    if "drop_database" in raw:
+        return DropStatement(Database(raw["drop_database"]), database=raw["database"])
+    return TextStatement(raw["query"], *raw["params"], database=raw["database"])
@@ -0,0 +1,94 @@
+"""
+Privileges are represented as integer bitmasks.
+
+The bits are the same as PostgreSQL uses for AclMode (see src/include/nodes/parsenodes.h)
+and each of them corresponds to a letter in ACL strings such as "grantee=arwdDxt/grantor"
+and to a keyword in GRANT and REVOKE statements.
+"""
+
+import functools
+from typing import Iterable, Tuple
+
+ACL_INSERT = 1 << 0
+ACL_SELECT = 1 << 1
+ACL_UPDATE = 1 << 2
+ACL_DELETE = 1 << 3
+ACL_TRUNCATE = 1 << 4
+ACL_REFERENCES = 1 << 5
+ACL_TRIGGER = 1 << 6
+ACL_EXECUTE = 1 << 7
+ACL_USAGE = 1 << 8
+ACL_CREATE = 1 << 9
+ACL_TEMPORARY = 1 << 10
+ACL_CONNECT = 1 << 11
+ACL_SET = 1 << 12
+ACL_ALTER_SYSTEM = 1 << 13
+ACL_MAINTAIN = 1 << 14
+
+# (bit, ACL letter, keyword) in the order in which PostgreSQL prints ACL letters
+_PRIVILEGES = (
+    (ACL_INSERT, "a", "INSERT"),
+    (ACL_SELECT, "r", "SELECT"),
+    (ACL_UPDATE, "w", "UPDATE"),
+    (ACL_DELETE, "d", "DELETE"),
+    (ACL_TRUNCATE, "D", "TRUNCATE"),
+    (ACL_REFERENCES, "x", "REFERENCES"),
+    (ACL_TRIGGER, "t", "TRIGGER"),
+    (ACL_EXECUTE, "X", "EXECUTE"),
+    (ACL_USAGE, "U", "USAGE"),
+    (ACL_CREATE, "C", "CREATE"),
+    (ACL_TEMPORARY, "T", "TEMPORARY"),
+    (ACL_CONNECT, "c", "CONNECT"),
+    (ACL_SET, "s", "SET"),
+    (ACL_ALTER_SYSTEM, "A", "ALTER SYSTEM"),
+    (ACL_MAINTAIN, "m", "MAINTAIN"),
+)
+
+BITS_BY_ACL_LETTER = {letter: bit for bit, letter, _ in _PRIVILEGES}
+
+BITS_BY_KEYWORD = {keyword: bit for bit, _, keyword in _PRIVILEGES}
+BITS_BY_KEYWORD["TEMP"] = ACL_TEMPORARY
+
+
+@functools.lru_cache(maxsize=None)
+def acl_to_mask(privs_str: str) -> int:
+    """
+    Converts the privileges part of an ACL item ("arwdDxt" in "grantee=arwdDxt/grantor")
+    to a bitmask. Grant options ("*") are ignored.
+    """
+    mask = 0
+    for letter in privs_str:
+        if letter != "*":
+            mask |= BITS_BY_ACL_LETTER[letter]
+    return mask
+
+
+@functools.lru_cache(maxsize=None)
+def mask_to_acl(mask: int) -> str:
+    return "".join(letter for bit, letter, _ in _PRIVILEGES if mask & bit)
+
+
+def keywords_to_mask(keywords: Iterable[str]) -> int:
+    """
+    Converts privilege keywords (as used in GRANT, or returned by aclexplode) to a bitmask.
+    Raises KeyError for unknown keywords. "ALL" is not handled here, see parse_privileges().
+    """
+    mask = 0
+    for keyword in keywords:
+        mask |= BITS_BY_KEYWORD[keyword.upper()]
+    return mask
+
+
+@functools.lru_cache(maxsize=None)
+def mask_to_keywords(mask: int) -> Tuple[str, ...]:
+    """
+    Converts a bitmask to a tuple of privilege keywords, in a stable order.
+    """
+    return tuple(keyword for bit, _, keyword in _PRIVILEGES if mask & bit)
+
+
+def diff_privileges(current: int, desired: int) -> Tuple[int, int]:
+    """
+    Returns (to_grant, to_revoke) bitmasks that turn the current privileges into the desired ones.
+    """
+    return desired & ~current, current & ~desired
@@ -1,28 +1,75 @@
+import collections
+import itertools
 import logging
-from typing import Dict, Hashable, List, Optional, Union, Generator
+from typing import Dict, Hashable, List, Optional, Set, TextIO, Union, Generator
 
 from .connection import Connection
+from .definition import iter_definition
+from .executor import Executor
 from .graph import Graph
+from .plan import Plan
 from .objects.base import Object, ObjectState, SetupAbc, ObjectLink, ConnectionManager
 from .objects.database import Database, DatabasePrivilege
 from .objects.default_privilege import DefaultPrivilege
 from .objects.role import User, Group
 from .objects.schema import SchemaPrivilege, SchemaTablesPrivilege, Schema
+from .privileges import mask_to_keywords
 from .registry import deserialise_object
+from .snapshot import StateCache, load_snapshot, save_snapshot
 from .state import State
-from .statements import Statement, TransactionOfStatements, DropStatement
+from .statements import Statement
 
 
 log = logging.getLogger(__name__)
 
 
 class Setup(SetupAbc):
-    def __init__(self, master_connection: Connection = None):
+    def __init__(
+        self,
+        master_connection: Connection = None, max_connections: int = None, idle_timeout: float = None,
+        concurrency: int = 1, table_chunk_size: int = None, lock_timeout: Union[str, int] = None,
+        lock_retries: int = 3, state_snapshot: str = None, server_state: State = None,
+        state_cache: StateCache = None, connection_manager: ConnectionManager = None,
+    ):
         self._objects: Dict[Hashable, Object] = {}
 
+        # Object graph is extended as objects are registered,
+        # the topological order is cached until the next registration.
+        self._graph = Graph()
+        self._topological_order: Optional[List[Object]] = None
+
+        # Number of databases to work on at the same time
+        self.concurrency = concurrency
+
+        # Grant privileges on tables in chunks of this many tables, each in its own transaction
+        # which waits for locks for at most lock_timeout and is retried lock_retries times.
+        self.table_chunk_size = table_chunk_size
+        self.lock_timeout = lock_timeout
+        self.lock_retries = lock_retries
+
+        # Path of the file in which the loaded server state is kept between runs,
+        # only the databases which have changed since the last run are loaded again.
+        self.state_snapshot = state_snapshot
+
+        # Same as state_snapshot but kept in memory by a long-running process
+        self.state_cache = state_cache
+
         self._server_state: State = None
 
-        self.connection_manager = ConnectionManager(master_connection=master_connection)
+        # State to plan against instead of loading it from the server, such as State.from_snapshot().
+        # Changes can then only be applied with dry_run.
+        self._offline_state = server_state
+        if master_connection is None and server_state is not None:
+            master_connection = server_state.master_connection
+
+        if connection_manager:
+            self.connection_manager = connection_manager
+        else:
+            self.connection_manager = ConnectionManager(
+                master_connection=master_connection,
+                max_connections=max_connections,
+                idle_timeout=idle_timeout,
+            )
 
         for obj in self.get_implicit_objects():
             self.register(obj)
@@ -35,12 +82,23 @@ class Setup(SetupAbc):
         return self.connection_manager.get_connection(database=database)
 
     @classmethod
-    def from_definition(cls, definition: Dict, master_connection: Connection = None) -> "Setup":
-        setup = cls(master_connection=master_connection)
+    def from_definition(cls, definition: Dict, master_connection: Connection = None, **kwargs) -> "Setup":
+        setup = cls(master_connection=master_connection, **kwargs)
         for raw in definition["objects"]:
             setup.register(deserialise_object(**raw, setup=setup))
         return setup
 
+    @classmethod
+    def from_stream(cls, stream: TextIO, master_connection: Connection = None, **kwargs) -> "Setup":
+        """
+        Creates a setup from a definition read from the stream, registering objects one at a time
+        as they are parsed, see definition.iter_definition() for the supported formats.
+        """
+        setup = cls(master_connection=master_connection, **kwargs)
+        for raw in iter_definition(stream):
+            setup.register(deserialise_object(**raw, setup=setup))
+        return setup
+
     def get_implicit_objects(self) -> List[Object]:
         """
         Returns a list of objects that are not managed (created, updated, dropped) by us,
@@ -81,6 +139,17 @@ class Setup(SetupAbc):
         """
         return [d.name for d in self._objects.values() if isinstance(d, Database)]
 
+    @property
+    def managed_table_schemas(self) -> Dict[str, Set[str]]:
+        """
+        Schemas whose tables are referenced by SchemaTablesPrivilege objects of this setup: [database] => Set[schema].
+        """
+        table_schemas = collections.defaultdict(set)
+        for obj in self._objects.values():
+            if isinstance(obj, SchemaTablesPrivilege):
+                table_schemas[obj.database].add(obj.schema)
+        return dict(table_schemas)
+
     def register(self, obj: Object):
         assert obj not in self
         assert not isinstance(obj, ObjectLink)
@@ -95,7 +164,13 @@ class Setup(SetupAbc):
             if obj.present and not self.get(dep).present:
                 raise ValueError(f"{obj} depends on {dep} but it is marked as not present")
 
+        # Refer to the registered dependencies rather than to the copies created by the constructor
+        # so that the copies can be freed.
+        obj.dependencies = {self._objects[dep.key] for dep in obj.dependencies}
+
         self._objects[obj.key] = obj
+        obj.add_to_graph(self._graph)
+        self._topological_order = None
 
     def get(self, obj_or_key: Union[Object, Hashable]) -> Optional[Object]:
         if isinstance(obj_or_key, ObjectLink):
@@ -173,17 +248,47 @@ class Setup(SetupAbc):
         )
 
     def generate_graph(self) -> Graph:
-        g = Graph()
-        for obj in self._objects.values():
-            obj.add_to_graph(g)
-        return g
+        """
+        Returns the graph of the registered objects and the links between them.
+        """
+        return self._graph
 
     def topological_order(self) -> List[Object]:
-        return [vertex.value for vertex in self.generate_graph().topological_sort_by_kahn()]
+        if self._topological_order is None:
+            self._topological_order = [vertex.value for vertex in self._graph.topological_sort_by_kahn()]
+        return list(self._topological_order)
 
-    def _load_server_state(self):
-        state = State(connection_manager=self.connection_manager)
-        state.load_all()
+    @property
+    def is_offline(self) -> bool:
+        """
+        True if the setup plans against a state which is not loaded from the server.
+        """
+        return self._offline_state is not None
+
+    def _load_server_state(self, fingerprint: bool = False):
+        if self.is_offline:
+            self._server_state = self._offline_state
+            return
+
+        state = State(
+            connection_manager=self.connection_manager,
+            concurrency=self.concurrency,
+            databases=self.managed_databases,
+            object_types={obj.__class__.__name__ for obj in self.topological_order()},
+            table_schemas=self.managed_table_schemas,
+        )
+        if self.state_cache is not None:
+            state.load_all(
+                snapshot=self.state_cache.snapshot,
+                fingerprint=True,
+                unchanged_databases=self.state_cache.unchanged_databases,
+            )
+            self.state_cache.snapshot = state.to_snapshot()
+        elif self.state_snapshot:
+            state.load_all(snapshot=load_snapshot(self.state_snapshot), fingerprint=True)
+            save_snapshot(state.to_snapshot(), self.state_snapshot)
+        else:
+            state.load_all(fingerprint=fingerprint)
 
         # TODO Return instead of storing on instance so that it could be reloaded
         self._server_state = state
@@ -194,9 +299,50 @@ class Setup(SetupAbc):
         """
         return self._server_state.get(obj)
 
+    def get_current_privileges(self, obj: Object) -> Optional[int]:
+        """
+        Returns the privileges currently granted for the privilege object, if known.
+        """
+        if self._server_state is None:
+            return None
+        return self._server_state.get_current_privileges(obj)
+
+    def get_drifted_tables(self, obj: SchemaTablesPrivilege) -> Optional[Dict[str, int]]:
+        """
+        Returns tables of the schema on which the grantee does not have the requested privileges,
+        with the privileges it currently has, see State.get_drifted_tables().
+        """
+        if self._server_state is None:
+            return None
+        return self._server_state.get_drifted_tables(obj)
+
+    def get_schema_tables(self, database: str, schema: str) -> List[str]:
+        """
+        Returns names of the tables currently in the schema.
+        """
+        return list(self._server_state.schema_tables.get(database, {}).get(schema, {}))
+
+    def _log_drift(self, obj: Object, max_tables: int = 20):
+        """
+        Log details of how the current state of the object differs from the desired one, where available.
+        """
+        if isinstance(obj, SchemaTablesPrivilege):
+            drifted = sorted(self._server_state.get_drifted_tables(obj).items())
+            details = ", ".join(
+                f"{table} ({','.join(mask_to_keywords(privileges)) or 'no privileges'})"
+                for table, privileges in drifted[:max_tables]
+            )
+            if len(drifted) > max_tables:
+                details += f" and {len(drifted) - max_tables} more"
+            log.info(f"{obj.key} differs on {len(drifted)} table(s): {details}")
+
     def _generate_stmts(self) -> Generator[Statement, None, None]:
         objects = self.topological_order()
+        yield from self._generate_create_stmts(objects)
+        yield from self._generate_maintain_stmts(objects)
+        yield from self._generate_drop_stmts(objects)
 
+    def _generate_create_stmts(self, objects: List[Object]) -> Generator[Statement, None, None]:
         # CREATE objects in topological order
         for obj in objects:
             current_state = self.get_current_state(obj)
@@ -209,13 +355,16 @@ class Setup(SetupAbc):
                 yield from obj.stmts_to_create()
 
             elif current_state.is_different and obj.present:
+                self._log_drift(obj)
                 yield from obj.stmts_to_update()
 
+    def _generate_maintain_stmts(self, objects: List[Object]) -> Generator[Statement, None, None]:
         # "Maintain" objects in topological order
         for obj in objects:
-            if obj.present:
+            if obj.present and self._needs_maintenance(obj):
                 yield from obj.stmts_to_maintain()
 
+    def _generate_drop_stmts(self, objects: List[Object]) -> Generator[Statement, None, None]:
         # DROP objects in reverse topological order
         for obj in reversed(objects):
             current_state = self.get_current_state(obj)
@@ -227,6 +376,35 @@ class Setup(SetupAbc):
             elif current_state.is_unknown and not obj.present:
                 yield from obj.stmts_to_drop()
 
+    def _needs_maintenance(self, obj: Object) -> bool:
+        # Objects which do not maintain anything are not asked, see Object.stmts_to_maintain()
+        if type(obj).stmts_to_maintain is Object.stmts_to_maintain:
+            return False
+        return not self._server_state.is_maintained(obj)
+
+    def get_drift(self) -> Dict[str, List[str]]:
+        """
+        Loads the server state and returns keys of the objects for which execute() would generate statements,
+        by what would be done with them: "create", "update", "maintain" and "drop".
+
+        This makes the same decisions as _generate_stmts() but no statements are generated.
+        Objects whose current state is unknown are reported as to be created or dropped.
+        """
+        self._load_server_state()
+        drift = {"create": [], "update": [], "maintain": [], "drop": []}
+        for obj in self.topological_order():
+            current_state = self.get_current_state(obj)
+            if obj.present:
+                if current_state.is_absent or current_state.is_unknown:
+                    drift["create"].append(obj.key)
+                elif current_state.is_different:
+                    drift["update"].append(obj.key)
+                if self._needs_maintenance(obj):
+                    drift["maintain"].append(obj.key)
+            elif current_state.is_present or current_state.is_unknown:
+                drift["drop"].append(obj.key)
+        return drift
+
     def inspect(self, load_current_state=True):
         """
         Inspect objects of the graph.
@@ -246,57 +424,97 @@ class Setup(SetupAbc):
                 f"{obj.key}"
             )
 
-    def execute(self, dry_run: bool = False):
+    def plan(self, fingerprint: bool = True) -> Plan:
+        """
+        Loads the server state and returns the statements which would bring the cluster
+        to the state of this setup.
+
+        With fingerprint=True, the fingerprints of the server state are recorded in the plan
+        so that it can be saved and executed later with execute_plan().
+        """
+        self._load_server_state(fingerprint=fingerprint)
+        objects = self.topological_order()
+
+        # Not all statements can always be executed on all databases because they may not exist.
+        # Checking just the server state is not sufficient because:
+        # - database may not have existed originally, but exists by the time the statement runs.
+        # - database may have existed originally, but no longer exists.
+        # Therefore "present" is the best indicator of whether we should attempt this.
+        databases = [datname for datname in self.managed_databases if self.get(Database(datname)).present]
+
+        return Plan(
+            statements=itertools.chain(
+                self._generate_create_stmts(objects),
+                self._generate_maintain_stmts(objects),
+            ),
+            drop_statements=self._generate_drop_stmts(objects),
+            databases=databases,
+            fingerprints=self._server_state.fingerprints,
+        )
+
+    def execute(
+        self, dry_run: bool = False, batch_size: int = None,
+        single_transaction: bool = False, commit_every: int = None,
+    ):
         """
         Ensure the object graph in the setup matches that in the database cluster.
 
         If dry_run is set to True, it CONNECTS to the server and consults the current state,
         but no changes are applied.
+
+        See execute_plan() for the other options.
         """
+        if self.is_offline and not dry_run:
+            raise ValueError("Cannot apply changes planned against a state which was not loaded from the server")
+
+        self.execute_plan(
+            self.plan(fingerprint=False),
+            dry_run=dry_run,
+            batch_size=batch_size,
+            single_transaction=single_transaction,
+            commit_every=commit_every,
+            verify=False,
+        )
 
-        def execute_stmt(connection: Connection, statement: Statement):
-            if dry_run:
-                if isinstance(statement, TransactionOfStatements):
-                    for s in statement.statements:
-                        connection.log_query(s.query, dry_run=True, database=s.database)
-                else:
-                    connection.log_query(statement.query, dry_run=True, database=statement.database)
-                return
-
-            # Before attempting to drop a database, must close the connection to that database.
-            if isinstance(statement, DropStatement) and isinstance(statement.obj, Database):
-                self.get_connection(statement.obj.name).close()
-
-            # If a statement is a transaction, must execute it as one
-            if isinstance(statement, TransactionOfStatements):
-                with connection.begin() as tx:
-                    for stmt in statement.statements:
-                        assert stmt.database is None or stmt.database == connection.database
-                        tx.execute(stmt.query, *stmt.params)
-            else:
-                connection.execute(statement.query, *statement.params)
+    def execute_plan(
+        self, plan: Plan, dry_run: bool = False, batch_size: int = None,
+        single_transaction: bool = False, commit_every: int = None, verify: bool = True,
+    ):
+        """
+        Executes the statements of a plan, which may have been created by another Setup, see plan().
 
-        self._load_server_state()
+        If verify is set, first checks that the server state has not changed since the plan was created
+        and raises StalePlanError if it has. The server state is not loaded otherwise.
 
-        for stmt in self._generate_stmts():
-            if stmt.is_on_all_databases:
-                for datname in self.managed_databases:
-                    # Not all statements can always be executed on all databases because they may not exist.
-                    # Checking just the server state is not sufficient because:
-                    # - database may not have existed originally, but exists by the time the statement runs.
-                    # - database may have existed originally, but no longer exists.
-                    # Therefore "present" is the best indicator of whether we should attempt this.
-                    database = self.get(Database(datname))
-                    if database and database.present:
-                        execute_stmt(connection=self.get_connection(database=datname), statement=stmt)
-                    else:
-                        log.info(f"Skipping statement {stmt} on non-existent database {datname!r}")
-            else:
-                conn = self.get_connection(database=stmt.database)
+        If batch_size is set, consecutive statements for the same database are sent to the server
+        in batches of up to batch_size statements, see Executor.
+
+        If the setup was created with concurrency > 1, statements for individual databases
+        are executed concurrently, see Executor.execute_concurrently().
 
-                # Before attempting to drop a database, must close the connection.
-                # (a connection was acquired earlier for each database to load its schemas)
-                if isinstance(stmt, DropStatement) and isinstance(stmt.obj, Database):
-                    self.get_connection(stmt.obj.name).close()
+        If single_transaction is set, all statements for a database are executed in one transaction
+        (committed every commit_every statements if that is set), except CREATE DATABASE
+        and DROP DATABASE which cannot run in a transaction.
 
-                execute_stmt(connection=conn, statement=stmt)
+        A setup created with a server_state does not connect to the server at all,
+        so it can only be executed with dry_run.
+        """
+        if self.is_offline and not dry_run:
+            raise ValueError("Cannot apply changes planned against a state which was not loaded from the server")
+
+        if verify and not self.is_offline:
+            plan.verify(self.connection_manager, concurrency=self.concurrency)
+
+        executor = Executor(
+            connection_manager=self.connection_manager,
+            databases=plan.databases,
+            dry_run=dry_run,
+            batch_size=batch_size,
+            concurrency=self.concurrency,
+            single_transaction=single_transaction,
+            commit_every=commit_every,
+        )
+        if self.concurrency > 1 or single_transaction:
+            executor.execute_concurrently(statements=plan.statements, drop_statements=plan.drop_statements)
+        else:
+            executor.execute(plan)
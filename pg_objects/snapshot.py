@@ -0,0 +1,110 @@
+"""
+Saving and loading of state snapshots, see State.to_snapshot(). Plans are stored the same way, see Plan.save().
+
+Snapshots are stored as JSON, compressed with gzip if the file name ends with ".gz".
+Dictionaries with keys which are not strings (such as privilege bitmasks or tuples)
+are stored as lists of [key, value] pairs.
+
+Files are only readable by their owner as plans contain password hashes of users.
+"""
+
+import gzip
+import io
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Set
+
+log = logging.getLogger(__name__)
+
+_ITEMS = "__items__"
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value) and list(value) != [_ITEMS]:
+            return {k: _encode(v) for k, v in value.items()}
+        return {_ITEMS: [[_encode(k), _encode(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if list(value) == [_ITEMS]:
+            return {_decode_key(k): _decode(v) for k, v in value[_ITEMS]}
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def _decode_key(key: Any) -> Any:
+    if isinstance(key, list):
+        return tuple(_decode_key(k) for k in key)
+    return key
+
+
+def _open(path: str, mode: str, compressed: bool):
+    if compressed:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _create_private(path: str, compressed: bool):
+    """
+    Creates the file with permissions for its owner only, regardless of the umask.
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    raw = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb")
+    if compressed:
+        # GzipFile does not close a file object it was passed
+        return gzip.open(raw, "wt", encoding="utf-8"), raw
+    return io.TextIOWrapper(raw, encoding="utf-8"), raw
+
+
+def save_snapshot(snapshot: Dict, path: str):
+    """
+    Writes the snapshot to a temporary file first and then moves it in place
+    so that a concurrent reader never sees a partially written snapshot.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    f, raw = _create_private(tmp_path, compressed=path.endswith(".gz"))
+    try:
+        with raw, f:
+            json.dump(_encode(snapshot), f, separators=(",", ":"))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str) -> Optional[Dict]:
+    """
+    Returns the snapshot stored in the file, or None if there is no usable snapshot.
+    """
+    try:
+        with _open(path, "r", compressed=path.endswith(".gz")) as f:
+            return _decode(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning(f"Ignoring state snapshot {path!r} which cannot be read: {e}")
+        return None
+
+
+class StateCache:
+    """
+    Keeps the state snapshot of the last run in memory instead of in a file, see pg_objects.daemon.
+
+    unchanged_databases are the databases known not to have changed since the snapshot was taken,
+    see State.load_all().
+    """
+
+    def __init__(self):
+        self.snapshot: Optional[Dict] = None
+        self.unchanged_databases: Set[str] = set()
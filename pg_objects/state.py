@@ -1,34 +1,348 @@
 import logging
+from typing import Collection, Dict, List, Optional, Set, Tuple
 
-from .objects.default_privilege import DefaultPrivilege
+from .objects.default_privilege import DefaultPrivilegeStateProvider
 from .objects.base import ConnectionManager, Object, ObjectState
 from .objects.database import DatabasePrivilegeStateProvider, DatabaseStateProvider
-from .objects.role import RoleStateProvider
-from .objects.schema import SchemaTablesStateProvider, SchemaStateProvider, SchemaTablesPrivilege
+from .objects.role import UNKNOWN_PASSWORD, RoleStateProvider
+from .objects.schema import SchemaTablesStateProvider, SchemaStateProvider
 from .connection import Connection, get_connection
 
 
 log = logging.getLogger(__name__)
 
 
+class SnapshotConnection(Connection):
+    """
+    Master connection of a state restored from a snapshot, see State.from_snapshot().
+    It carries the user name and the database of the cluster, but it never connects to the server.
+    """
+
+    def _connect(self):
+        raise RuntimeError(
+            f"Cannot connect to {self.database!r} to load state which is missing from the state snapshot"
+        )
+
+
 class State(
     DatabaseStateProvider,
     DatabasePrivilegeStateProvider,
     SchemaStateProvider,
     SchemaTablesStateProvider,
     RoleStateProvider,
+    DefaultPrivilegeStateProvider,
 ):
-    def __init__(self, connection_manager: ConnectionManager = None, master_connection: Connection = None):
+    SNAPSHOT_VERSION = 2
+
+    # Fingerprints of the catalogs the state was loaded from: {"cluster": str, "databases": {datname: str}}
+    fingerprints: Optional[Dict] = None
+
+    def __init__(
+        self,
+        connection_manager: ConnectionManager = None, master_connection: Connection = None,
+        concurrency: int = 1,
+        databases: Collection[str] = None,
+        object_types: Collection[str] = None,
+        table_schemas: Dict[str, Collection[str]] = None,
+    ):
+        """
+        Pass concurrency > 1 to load per-database state of that many databases at the same time.
+
+        Pass databases to only load per-database state (schemas, tables, privileges) of these databases.
+
+        Pass object_types (names of Object classes) to only load the state
+        that is needed to answer get() for objects of these types.
+
+        Pass table_schemas ([database] => schemas) to only load tables and their privileges of these schemas.
+        """
         if connection_manager:
             self.connection_manager = connection_manager
         else:
             self.connection_manager = ConnectionManager(master_connection=master_connection)
+        self.concurrency = concurrency
+        self.managed_databases = set(databases) if databases is not None else None
+        self.object_types = set(object_types) if object_types is not None else None
+        if table_schemas is not None:
+            self.managed_table_schemas = {datname: set(schemas) for datname, schemas in table_schemas.items()}
+
+    def _merge_class_attribute(self, name: str) -> Dict:
+        merged = {}
+        for cls in reversed(self.__class__.__mro__):
+            merged.update(vars(cls).get(name, {}))
+        return merged
+
+    def get_object_types_by_loader(self) -> Dict[str, Tuple[str, ...]]:
+        return self._merge_class_attribute("object_types_by_loader")
 
-    def load_all(self):
+    def get_state_attributes_by_loader(self) -> Dict[str, Tuple[str, ...]]:
+        return self._merge_class_attribute("state_attributes_by_loader")
+
+    def get_per_database_loaders(self) -> Set[str]:
+        return {
+            loader
+            for cls in self.__class__.__mro__
+            for loader in vars(cls).get("per_database_loaders", ())
+        }
+
+    def get_loaders(self) -> List[str]:
+        """
+        Returns names of the load_* methods which need to be run for the managed object types.
+        """
+        object_types_by_loader = self.get_object_types_by_loader()
+        loaders = []
         for k in dir(self):
             if not k.startswith("load_") or k == "load_all":
                 continue
-            getattr(self, k)()
+            if self.object_types is not None and k in object_types_by_loader:
+                if not self.object_types.intersection(object_types_by_loader[k]):
+                    log.debug(f"Not running {k} because no managed objects need it")
+                    continue
+            loaders.append(k)
+        return loaders
+
+    def load_all(self, snapshot: Dict = None, fingerprint: bool = False, unchanged_databases: Collection[str] = ()):
+        """
+        Loads the state needed by the managed object types, cluster-level state first.
+
+        Pass fingerprint=True to record fingerprints of the catalogs before loading them,
+        these are needed to create a snapshot with to_snapshot().
+
+        Pass a snapshot created by to_snapshot() to reuse its state of the cluster
+        and of each database whose fingerprint has not changed since then.
+        Only the state of the changed databases is loaded from the server.
+
+        Pass unchanged_databases along with a snapshot if some databases are known not to have changed
+        since the snapshot was taken (see pg_objects.daemon), their fingerprints are not fetched.
+        """
+        if snapshot is not None and not self.is_snapshot_usable(snapshot):
+            snapshot = None
+        if snapshot is not None or fingerprint:
+            self.fingerprints = {"cluster": self.fetch_cluster_fingerprint(), "databases": {}}
+
+        loaders = self.get_loaders()
+        per_database_loaders = [k for k in loaders if k in self.get_per_database_loaders()]
+        cluster_loaders = [k for k in loaders if k not in per_database_loaders]
+
+        if snapshot is not None and snapshot["fingerprints"]["cluster"] == self.fingerprints["cluster"]:
+            log.info("Cluster catalogs have not changed since the state snapshot was taken, reusing it")
+            for k in cluster_loaders:
+                self._restore_loader_state(k, snapshot)
+        else:
+            for k in cluster_loaders:
+                getattr(self, k)()
+
+        reused_databases = set()
+        if self.fingerprints is not None:
+            known = {}
+            if snapshot is not None and unchanged_databases:
+                known = {
+                    datname: fingerprint for datname, fingerprint in snapshot["fingerprints"]["databases"].items()
+                    if datname in unchanged_databases and datname in self.databases
+                    and (self.managed_databases is None or datname in self.managed_databases)
+                }
+            only = [datname for datname in self.databases if datname not in known] if known else None
+            self.fingerprints["databases"] = {**self.fetch_database_fingerprints(only=only), **known}
+            if snapshot is not None:
+                reused_databases = {
+                    datname for datname, fingerprint in self.fingerprints["databases"].items()
+                    if snapshot["fingerprints"]["databases"].get(datname) == fingerprint
+                }
+                self.reload_databases = set(self.fingerprints["databases"]) - reused_databases
+                log.info(
+                    f"Reusing state snapshot of {len(reused_databases)} database(s), "
+                    f"loading {len(self.reload_databases)} changed database(s)"
+                )
+
+        try:
+            for k in per_database_loaders:
+                getattr(self, k)()
+        finally:
+            self.reload_databases = None
+
+        if reused_databases:
+            for k in per_database_loaders:
+                self._restore_loader_state(k, snapshot, databases=reused_databases)
+            if self._stsp_schema_tables_privileges is not None:
+                self.index_schema_tables_grants()
+
+    def _restore_loader_state(self, loader: str, snapshot: Dict, databases: Collection[str] = None):
+        """
+        Sets the state attributes of the loader to their values in the snapshot,
+        or, for a per-database loader, sets the state of the passed databases.
+        """
+        for attribute in self.get_state_attributes_by_loader().get(loader, ()):
+            value = snapshot["state"][attribute]
+            if databases is None:
+                setattr(self, attribute, value)
+            else:
+                current = getattr(self, attribute)
+                for datname in databases:
+                    if datname in value:
+                        current[datname] = value[datname]
+
+    @property
+    def scope(self) -> Dict:
+        """
+        Options which determine which state is loaded. A snapshot can only be reused with the same scope.
+        """
+        return {
+            "databases": sorted(self.managed_databases) if self.managed_databases is not None else None,
+            "object_types": sorted(self.object_types) if self.object_types is not None else None,
+            "table_schemas": {
+                datname: sorted(schemas) for datname, schemas in sorted(self.managed_table_schemas.items())
+            } if self.managed_table_schemas is not None else None,
+        }
+
+    def is_snapshot_usable(self, snapshot: Dict) -> bool:
+        """
+        A snapshot is usable if it was taken with the same scope or with no limits on the scope,
+        as one exported with export-state is.
+        """
+        if snapshot.get("version") != self.SNAPSHOT_VERSION:
+            log.info(f"Not using state snapshot of version {snapshot.get('version')!r}")
+            return False
+        snapshot_scope = snapshot.get("scope") or {}
+        for k, v in self.scope.items():
+            if snapshot_scope.get(k) is not None and snapshot_scope.get(k) != v:
+                log.info("Not using state snapshot which was taken for different objects")
+                return False
+        state = snapshot.get("state", {})
+        for loader in self.get_loaders():
+            for attribute in self.get_state_attributes_by_loader().get(loader, ()):
+                if attribute not in state:
+                    log.info(f"Not using state snapshot which does not have {attribute}")
+                    return False
+        return True
+
+    def to_snapshot(self, without_passwords: bool = False) -> Dict:
+        """
+        Returns the loaded state with the fingerprints of the catalogs it was loaded from,
+        see load_all() and pg_objects.snapshot.save_snapshot().
+
+        Passwords are stored as digests of their hashes. Pass without_passwords=True to store them
+        as unknown instead, in which case passwords are not compared when planning against the snapshot.
+        """
+        if self.fingerprints is None:
+            raise ValueError("State was loaded without fingerprints, pass fingerprint=True to load_all()")
+        state = {}
+        for attributes in self.get_state_attributes_by_loader().values():
+            for attribute in attributes:
+                if getattr(self, attribute) is not None:
+                    state[attribute] = getattr(self, attribute)
+        if without_passwords and "_rsp_role_attributes" in state:
+            state["_rsp_role_attributes"] = {
+                rolname: dict(attributes, password=UNKNOWN_PASSWORD)
+                for rolname, attributes in state["_rsp_role_attributes"].items()
+            }
+        return {
+            "version": self.SNAPSHOT_VERSION,
+            "master": {"username": self.master_connection.username, "database": self.master_connection.database},
+            "scope": self.scope,
+            "fingerprints": self.fingerprints,
+            "state": state,
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict) -> "State":
+        """
+        Returns the state stored in a snapshot created by to_snapshot(), without connecting to the server.
+
+        The master connection of the returned state only carries the user name and the database
+        the snapshot was taken with, see SnapshotConnection.
+        """
+        if snapshot.get("version") != cls.SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported state snapshot version {snapshot.get('version')!r}")
+        master = snapshot.get("master") or {}
+        scope = snapshot.get("scope") or {}
+        state = cls(
+            master_connection=SnapshotConnection(username=master.get("username"), database=master.get("database")),
+            databases=scope.get("databases"),
+            object_types=scope.get("object_types"),
+            table_schemas=scope.get("table_schemas"),
+        )
+        state.fingerprints = snapshot["fingerprints"]
+        for attributes in state.get_state_attributes_by_loader().values():
+            for attribute in attributes:
+                if attribute in snapshot["state"]:
+                    setattr(state, attribute, snapshot["state"][attribute])
+        if state._stsp_schema_tables_privileges is not None:
+            state.index_schema_tables_grants()
+        return state
+
+    def fetch_cluster_fingerprint(self) -> str:
+        """
+        Returns a hash of the cluster-level catalogs: roles, role membership and databases with their ACLs.
+        """
+        query = """
+            SELECT md5(concat_ws('|',
+                (SELECT string_agg(r::text, ',' ORDER BY r.oid) FROM pg_roles r),
+                (SELECT string_agg(m.roleid || ':' || m.member, ',' ORDER BY m.roleid, m.member)
+                FROM pg_auth_members m),
+                (SELECT string_agg(
+                    d.datname || ':' || d.datdba || ':' || COALESCE(d.datacl::text, ''), ',' ORDER BY d.oid
+                ) FROM pg_database d),
+                {passwords}
+            ))
+        """
+        try:
+            return self.mc.execute(query.format(passwords="""
+                (SELECT md5(string_agg(a.rolname || ':' || COALESCE(a.rolpassword, ''), ',' ORDER BY a.oid))
+                FROM pg_authid a)
+            """)).scalar()
+        except Exception as e:
+            if not isinstance(e, self.mc.programming_error_cls or ()):
+                raise
+            # Only superusers can read pg_authid, see load_role_attributes()
+            return self.mc.execute(query.format(passwords="NULL")).scalar()
+
+    def fetch_database_fingerprints(self, only: Collection[str] = None) -> Dict[str, str]:
+        """
+        Returns a hash of the catalogs of each database: schemas, tables and default privileges with their ACLs.
+        Pass `only` to fetch the fingerprints of some of the databases.
+
+        Owners are hashed by name rather than by OID because the state refers to roles by name,
+        so renaming a role changes the fingerprints.
+        """
+        def fetch(conn):
+            return conn.execute("""
+                SELECT md5(concat_ws('|',
+                    (SELECT string_agg(
+                        n.oid || ':' || n.nspname || ':' || pg_get_userbyid(n.nspowner) || ':'
+                        || COALESCE(n.nspacl::text, ''),
+                        ',' ORDER BY n.oid
+                    ) FROM pg_namespace n),
+                    (SELECT string_agg(
+                        c.oid || ':' || c.relname || ':' || c.relnamespace || ':' || pg_get_userbyid(c.relowner) || ':'
+                        || COALESCE(c.relacl::text, ''),
+                        ',' ORDER BY c.oid
+                    ) FROM pg_class c WHERE c.relkind IN ('r', 'p')),
+                    (SELECT string_agg(
+                        d::text || ':' || pg_get_userbyid(d.defaclrole), ',' ORDER BY d.oid
+                    ) FROM pg_default_acl d)
+                ))
+            """).scalar()
+
+        return dict(self._map_databases(fetch, only=only))
+
+    def is_maintained(self, obj: Object) -> bool:
+        """
+        Returns True if the statements of obj.stmts_to_maintain() would not change anything.
+        Objects for which this cannot be detected are never considered maintained.
+        """
+        checker = getattr(self, f"is_{obj.__class__.__name__.lower()}_maintained", None)
+        if checker is None:
+            return False
+        return checker(obj)
+
+    def get_current_privileges(self, obj: Object) -> Optional[int]:
+        """
+        Returns the privileges bitmask currently granted for the privilege object,
+        or None if the current privileges of objects of this type are not known.
+        """
+        getter = getattr(self, f"get_current_{obj.__class__.__name__.lower()}", None)
+        if getter is None:
+            return None
+        return getter(obj)
 
     def get(self, obj: Object):
         getter = getattr(self, f"get_{obj.__class__.__name__.lower()}", None)
@@ -37,25 +351,6 @@ class State(
             return ObjectState.IS_UNKNOWN
         return getter(obj)
 
-    def get_defaultprivilege(self, obj: DefaultPrivilege) -> ObjectState:
-        """
-        TODO This is an incomplete implementation of current state of default privileges --
-        TODO the actual state is not loaded, we just use the absence of schemas or roles
-        TODO as an indicator that the default privilege is surely absent.
-        TODO This is needed because the default state IS_UNKNOWN means that we should
-        TODO attempt to revoke the privileges every time they are requested absent
-        TODO but that would throw errors if schemas or roles don't exist.
-        """
-        priv = obj.privilege
-        if obj.grantor not in self.groups and obj.grantor not in self.users:
-            return ObjectState.IS_ABSENT
-        if isinstance(priv, SchemaTablesPrivilege):
-            if priv.database not in self.schemas:
-                return ObjectState.IS_ABSENT
-            if priv.schema not in self.schemas[priv.database]:
-                return ObjectState.IS_ABSENT
-        return ObjectState.IS_UNKNOWN
-
 
 if __name__ == "__main__":
     state = State(master_connection=get_connection())
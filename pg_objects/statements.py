@@ -1,7 +1,11 @@
-from typing import Tuple, ClassVar, List, Union
+from typing import Collection, Tuple, ClassVar, List, Optional, Union
+
+from .utils import quote_tables
 
 
 class Statement:
+    __slots__ = ()
+
     query: str
     params: Tuple
     database: str
@@ -25,16 +29,58 @@ class Statement:
 
 
 class TransactionOfStatements(Statement):
+    """
+    Statements executed in one transaction.
+
+    If lock_timeout is set (as accepted by PostgreSQL, e.g. "2s" or 2000 for milliseconds),
+    the transaction gives up waiting for a lock after that time and is retried up to `retries` times.
+    Such a transaction is always executed on its own so that it holds its locks as briefly as possible,
+    and so is a transaction with keep_separate set (such as a chunk of tables), lock_timeout or not.
+
+    tables are the (schema, table) pairs which the statements list, as formatted by quote_tables().
+    If some of them no longer exist when the transaction is executed, it is retried without them,
+    see Executor.execute_transaction().
+    """
+
+    __slots__ = ("statements", "database", "lock_timeout", "retries", "keep_separate", "tables")
 
     statements: List[Statement]
+    lock_timeout: Union[str, int, None]
+    retries: int
+    keep_separate: bool
+    tables: Tuple[Tuple[str, str], ...]
 
     def __init__(self, *statements, **kwargs):
         self.statements = statements
         self.database = kwargs.pop("database", None)
+        self.lock_timeout = kwargs.pop("lock_timeout", None)
+        self.retries = kwargs.pop("retries", 0)
+        self.keep_separate = kwargs.pop("keep_separate", False)
+        self.tables = tuple(tuple(table) for table in kwargs.pop("tables", ()))
         assert not kwargs
 
+    def with_tables(self, tables: Collection[Tuple[str, str]]) -> Optional["TransactionOfStatements"]:
+        """
+        Returns the transaction with its statements listing only those of its tables which are passed,
+        or None if there are none left.
+        """
+        remaining = [table for table in self.tables if table in set(tables)]
+        if not remaining:
+            return None
+        listed, replacement = quote_tables(self.tables), quote_tables(remaining)
+        return TransactionOfStatements(
+            *(
+                TextStatement(stmt.query.replace(listed, replacement), *stmt.params, database=stmt.database)
+                for stmt in self.statements
+            ),
+            database=self.database, lock_timeout=self.lock_timeout, retries=self.retries,
+            keep_separate=self.keep_separate, tables=remaining,
+        )
+
 
 class TextStatement(Statement):
+    __slots__ = ("query", "params", "database")
+
     def __init__(self, query: str, *params, **kwargs):
         """
         Pass database= when the statement should be executed while connected to a particular database.
@@ -50,6 +96,8 @@ class TextStatement(Statement):
 
 
 class CreateStatement(Statement):
+    __slots__ = ("obj", "params", "database")
+
     def __init__(self, obj: Union["Database", "Role", "Schema"], *params, **kwargs):
         self.obj = obj
         self.params = params or ()
@@ -61,6 +109,8 @@ class CreateStatement(Statement):
 
 
 class DropStatement(Statement):
+    __slots__ = ("obj", "params", "database")
+
     def __init__(self, obj: Union["Database", "Role", "Schema"], *params, **kwargs):
         self.obj = obj
         self.params = params or ()
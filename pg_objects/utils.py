@@ -9,3 +9,25 @@ def generate_password(length=24) -> str:
 
 def get_password_md5(username, password) -> str:
     return "md5" + hashlib.md5(f"{password}{username}".encode()).hexdigest()
+
+
+def get_password_digest(password_hash: str) -> str:
+    """
+    Returns a digest of a password hash as stored in pg_authid. Unlike an md5 hash,
+    the digest cannot be used to log in, so it can be kept in state snapshots.
+    """
+    return hashlib.sha256(password_hash.encode()).hexdigest()
+
+
+def quote_ident(name: str) -> str:
+    """
+    Quotes an identifier (such as a table name) for use in a query.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_tables(tables) -> str:
+    """
+    Returns a comma-separated list of the (schema, table) pairs, qualified and quoted.
+    """
+    return ", ".join(f"{quote_ident(schema)}.{quote_ident(table)}" for schema, table in tables)
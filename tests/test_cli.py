@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from pg_objects.cli import pg_objects_cli
+from pg_objects.snapshot import save_snapshot
+from tests.test_state import make_cluster_snapshot
+
+
+def run_check(*args) -> int:
+    with pytest.raises(SystemExit) as exc_info:
+        pg_objects_cli.run(list(args))
+    return exc_info.value.code
+
+
+def test_check_counts_each_drifted_object_once(tmp_path):
+    state_path = str(tmp_path / "cluster.json")
+    output_path = str(tmp_path / "drift.json")
+    save_snapshot(make_cluster_snapshot(), state_path)
+    definition = json.dumps([{"type": "Group", "name": "readers"}, {"type": "Database", "name": "new"}])
+
+    assert run_check("--state", state_path, "check", definition, "--output", output_path) == 1
+    with open(output_path) as f:
+        report = json.load(f)
+    assert report["objects"]["create"] == report["objects"]["maintain"] == ["Database(new)"]
+    assert report["drifted"] == 1
+
+
+def test_check_exits_with_2_when_it_fails(tmp_path):
+    assert run_check("--state", str(tmp_path / "missing.json"), "check", "[]") == 2
+    assert run_check("--state", str(tmp_path / "missing.json"), "check", "not a definition") == 2
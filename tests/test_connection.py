@@ -0,0 +1,84 @@
+from unittest import mock
+
+import psycopg2.extensions
+
+from pg_objects.connection import Connection
+from pg_objects.objects.base import ConnectionManager
+
+
+def fake_connect(dsn):
+    conn = mock.Mock(closed=0)
+    conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    return conn
+
+
+@mock.patch("psycopg2.connect", side_effect=fake_connect)
+def test_connection_is_reused(connect):
+    conn = Connection(username="postgres", database="postgres")
+    conn.execute("SELECT 1")
+    conn.execute("SELECT 2")
+    with conn.begin() as tx:
+        tx.execute("SELECT 3")
+    assert conn.autocommit is True
+    assert connect.call_count == 1
+    assert conn.connect_count == 1
+    assert conn.query_count == 3
+
+
+@mock.patch("psycopg2.connect", side_effect=fake_connect)
+def test_broken_connection_is_replaced(connect):
+    conn = Connection(username="postgres", database="postgres")
+    first = conn.connection
+    first.closed = 2
+    assert not conn.is_healthy()
+
+    second = conn.connection
+    assert second is not first
+    assert conn.connect_count == 2
+    assert conn.connection is second
+
+
+def test_connection_manager_evicts_least_recently_used():
+    master = mock.Mock(database="postgres")
+    master.clone.side_effect = lambda database: mock.Mock(database=database)
+    cm = ConnectionManager(master_connection=master, max_connections=2)
+
+    a = cm.get_connection("a")
+    cm.get_connection("b")
+    assert cm.get_connection("a") is a
+    cm.get_connection("c")
+
+    assert cm.get_connection(None) is master
+    assert cm.stats == {"open": 2, "hits": 1, "misses": 3, "evictions": 1}
+    assert cm.get_connection("a") is a
+    assert cm.misses == 3
+
+
+def test_connection_manager_does_not_evict_connections_in_use():
+    master = mock.Mock(database="postgres")
+    master.clone.side_effect = lambda database: mock.Mock(database=database)
+    cm = ConnectionManager(master_connection=master, max_connections=1)
+
+    with cm.using("a") as a:
+        cm.get_connection("b")
+        assert cm.get_connection("a") is a
+    cm.get_connection("c")
+    assert cm.stats["open"] == 1
+
+
+def test_connection_manager_closes_idle_connection_behind_long_held_one(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+    master = mock.Mock(database="postgres")
+    master.clone.side_effect = lambda database: mock.Mock(database=database)
+    cm = ConnectionManager(master_connection=master, idle_timeout=10)
+
+    with cm.using("a"):
+        now[0] = 1
+        cm.get_connection("b")
+        now[0] = 20
+    now[0] = 25
+    cm.get_connection("c")
+
+    assert list(cm._managed_connections) == ["a", "c"]
+    assert cm.stats["evictions"] == 1
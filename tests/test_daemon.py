@@ -0,0 +1,76 @@
+import json
+import threading
+from unittest import mock
+
+from pg_objects.daemon import Daemon, send_definition
+from pg_objects.objects.base import ConnectionManager
+from pg_objects.plan import Plan
+from pg_objects.setup import Setup
+from tests.test_executor import FakeConnection
+
+DEFINITION = json.dumps({"objects": [{"type": "Group", "name": "devops"}]})
+
+
+class FakeListener:
+    def __init__(self):
+        self.payloads = []
+        self.lost = False
+
+    def get_notifications(self):
+        if self.lost:
+            raise ConnectionError("lost")
+        payloads, self.payloads = self.payloads, []
+        return payloads
+
+    def close(self):
+        pass
+
+
+def make_daemon() -> Daemon:
+    return Daemon(connection_manager=ConnectionManager(master_connection=FakeConnection("postgres", [])))
+
+
+@mock.patch.object(Setup, "execute_plan")
+@mock.patch.object(Setup, "plan", return_value=Plan(statements=[]))
+def test_setup_is_reused_and_notified_databases_are_reloaded(plan, execute_plan):
+    daemon = make_daemon()
+    listeners = {"db0": FakeListener(), "db1": FakeListener(), "db2": FakeListener()}
+    daemon._listeners = dict(listeners)
+
+    assert daemon.reconcile(DEFINITION) == {"status": "ok", "statements": 0}
+    setup = daemon.get_setup(DEFINITION)
+    assert daemon.state_cache.unchanged_databases == {"db0", "db1", "db2"}
+
+    listeners["db0"].payloads.append("db0")
+    listeners["db2"].lost = True
+    daemon.process_notifications()
+    assert daemon.state_cache.unchanged_databases == {"db1"}
+    assert set(daemon._listeners) == {"db0", "db1"}
+
+    daemon.reconcile(DEFINITION)
+    assert daemon.get_setup(DEFINITION) is setup
+    assert daemon.get_setup(DEFINITION.replace("devops", "ops")) is not setup
+    assert execute_plan.call_count == 2
+
+
+def test_definitions_are_sent_over_unix_socket(tmp_path):
+    daemon = make_daemon()
+    socket_path = str(tmp_path / "pg_objects.sock")
+    server = daemon.make_server(socket_path)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01})
+    thread.start()
+    try:
+        with mock.patch.object(Daemon, "reconcile", return_value={"status": "ok", "statements": 3}) as reconcile:
+            with open(tmp_path / "definition.json", "w") as f:
+                f.write(DEFINITION)
+            with open(tmp_path / "definition.json") as f:
+                assert send_definition(socket_path, f, dry_run=True) == {"status": "ok", "statements": 3}
+        assert reconcile.call_args == mock.call(DEFINITION, dry_run=True)
+
+        with mock.patch.object(Daemon, "reconcile", side_effect=ValueError("bad definition")):
+            with open(tmp_path / "definition.json") as f:
+                assert send_definition(socket_path, f) == {"status": "error", "error": "bad definition"}
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,43 @@
+import io
+import json
+from unittest import mock
+
+import pytest
+
+from pg_objects.definition import iter_definition, open_definition
+from pg_objects.setup import Setup
+
+OBJECTS = [
+    {"type": "Group", "name": "devops"},
+    {"type": "User", "name": "johnny", "groups": ["devops"], "password": "x" * 100},
+    {"type": "Database", "name": "db", "owner": "devops"},
+    {"type": "DatabasePrivilege", "database": "db", "grantee": "devops", "privileges": ["CONNECT"]},
+]
+
+
+@pytest.mark.parametrize("text", [
+    json.dumps({"objects": OBJECTS}),
+    json.dumps({"version": 1.25, "objects": OBJECTS, "extra": [1, 2]}, indent=2),
+    json.dumps(OBJECTS),
+    "\n".join(json.dumps(obj) for obj in OBJECTS) + "\n",
+])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+def test_definition_formats(text, chunk_size):
+    assert list(iter_definition(io.StringIO(text), chunk_size=chunk_size)) == OBJECTS
+
+
+def test_invalid_definition():
+    with pytest.raises(ValueError):
+        list(iter_definition(io.StringIO('{"objects": [{"type": "Group", "name": "x"}')))
+    with pytest.raises(ValueError):
+        list(iter_definition(io.StringIO('"objects"')))
+
+
+def test_setup_from_stream(tmp_path):
+    path = tmp_path / "definition.ndjson"
+    path.write_text("\n".join(json.dumps(obj) for obj in OBJECTS))
+    with open_definition(str(path)) as stream:
+        setup = Setup.from_stream(stream, master_connection=mock.Mock())
+    assert "DatabasePrivilege(devops@db:CONNECT)" in setup
+    with open_definition(json.dumps({"objects": OBJECTS})) as stream:
+        assert len(list(iter_definition(stream))) == len(OBJECTS)
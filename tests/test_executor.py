@@ -0,0 +1,305 @@
+import contextlib
+import threading
+from unittest import mock
+
+import pytest
+
+from pg_objects.executor import ExecutionError, Executor
+from pg_objects.objects.base import ConnectionManager
+from pg_objects.objects.database import Database
+from pg_objects.objects.schema import SchemaTablesPrivilege
+from pg_objects.setup import Setup
+from pg_objects.statements import CreateStatement, TextStatement, TransactionOfStatements
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeConnection:
+    database_error_cls = FakeError
+    username = "postgres"
+
+    def __init__(self, database, log):
+        self.database = database
+        self.log = log
+
+    def clone(self, database):
+        return FakeConnection(database, self.log)
+
+    def _run(self, query):
+        if "FAIL" in query or "FAIL" in self.database:
+            raise FakeError(query)
+        self.log.append((self.database, query))
+
+    def execute(self, query, *params):
+        self._run(query)
+
+    def execute_batch(self, queries):
+        if any("FAIL" in query for query, params in queries):
+            raise FakeError("batch")
+        self.log.append((self.database, [query for query, params in queries]))
+
+    @contextlib.contextmanager
+    def begin(self):
+        self.log.append((self.database, "BEGIN"))
+        try:
+            yield self
+        except FakeError:
+            self.log.append((self.database, "ROLLBACK"))
+            raise
+        self.log.append((self.database, "COMMIT"))
+
+    def is_healthy(self):
+        return True
+
+    def log_query(self, query, dry_run=False, database=None):
+        self.log.append(("DRY-RUN", database, query))
+
+    def close(self):
+        pass
+
+
+def make_executor(**kwargs):
+    log = []
+    cm = ConnectionManager(master_connection=FakeConnection("postgres", log))
+    return Executor(connection_manager=cm, databases=["a", "b"], **kwargs), log
+
+
+def test_all_databases_statements_are_repeated_for_each_database():
+    executor, log = make_executor()
+    executor.execute([
+        TextStatement("CREATE ROLE r"),
+        TextStatement("REASSIGN OWNED BY r TO postgres", database=TextStatement.ALL_DATABASES),
+    ])
+    assert log == [
+        ("postgres", "CREATE ROLE r"),
+        ("a", "REASSIGN OWNED BY r TO postgres"),
+        ("b", "REASSIGN OWNED BY r TO postgres"),
+    ]
+
+
+def test_batches_are_split_by_database_and_non_transactional_statements():
+    executor, log = make_executor(batch_size=3)
+    executor.execute([
+        TextStatement("CREATE ROLE r1"),
+        TextStatement("CREATE ROLE r2"),
+        CreateStatement(Database("d")),
+        TransactionOfStatements(TextStatement("GRANT 1", database="d"), TextStatement("GRANT 2", database="d"), database="d"),
+        TextStatement("GRANT 3", database="d"),
+        TextStatement("GRANT 4", database="d"),
+    ])
+    assert log == [
+        ("postgres", ["CREATE ROLE r1", "CREATE ROLE r2"]),
+        ("postgres", "CREATE DATABASE d"),
+        ("d", ["GRANT 1", "GRANT 2", "GRANT 3"]),
+        ("d", "GRANT 4"),
+    ]
+
+
+def test_failed_batch_is_replayed_one_by_one():
+    executor, log = make_executor(batch_size=10)
+    with pytest.raises(FakeError) as exc_info:
+        executor.execute([
+            TextStatement("GRANT 1", database="a"),
+            TextStatement("GRANT FAIL", database="a"),
+            TextStatement("GRANT 3", database="a"),
+        ])
+    assert str(exc_info.value) == "GRANT FAIL"
+    assert log == [("a", "GRANT 1")]
+
+
+def test_concurrent_execution_runs_database_streams_between_cluster_level_statements():
+    executor, log = make_executor(concurrency=4)
+    executor.execute_concurrently(
+        statements=[
+            TextStatement("CREATE ROLE r"),
+            TextStatement("GRANT a1", database="a"),
+            TextStatement("GRANT b1", database="b"),
+            TextStatement("ALTER USER r"),
+            TextStatement("GRANT a2", database="a"),
+        ],
+        drop_statements=[
+            TextStatement("REASSIGN OWNED BY x TO postgres", database=TextStatement.ALL_DATABASES),
+            TextStatement("DROP ROLE x"),
+        ],
+    )
+    assert log[:2] == [("postgres", "CREATE ROLE r"), ("postgres", "ALTER USER r")]
+    assert log[-1] == ("postgres", "DROP ROLE x")
+    assert [q for d, q in log if d == "a"] == ["GRANT a1", "GRANT a2", "REASSIGN OWNED BY x TO postgres"]
+    assert [q for d, q in log if d == "b"] == ["GRANT b1", "REASSIGN OWNED BY x TO postgres"]
+
+
+def test_concurrent_execution_reports_failures_of_all_databases():
+    executor, log = make_executor(concurrency=2)
+    with pytest.raises(ExecutionError) as exc_info:
+        executor.execute_concurrently(
+            statements=[
+                TextStatement("GRANT FAIL", database="a"),
+                TextStatement("GRANT b1", database="b"),
+            ],
+            drop_statements=[TextStatement("DROP ROLE x")],
+        )
+    assert set(exc_info.value.failures) == {"a"}
+    assert log == [("b", "GRANT b1")]
+
+
+def test_all_databases_statements_fail_per_database():
+    executor, log = make_executor(concurrency=2)
+    executor.databases = ["a", "FAIL", "b"]
+    with pytest.raises(ExecutionError) as exc_info:
+        executor.execute([
+            TextStatement("REASSIGN OWNED BY r TO postgres", database=TextStatement.ALL_DATABASES),
+            TextStatement("DROP ROLE r"),
+        ])
+    assert set(exc_info.value.failures) == {"FAIL"}
+    assert sorted(log) == [("a", "REASSIGN OWNED BY r TO postgres"), ("b", "REASSIGN OWNED BY r TO postgres")]
+
+
+def test_single_transaction_per_database():
+    executor, log = make_executor(single_transaction=True, commit_every=2)
+    executor.execute_concurrently(
+        statements=[
+            TextStatement("CREATE ROLE r"),
+            CreateStatement(Database("d")),
+            TextStatement("ALTER DATABASE d OWNER TO r"),
+            TextStatement("GRANT 1", database="d"),
+            TextStatement("GRANT 2", database="d"),
+            TextStatement("GRANT 3", database="d"),
+        ],
+        drop_statements=[],
+    )
+    assert log == [
+        ("postgres", "BEGIN"), ("postgres", "CREATE ROLE r"), ("postgres", "COMMIT"),
+        ("postgres", "CREATE DATABASE d"),
+        ("postgres", "BEGIN"), ("postgres", "ALTER DATABASE d OWNER TO r"), ("postgres", "COMMIT"),
+        ("d", "BEGIN"), ("d", "GRANT 1"), ("d", "GRANT 2"), ("d", "COMMIT"),
+        ("d", "BEGIN"), ("d", "GRANT 3"), ("d", "COMMIT"),
+    ]
+
+
+class LockNotAvailable(FakeError):
+    pgcode = "55P03"
+
+
+def test_transaction_with_lock_timeout_is_retried_with_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("time.sleep", sleeps.append)
+    executor, log = make_executor(batch_size=10)
+
+    connection = executor.get_connection("a")
+    execute = connection.execute
+    failures = [LockNotAvailable("GRANT"), LockNotAvailable("GRANT")]
+
+    def execute_or_time_out(query, *params):
+        if query.startswith("GRANT") and failures:
+            raise failures.pop()
+        execute(query, *params)
+
+    connection.execute = execute_or_time_out
+    executor.execute([
+        TextStatement("COMMENT", database="a"),
+        TransactionOfStatements(TextStatement("GRANT", database="a"), database="a", lock_timeout="2s", retries=3),
+        TextStatement("COMMENT", database="a"),
+    ])
+
+    assert sleeps == [0.5, 1.0]
+    assert log == [
+        ("a", "COMMENT"),
+        ("a", "BEGIN"), ("a", "SET LOCAL lock_timeout = %s"), ("a", "ROLLBACK"),
+        ("a", "BEGIN"), ("a", "SET LOCAL lock_timeout = %s"), ("a", "ROLLBACK"),
+        ("a", "BEGIN"), ("a", "SET LOCAL lock_timeout = %s"), ("a", "GRANT"), ("a", "COMMIT"),
+        ("a", "COMMENT"),
+    ]
+
+    failures.extend([LockNotAvailable("GRANT")] * 2)
+    with pytest.raises(LockNotAvailable):
+        executor.execute([
+            TransactionOfStatements(TextStatement("GRANT", database="a"), database="a", lock_timeout="2s", retries=1),
+        ])
+
+
+def test_table_chunks_are_not_batched_together():
+    setup = Setup(master_connection=mock.Mock(), table_chunk_size=2)
+    setup.get_schema_tables = mock.Mock(return_value=["a", "b", "c"])
+    setup.group(name="rol")
+    stp = SchemaTablesPrivilege(database="a", schema="sch", grantee="rol", privileges="SELECT", setup=setup)
+
+    executor, log = make_executor(batch_size=10)
+    executor.execute([TextStatement("COMMENT 1", database="a"), *stp.stmts_to_create(), TextStatement("COMMENT 2", database="a")])
+    assert [" ".join(q.split()) for d, q in log] == [
+        "COMMENT 1",
+        "BEGIN", 'REVOKE ALL ON TABLE "sch"."a", "sch"."b" FROM rol', 'GRANT SELECT ON TABLE "sch"."a", "sch"."b" TO rol', "COMMIT",
+        "BEGIN", 'REVOKE ALL ON TABLE "sch"."c" FROM rol', 'GRANT SELECT ON TABLE "sch"."c" TO rol', "COMMIT",
+        "COMMENT 2",
+    ]
+
+
+class UndefinedTable(FakeError):
+    pgcode = "42P01"
+
+
+def test_chunk_with_dropped_tables_is_retried_without_them():
+    setup = Setup(master_connection=mock.Mock(), table_chunk_size=2)
+    setup.get_schema_tables = mock.Mock(return_value=["a", "b", "c", "d", "e"])
+    setup.group(name="rol")
+    stp = SchemaTablesPrivilege(database="a", schema="sch", grantee="rol", privileges="SELECT", setup=setup)
+
+    executor, log = make_executor()
+    connection = executor.get_connection("a")
+    execute = connection.execute
+
+    def execute_without_dropped_tables(query, *params):
+        if "pg_class" in query:
+            result = mock.Mock()
+            result.get_all.return_value = [
+                {"nspname": "sch", "relname": table} for table in params[1] if table not in ("c", "e")
+            ]
+            return result
+        if '"sch"."c"' in query or '"sch"."e"' in query:
+            raise UndefinedTable('relation "sch.c" does not exist')
+        execute(query, *params)
+
+    connection.execute = execute_without_dropped_tables
+    executor.execute(stp.stmts_to_create())
+    assert [" ".join(q.split()) for d, q in log] == [
+        "BEGIN", 'REVOKE ALL ON TABLE "sch"."a", "sch"."b" FROM rol', 'GRANT SELECT ON TABLE "sch"."a", "sch"."b" TO rol', "COMMIT",
+        "BEGIN", "ROLLBACK",
+        "BEGIN", 'REVOKE ALL ON TABLE "sch"."d" FROM rol', 'GRANT SELECT ON TABLE "sch"."d" TO rol', "COMMIT",
+        "BEGIN", "ROLLBACK",
+    ]
+
+    log.clear()
+    executor.execute(stp.stmts_to_drop())
+    assert [" ".join(q.split()) for d, q in log] == [
+        "BEGIN", 'REVOKE SELECT ON TABLE "sch"."a", "sch"."b" FROM rol', "COMMIT",
+        "BEGIN", "ROLLBACK",
+        "BEGIN", 'REVOKE SELECT ON TABLE "sch"."d" FROM rol', "COMMIT",
+        "BEGIN", "ROLLBACK",
+    ]
+
+
+def test_connection_in_use_is_not_evicted_by_another_thread():
+    executor, log = make_executor()
+    executor.connection_manager.max_connections = 1
+    connection = executor.get_connection("a")
+    execute = connection.execute
+    closed = []
+    connection.close = lambda: closed.append(connection.database)
+    started, release = threading.Event(), threading.Event()
+
+    def execute_slowly(query, *params):
+        started.set()
+        release.wait(5)
+        execute(query, *params)
+
+    connection.execute = execute_slowly
+    thread = threading.Thread(target=executor.execute_statement, args=("a", TextStatement("GRANT 1", database="a")))
+    thread.start()
+    assert started.wait(5)
+    executor.execute_statement("b", TextStatement("GRANT 2", database="b"))
+    release.set()
+    thread.join()
+
+    assert closed == []
+    assert log == [("b", "GRANT 2"), ("a", "GRANT 1")]
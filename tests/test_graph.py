@@ -0,0 +1,50 @@
+import pytest
+
+from pg_objects.graph import Graph, GraphCycleError, graph_definition_example1, graph_definition_example2
+
+
+def test_topological_order_is_deterministic():
+    for g in (graph_definition_example1(), graph_definition_example2()):
+        assert [v.value for v in g.topological_sort_by_kahn()] == ["b", "a", "c", "d", "e"]
+
+    g = Graph()
+    for value in ["x", "y", "z"]:
+        g.new_vertex(value)
+    assert [v.value for v in g.topological_sort_by_kahn()] == ["x", "y", "z"]
+    assert [v.value for v in Graph().topological_sort_by_kahn()] == []
+
+
+def test_vertices_and_edges():
+    g = Graph.from_edge_list(("a", "b"), ("a", "b"), ("c", "b"))
+    assert g.new_vertex("a") is g["a"]
+    assert len(g) == 3
+    assert g["b"].dependants == {g["a"], g["c"]}
+    assert g["a"].dependencies == {g["b"]}
+
+    g.remove_edge(g["a"], g["b"])
+    assert g["a"].dependencies == set()
+    assert [v.value for v in g.topological_sort_by_kahn()] == ["a", "b", "c"]
+
+
+def test_cycles_are_reported():
+    g = Graph.from_edge_list(("a", "b"), ("b", "c"), ("c", "a"), ("d", "a"), ("e", "e"), ("f", "g"))
+    with pytest.raises(GraphCycleError) as exc_info:
+        g.topological_sort_by_kahn()
+    assert exc_info.value.cycles == [["a", "b", "c", "a"], ["e", "e"]]
+    assert isinstance(exc_info.value, ValueError)
+
+
+def test_long_chain():
+    n = 100_000
+    g = Graph()
+    for i in range(n):
+        g.new_vertex(i)
+    for i in range(1, n):
+        g.add_edge(i - 1, i)
+    assert [v.value for v in g.topological_sort_by_kahn()] == list(range(n - 1, -1, -1))
+
+    g.add_edge(n - 1, 0)
+    with pytest.raises(GraphCycleError) as exc_info:
+        g.topological_sort_by_kahn()
+    cycle, = exc_info.value.cycles
+    assert len(cycle) == n + 1
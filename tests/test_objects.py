@@ -1,8 +1,12 @@
 from unittest import mock
 
+import pytest
+
+from pg_objects.graph import Graph
 from pg_objects.objects.database import DatabasePrivilege
 from pg_objects.objects.default_privilege import DefaultPrivilege, DefaultPrivilegeReady
 from pg_objects.objects.schema import SchemaTablesPrivilege
+from pg_objects.privileges import mask_to_keywords
 from pg_objects.setup import Setup
 
 
@@ -21,16 +25,21 @@ def test_simple_setup():
 
 def test_database_privilege():
     dp = DatabasePrivilege("db", "rol", privileges="ALL")
-    assert dp.privileges == DatabasePrivilege.ALL == {"CONNECT", "CREATE", "TEMPORARY"}
+    assert dp.privileges == DatabasePrivilege.ALL
+    assert set(mask_to_keywords(dp.privileges)) == {"CONNECT", "CREATE", "TEMPORARY"}
 
     dp = DatabasePrivilege("db", "rol", privileges="CONNECT")
-    assert dp.privileges == {"CONNECT"}
+    assert mask_to_keywords(dp.privileges) == ("CONNECT",)
 
     dp = DatabasePrivilege("db", "rol", privileges=["CONNECT", "TEMPORARY"])
-    assert dp.privileges == {"CONNECT", "TEMPORARY"}
+    assert set(mask_to_keywords(dp.privileges)) == {"CONNECT", "TEMPORARY"}
 
     dp = DatabasePrivilege("db", "rol", privileges=["CONNECT", "TEMP"])
-    assert dp.privileges == {"CONNECT", "TEMPORARY"}
+    assert set(mask_to_keywords(dp.privileges)) == {"CONNECT", "TEMPORARY"}
+    assert dp.key == "DatabasePrivilege(rol@db:CONNECT,TEMPORARY)"
+
+    with pytest.raises(ValueError):
+        DatabasePrivilege("db", "rol", privileges="SELECT")
 
 
 def test_default_privilege_example():
@@ -59,3 +68,80 @@ def test_default_privilege_example():
         )
     )
     assert dp == dp2
+
+
+def test_schema_tables_privilege_in_chunks():
+    setup = Setup(master_connection=mock.Mock(), table_chunk_size=2, lock_timeout="1s", lock_retries=5)
+    setup.get_schema_tables = mock.Mock(return_value=["c", "a", 'Quoted"Name'])
+    setup.group(name="rol")
+    stp = SchemaTablesPrivilege(database="db", schema="sch", grantee="rol", privileges="SELECT", setup=setup)
+
+    transactions = list(stp.stmts_to_create())
+    assert len(transactions) == 2
+    assert [t.lock_timeout for t in transactions] == ["1s", "1s"]
+    assert [t.retries for t in transactions] == [5, 5]
+    revoke, grant = transactions[0].statements
+    assert 'REVOKE ALL ON TABLE "sch"."Quoted""Name", "sch"."a"' in " ".join(revoke.query.split())
+    assert 'GRANT SELECT ON TABLE "sch"."c" TO rol' in " ".join(transactions[1].statements[1].query.split())
+
+    setup.table_chunk_size = None
+    transaction, = stp.stmts_to_create()
+    assert "ON ALL TABLES IN SCHEMA sch" in " ".join(transaction.statements[0].query.split())
+
+
+def test_privileges_are_updated_by_delta():
+    setup = Setup(master_connection=mock.Mock())
+    setup.group(name="rol")
+    setup.database("db")
+    dp = setup.database_privilege(database="db", grantee="rol", privileges=["CONNECT", "CREATE"])
+    setup.get_current_privileges = mock.Mock(return_value=DatabasePrivilege.CONNECT | DatabasePrivilege.TEMPORARY)
+
+    transaction, = dp.stmts_to_update()
+    assert [s.query for s in transaction.statements] == [
+        "REVOKE TEMPORARY ON DATABASE db FROM rol",
+        "GRANT CREATE ON DATABASE db TO rol",
+    ]
+
+    stp = SchemaTablesPrivilege(database="db", schema="sch", grantee="rol", privileges="SELECT", setup=setup)
+    setup.get_drifted_tables = mock.Mock(return_value={
+        "b": 0,
+        "a": 0,
+        "c": SchemaTablesPrivilege.SELECT | SchemaTablesPrivilege.INSERT,
+    })
+    grant, revoke = stp.stmts_to_update()
+    assert [s.query for s in grant.statements] == ['GRANT SELECT ON TABLE "sch"."a", "sch"."b" TO rol']
+    assert [s.query for s in revoke.statements] == ['REVOKE INSERT ON TABLE "sch"."c" FROM rol']
+    assert {grant.database, revoke.database} == {"db"}
+
+
+def test_object_graph_is_maintained_on_register():
+    setup = Setup(master_connection=mock.Mock())
+    setup.group(name="devops")
+    setup.database("db", owner="devops")
+
+    graph = setup.generate_graph()
+    with mock.patch.object(Graph, "topological_sort_by_kahn", wraps=graph.topological_sort_by_kahn) as sort:
+        order = setup.topological_order()
+        assert setup.topological_order() == order
+        assert sort.call_count == 1
+
+        setup.schema("sch", database="db", owner="devops")
+        new_order = setup.topological_order()
+        assert sort.call_count == 2
+
+    keys = [obj.key for obj in new_order]
+    assert keys.index("Database(db)") < keys.index("DatabaseOwner(db+devops)")
+    assert keys.index("Schema(db.sch)") < keys.index("SchemaOwner(db.sch+devops)")
+
+
+def test_objects_use_slots_and_cache_keys():
+    stp = SchemaTablesPrivilege(database="db", schema="sch", grantee="rol", privileges="SELECT")
+    assert not hasattr(stp, "__dict__")
+    assert stp.key is stp.key
+    assert stp == SchemaTablesPrivilege(database="db", schema="sch", grantee="rol", privileges=["SELECT"])
+
+    setup = Setup(master_connection=mock.Mock())
+    setup.database("db")
+    setup.group(name="rol")
+    dp = setup.database_privilege(database="db", grantee="rol", privileges="CONNECT")
+    assert {id(dep) for dep in dp.dependencies} == {id(setup.get("Database(db)")), id(setup.get("Group(rol)"))}
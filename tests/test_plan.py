@@ -0,0 +1,72 @@
+from unittest import mock
+
+import pytest
+
+from pg_objects.objects.database import Database
+from pg_objects.plan import Plan, StalePlanError
+from pg_objects.setup import Setup
+from pg_objects.state import State
+from pg_objects.statements import CreateStatement, DropStatement, TextStatement, TransactionOfStatements
+from tests.test_executor import FakeConnection
+
+
+def make_plan() -> Plan:
+    return Plan(
+        statements=[
+            CreateStatement(Database("app")),
+            TextStatement("GRANT CONNECT ON DATABASE app TO readers"),
+            TransactionOfStatements(
+                TextStatement("GRANT SELECT ON reports.a, reports.b TO readers", database="app"),
+                database="app", lock_timeout="2s", retries=3,
+            ),
+        ],
+        drop_statements=[
+            TextStatement("REVOKE ALL ON SCHEMA public FROM public", database=TextStatement.ALL_DATABASES),
+            DropStatement(Database("old")),
+        ],
+        databases=["app"],
+        fingerprints={"cluster": "c", "databases": {"app": "a"}},
+    )
+
+
+def test_plan_is_saved_and_loaded(tmp_path):
+    path = str(tmp_path / "plan.json.gz")
+    make_plan().save(path)
+    plan = Plan.load(path)
+
+    assert len(plan) == 5
+    assert plan.to_dict() == make_plan().to_dict()
+    assert isinstance(plan.statements[0], CreateStatement) and plan.statements[0].obj == Database("app")
+    assert isinstance(plan.drop_statements[1], DropStatement)
+    transaction = plan.statements[2]
+    assert (transaction.database, transaction.lock_timeout, transaction.retries) == ("app", "2s", 3)
+    assert plan.drop_statements[0].is_on_all_databases
+
+
+def test_plan_is_executed_only_against_the_state_it_was_created_against():
+    log = []
+    setup = Setup(master_connection=FakeConnection("postgres", log))
+    plan = make_plan()
+
+    with mock.patch.object(State, "fetch_cluster_fingerprint", return_value="c"), \
+            mock.patch.object(State, "fetch_database_fingerprints", return_value={"app": "changed"}):
+        with pytest.raises(StalePlanError):
+            setup.execute_plan(plan)
+    assert log == []
+
+    with mock.patch.object(State, "fetch_cluster_fingerprint", return_value="c"), \
+            mock.patch.object(State, "fetch_database_fingerprints", return_value={"app": "a"}):
+        setup.execute_plan(plan)
+    assert log == [
+        ("postgres", "CREATE DATABASE app"),
+        ("postgres", "GRANT CONNECT ON DATABASE app TO readers"),
+        ("app", "BEGIN"),
+        ("app", "SET LOCAL lock_timeout = %s"),
+        ("app", "GRANT SELECT ON reports.a, reports.b TO readers"),
+        ("app", "COMMIT"),
+        ("app", "REVOKE ALL ON SCHEMA public FROM public"),
+        ("postgres", "DROP DATABASE old"),
+    ]
+
+    with pytest.raises(StalePlanError):
+        setup.execute_plan(Plan(statements=[]))
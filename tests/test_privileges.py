@@ -0,0 +1,22 @@
+from pg_objects.privileges import (
+    ACL_CONNECT, ACL_SELECT, ACL_TEMPORARY, acl_to_mask, diff_privileges, keywords_to_mask, mask_to_acl,
+    mask_to_keywords,
+)
+
+
+def test_acl_conversions():
+    assert acl_to_mask("Tc") == ACL_CONNECT | ACL_TEMPORARY
+    assert acl_to_mask("r*") == ACL_SELECT
+    assert mask_to_acl(acl_to_mask("arwdDxt")) == "arwdDxt"
+    assert acl_to_mask("") == 0
+
+
+def test_keyword_conversions():
+    assert keywords_to_mask(["CONNECT", "temp"]) == ACL_CONNECT | ACL_TEMPORARY
+    assert mask_to_keywords(ACL_TEMPORARY | ACL_CONNECT) == ("TEMPORARY", "CONNECT")
+    assert mask_to_keywords(keywords_to_mask(["SELECT", "INSERT"])) == ("INSERT", "SELECT")
+
+
+def test_diff_privileges():
+    assert diff_privileges(ACL_CONNECT | ACL_TEMPORARY, ACL_CONNECT | ACL_SELECT) == (ACL_SELECT, ACL_TEMPORARY)
+    assert diff_privileges(ACL_CONNECT, ACL_CONNECT) == (0, 0)
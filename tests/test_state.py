@@ -0,0 +1,299 @@
+import json
+import logging
+from unittest import mock
+
+import pytest
+
+from pg_objects.objects.base import ConnectionManager, ObjectState
+from pg_objects.objects.database import Database
+from pg_objects.objects.role import UNKNOWN_PASSWORD, User
+from pg_objects.objects.default_privilege import DefaultPrivilege
+from pg_objects.objects.schema import SchemaTablesPrivilege
+from pg_objects.setup import Setup
+from pg_objects.snapshot import load_snapshot, save_snapshot
+from pg_objects.state import State
+from pg_objects.utils import get_password_digest, get_password_md5
+
+
+def make_state(rows_by_database, **kwargs) -> State:
+    def clone(database):
+        conn = mock.Mock(database=database)
+        conn.execute.return_value.get_all.side_effect = lambda *columns: iter(rows_by_database[database])
+        return conn
+
+    master = mock.Mock(database="postgres", username="postgres")
+    master.clone.side_effect = clone
+    state = State(connection_manager=ConnectionManager(master_connection=master), **kwargs)
+    state._dsp_databases = {datname: {"name": datname} for datname in rows_by_database}
+    return state
+
+
+def test_load_schemas_concurrently():
+    rows_by_database = {
+        f"db{i}": [{"name": f"schema{i}", "owner": "postgres"}, {"name": "public", "owner": "postgres"}]
+        for i in range(10)
+    }
+    state = make_state(rows_by_database, concurrency=4)
+    state.load_schemas()
+
+    assert list(state.schemas) == list(rows_by_database)
+    assert set(state.schemas["db3"]) == {"schema3", "public"}
+    assert state.connection_manager.stats["misses"] == 10
+
+
+def test_load_all_runs_only_needed_loaders():
+    state = make_state({}, object_types={"User", "Group"})
+    with mock.patch.object(State, "load_groups_and_users") as load_groups_and_users, \
+            mock.patch.object(State, "load_role_attributes") as load_role_attributes, \
+            mock.patch.object(State, "load_schemas") as load_schemas, \
+            mock.patch.object(State, "load_database_privileges") as load_database_privileges:
+        state.load_all()
+    load_groups_and_users.assert_called_once_with()
+    load_role_attributes.assert_called_once_with()
+    load_schemas.assert_not_called()
+    load_database_privileges.assert_not_called()
+
+
+def test_load_schemas_of_managed_databases_only():
+    rows_by_database = {"a": [{"name": "s", "owner": "postgres"}], "b": [{"name": "s", "owner": "postgres"}]}
+    state = make_state(rows_by_database, databases=["b"])
+    state.load_schemas()
+    assert list(state.schemas) == ["b"]
+
+
+def test_schema_tables_privileges_are_grouped_by_privileges():
+    rows_by_database = {
+        "db": [
+            {"schema": "sch", "grantee": "readers", "privileges": "SELECT", "tables": ["a", "b"]},
+            {"schema": "sch", "grantee": "writers", "privileges": "INSERT,SELECT", "tables": ["a"]},
+            {"schema": "sch", "grantee": "writers", "privileges": "SELECT", "tables": ["b"]},
+        ],
+    }
+    state = make_state(rows_by_database, table_schemas={"db": ["sch"]})
+    state._stsp_schema_tables = {"db": {"sch": {"a": {}, "b": {}, "c": {}}}}
+    state.load_schema_tables_privileges()
+
+    assert state.schema_tables_privileges["db"]["sch"]["readers"] == {SchemaTablesPrivilege.SELECT: ["a", "b"]}
+
+    readers = SchemaTablesPrivilege("db", "sch", "readers", "SELECT")
+    writers = SchemaTablesPrivilege("db", "sch", "writers", ["SELECT", "INSERT"])
+    others = SchemaTablesPrivilege("db", "sch", "others", "SELECT")
+    assert state.get(readers) == ObjectState.IS_DIFFERENT
+    assert state.get(writers) == ObjectState.IS_DIFFERENT
+    assert state.get(others) == ObjectState.IS_ABSENT
+
+    assert state.get_drifted_tables(readers) == {"c": 0}
+    assert state.get_drifted_tables(writers) == {"b": SchemaTablesPrivilege.SELECT, "c": 0}
+
+    state._stsp_schema_tables["db"]["sch"].pop("c")
+    state.load_schema_tables_privileges()
+    assert state.get(readers) == ObjectState.IS_PRESENT
+    assert state.get_drifted_tables(readers) == {}
+
+
+def test_default_privilege_state():
+    rows_by_database = {
+        "db": [
+            {"grantor": "owner", "schema": "sch", "object_type": "r", "acl": "{readers=r/owner,writers=arw/owner}"},
+        ],
+    }
+    state = make_state(rows_by_database)
+    state._rsp_groups = {"owner": {}, "readers": {}, "writers": {}, "others": {}}
+    state._rsp_users = {}
+    state._ssp_schemas = {"db": {"sch": {}}}
+
+    def default_privilege(grantee, privileges, present=True):
+        privilege = SchemaTablesPrivilege("db", "sch", grantee, privileges)
+        return DefaultPrivilege(privilege=privilege, grantor="owner", present=present)
+
+    assert state.get(default_privilege("readers", "SELECT")) == ObjectState.IS_PRESENT
+    assert state.get(default_privilege("writers", "SELECT")) == ObjectState.IS_DIFFERENT
+    assert state.get(default_privilege("others", "SELECT")) == ObjectState.IS_ABSENT
+    assert state.get(default_privilege("readers", "SELECT", present=False)) == ObjectState.IS_PRESENT
+    assert state.get(default_privilege("others", "SELECT", present=False)) == ObjectState.IS_ABSENT
+
+
+def test_maintenance_is_skipped_when_state_matches():
+    state = make_state({})
+    state._rsp_role_attributes = {
+        "alice": {"inherit": False, "createdb": False, "login": True, "password": get_password_digest(get_password_md5("alice", "pw"))},
+        "bob": {"inherit": True, "createdb": False, "login": True, "password": None},
+    }
+    state._dpsp_db_privs = {"closed": {"owner": 1}, "open": {"public": 1}}
+
+    assert state.is_maintained(User("alice", password="pw"))
+    assert not state.is_maintained(User("alice", password="other"))
+    assert not state.is_maintained(User("bob"))
+    assert not state.is_maintained(User("carol"))
+
+    assert state.is_maintained(Database("closed"))
+    assert not state.is_maintained(Database("open"))
+    assert not state.is_maintained(Database("new"))
+
+
+def test_passwords_are_not_compared_when_pg_authid_cannot_be_read():
+    class ProgrammingError(Exception):
+        pass
+
+    state = make_state({})
+    master = state.connection_manager.master_connection
+    master.programming_error_cls = ProgrammingError
+    rows = [{"rolname": "alice", "rolinherit": False, "rolcreatedb": False, "rolcanlogin": True}]
+
+    def execute(query, *params):
+        if "pg_authid" in query:
+            raise ProgrammingError("permission denied for table pg_authid")
+        result = mock.Mock()
+        result.get_all.side_effect = lambda *columns: iter([dict(row, rolpassword=params[0]) for row in rows])
+        return result
+
+    master.execute.side_effect = execute
+    state.load_role_attributes()
+
+    assert state.is_maintained(User("alice", password="pw"))
+    assert not state.is_maintained(User("alice", password="pw", inherit=True))
+
+
+def test_snapshot_is_reused_for_unchanged_databases(tmp_path):
+    path = str(tmp_path / "state.json.gz")
+    rows_by_database = {"db0": [{"name": "s0", "owner": "postgres"}], "db1": [{"name": "s1", "owner": "postgres"}]}
+    state = make_state(rows_by_database, object_types={"Schema"})
+    with mock.patch.object(State, "fetch_cluster_fingerprint", return_value="c"), \
+            mock.patch.object(State, "fetch_database_fingerprints", return_value={"db0": "a", "db1": "b"}):
+        state.load_all(fingerprint=True)
+    save_snapshot(state.to_snapshot(), path)
+
+    rows_by_database = {"db0": [{"name": "changed", "owner": "postgres"}], "db1": [{"name": "new", "owner": "postgres"}]}
+    state = make_state(rows_by_database, object_types={"Schema"})
+    with mock.patch.object(State, "fetch_cluster_fingerprint", return_value="c"), \
+            mock.patch.object(State, "fetch_database_fingerprints", return_value={"db0": "a", "db1": "changed"}):
+        state.load_all(snapshot=load_snapshot(path))
+
+    # db0 has not changed according to its fingerprint, so it was not queried
+    assert set(state.schemas["db0"]) == {"s0"}
+    assert set(state.schemas["db1"]) == {"new"}
+    assert state.connection_manager.stats["misses"] == 1
+
+    state = make_state(rows_by_database, object_types={"Schema", "User"})
+    assert not state.is_snapshot_usable(load_snapshot(path))
+
+
+def test_snapshot_file_keeps_keys_which_are_not_strings(tmp_path):
+    path = str(tmp_path / "state.json")
+    snapshot = {"state": {"privileges": {"db": {("grantor", "sch", "r"): {"public": 2}}, "tables": {3: ["t"]}}}}
+    save_snapshot(snapshot, path)
+    assert load_snapshot(path) == snapshot
+    assert load_snapshot(str(tmp_path / "missing.json")) is None
+
+
+def test_snapshot_is_private_and_has_no_password_hashes(tmp_path):
+    state = make_state({})
+    password_hash = get_password_md5("alice", "pw")
+    rows = [{"rolname": "alice", "rolinherit": False, "rolcreatedb": False, "rolcanlogin": True, "rolpassword": password_hash}]
+    state.connection_manager.master_connection.execute.return_value.get_all.side_effect = lambda *columns: iter(rows)
+    state.load_role_attributes()
+    state.fingerprints = {"cluster": "c", "databases": {}}
+    assert state.is_maintained(User("alice", password="pw"))
+
+    for name in ("state.json", "state.json.gz"):
+        path = tmp_path / name
+        save_snapshot(state.to_snapshot(), str(path))
+        assert path.stat().st_mode & 0o777 == 0o600
+        assert password_hash not in json.dumps(load_snapshot(str(path)))
+    assert password_hash[3:].encode() not in (tmp_path / "state.json").read_bytes()
+    assert State.from_snapshot(load_snapshot(str(path))).is_maintained(User("alice", password="pw"))
+
+
+def test_state_can_be_exported_without_passwords(tmp_path):
+    state = make_state({})
+    rows = [{"rolname": "alice", "rolinherit": False, "rolcreatedb": False, "rolcanlogin": True, "rolpassword": "md5x"}]
+    state.connection_manager.master_connection.execute.return_value.get_all.side_effect = lambda *columns: iter(rows)
+    state.load_role_attributes()
+    state.fingerprints = {"cluster": "c", "databases": {}}
+
+    path = tmp_path / "exported.json"
+    save_snapshot(state.to_snapshot(without_passwords=True), str(path))
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert load_snapshot(str(path))["state"]["_rsp_role_attributes"]["alice"]["password"] == UNKNOWN_PASSWORD
+    assert state.role_attributes["alice"]["password"] != UNKNOWN_PASSWORD
+
+
+def make_cluster_snapshot() -> dict:
+    return {
+        "version": State.SNAPSHOT_VERSION,
+        "master": {"username": "postgres", "database": "postgres"},
+        "scope": {"databases": None, "object_types": None, "table_schemas": None},
+        "fingerprints": {"cluster": "c", "databases": {"app": "a"}},
+        "state": {
+            "_dsp_databases": {"postgres": {"name": "postgres"}, "app": {"name": "app", "owner": "postgres"}},
+            "_rsp_groups": {"public": {"name": "public"}, "readers": {"name": "readers"}},
+            "_rsp_users": {"postgres": {"name": "postgres"}},
+            "_rsp_group_users": {},
+            "_rsp_user_groups": {},
+            "_rsp_role_attributes": {"postgres": {"inherit": False, "createdb": False, "login": True, "password": None}},
+            "_dpsp_db_privs": {"app": {}},
+            "_ssp_schemas": {"app": {"public": {"name": "public", "owner": "postgres"}}},
+        },
+    }
+
+
+def test_setup_is_planned_against_exported_state_without_connecting(tmp_path, caplog):
+    path = str(tmp_path / "cluster.json.gz")
+    save_snapshot(make_cluster_snapshot(), path)
+    state = State.from_snapshot(load_snapshot(path))
+    assert state.master_connection.username == "postgres"
+
+    setup = Setup(server_state=state)
+    setup.group("readers")
+    setup.group("writers")
+    setup.database("app")
+    setup.schema("reports", database="app", owner="writers")
+    assert setup.master_user == "postgres"
+
+    with caplog.at_level(logging.DEBUG, logger="pg_objects.connection"):
+        setup.execute(dry_run=True)
+    queries = [record.getMessage() for record in caplog.records if "[DRY-RUN]" in record.getMessage()]
+    assert any("CREATE GROUP writers" in q for q in queries)
+    assert any("CREATE SCHEMA reports" in q for q in queries)
+    assert not any("CREATE GROUP readers" in q or "CREATE DATABASE" in q for q in queries)
+    assert not setup.mc.is_connected
+
+    with pytest.raises(ValueError):
+        setup.execute()
+
+
+def test_drift_is_reported_without_generating_statements():
+    setup = Setup(server_state=State.from_snapshot(make_cluster_snapshot()))
+    setup.group("readers")
+    setup.group("writers")
+    setup.database("app")
+    setup.schema("public", database="app")
+    setup.schema("reports", database="app", present=False)
+
+    with mock.patch("pg_objects.objects.base.Object.stmts_to_create") as stmts_to_create:
+        drift = setup.get_drift()
+    assert not stmts_to_create.called
+    assert drift == {"create": ["Group(writers)"], "update": [], "maintain": [], "drop": []}
+
+    setup = Setup(server_state=State.from_snapshot(make_cluster_snapshot()))
+    setup.group("readers")
+    setup.database("app")
+    assert setup.get_drift() == {"create": [], "update": [], "maintain": [], "drop": []}
+
+
+def test_fingerprints_of_unchanged_databases_are_not_fetched():
+    rows_by_database = {f"db{i}": [{"name": "public", "owner": "postgres"}] for i in range(3)}
+    state = make_state(rows_by_database, object_types={"Schema"})
+    with mock.patch.object(State, "fetch_cluster_fingerprint", return_value="c"), \
+            mock.patch.object(State, "fetch_database_fingerprints", return_value={"db0": "a", "db1": "b", "db2": "c"}):
+        state.load_all(fingerprint=True)
+    snapshot = state.to_snapshot()
+
+    state = make_state(rows_by_database, object_types={"Schema"})
+    with mock.patch.object(State, "fetch_cluster_fingerprint", return_value="c"), \
+            mock.patch.object(State, "fetch_database_fingerprints", return_value={"db2": "c"}) as fetch:
+        state.load_all(snapshot=snapshot, unchanged_databases={"db0", "db1"})
+
+    assert fetch.call_args == mock.call(only=["db2"])
+    assert state.fingerprints["databases"] == {"db0": "a", "db1": "b", "db2": "c"}
+    assert state.connection_manager.stats["misses"] == 0